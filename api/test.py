@@ -5,7 +5,9 @@ import numpy as np
 import pandas as pd
 
 from local_api import BungieAPI
+from api_cache import ResponseCache
 from models.activity import Activity
+from models.carnage_report import CarnageReport, parse_carnage_report
 from models.guardian import Guardian
 
 
@@ -32,39 +34,17 @@ class MatchPredictor:
         
         return True
 
-    def _extract_guardians_from_carnage_report(self, carnage_report) -> list[list[Guardian], list[Guardian]]:
+    def _extract_guardians_from_carnage_report(self, report: CarnageReport) -> list[list[Guardian], list[Guardian]]:
         """
-        Extract guardians ids from the carnage report and return two lists of guardians - one for each team.
-        :param carnage_report: 
+        Split the guardians of the carnage report in two lists of guardians - one for each team.
+        :param report: parsed carnage report, with a guardian by player
         :return: 
         """
         guardians = [[], []]
         
-        team_a = carnage_report["teams"][0]["teamId"]
-        # team_b = carnage_report["teams"][1]["teamId"]
-        
-        for entry in carnage_report["entries"]:
-            # Not always available (old or private profile)
-            display_name = ""
-            display_name_code = ""
-            try:
-                display_name = entry["player"]["destinyUserInfo"]["bungieGlobalDisplayName"]
-                display_name_code = entry["player"]["destinyUserInfo"]["bungieGlobalDisplayNameCode"]
-            except:
-                pass
-
-            membership_id = entry["player"]["destinyUserInfo"]["membershipId"]
-            membership_type = entry["player"]["destinyUserInfo"]["membershipType"]
-            character_id = entry["characterId"]
-            is_private = not entry["player"]["destinyUserInfo"]["isPublic"]
-            guardian = Guardian(display_name=display_name,
-                                display_name_code=display_name_code,
-                                membership_id=membership_id,
-                                membership_type=membership_type,
-                                character_id=character_id,
-                                is_private=is_private)
-            
-            if entry["values"]["team"]["basic"]["value"] == team_a:
+        team_a = report.teams[0].team_id
+        for player, guardian in zip(report.players, report.guardians):
+            if player.team == team_a:
                 guardians[0].append(guardian)
             else:
                 guardians[1].append(guardian)
@@ -136,22 +116,17 @@ class MatchPredictor:
         :return: 
         """
         # Fetch carnage report
-        carnage_report = await self.api.fetch_carnage_report(activity.instance_id)
-        if 70 not in carnage_report["activityDetails"]["modes"]:  # Quickplay
+        report = parse_carnage_report(await self.api.fetch_carnage_report(activity.instance_id))
+        if 70 not in report.modes or len(report.teams) < 2:  # Quickplay
             raise Exception("Trying to predict a match that is not quickplay.")
         
         # Extract guardians in teams
-        guardians = self._extract_guardians_from_carnage_report(carnage_report)
+        guardians = self._extract_guardians_from_carnage_report(report)
         
         pred = await self.predict_winner_from_guardians(guardians)
-        pred_team = carnage_report["teams"][np.argmax(pred)]["teamId"]
+        pred_team = report.teams[np.argmax(pred)].team_id
         print(f"Team {pred_team} has {max(pred)}% chance of winning.")
-        
-        if carnage_report["teams"][0]["standing"]["basic"]["value"] > 0.5:
-            winning_team = carnage_report["teams"][0]["teamId"]
-        else:
-            winning_team = carnage_report["teams"][1]["teamId"]
-        print(f"Team {winning_team} won the game.")
+        print(f"Team {report.winning_team} won the game.")
         
         return pred
 
@@ -159,7 +134,7 @@ class MatchPredictor:
 async def main():
     global r
     async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=3600)) as session:
-        api = BungieAPI(session)
+        api = BungieAPI(session, cache=ResponseCache())
         predictor = MatchPredictor(api, "api/model_quickplay.json")
         r = await predictor.predict_winner_from_activity(Activity(instance_id=11983979189))
         print(r)
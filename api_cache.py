@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import zlib
+
+
+class ResponseCache:
+    """
+    On-disk cache of the bodies of the api json responses as received, stored zlib-compressed in sqlite. They are decoded
+    after being read, a decoder reading some fields only does not change what is cached.
+    Each entry has its own ttl (None for immutable data) and the least recently used entries are evicted when the
+    cache gets bigger than max_size.
+    """
+    EVICTION_RATIO = 0.9  # evict down to this ratio of max_size to not evict at every insertion
+
+    def __init__(self, filename="api_cache.db", folder="data", max_size=2 * 1024 ** 3, compression_level=6):
+        """
+
+        :param filename:
+        :param folder: created if it does not exist
+        :param max_size: max size of the compressed bodies in bytes
+        :param compression_level: zlib level
+        """
+        os.makedirs(folder, exist_ok=True)
+        self.max_size = max_size
+        self.compression_level = compression_level
+
+        # Autocommit, WAL makes each small write cheap
+        self.connexion = sqlite3.connect(os.path.join(folder, filename), isolation_level=None)
+        self.connexion.execute("PRAGMA journal_mode=WAL")
+        self.connexion.execute("PRAGMA synchronous=NORMAL")
+        self.connexion.execute("CREATE TABLE IF NOT EXISTS response ("
+                               "key TEXT PRIMARY KEY, "
+                               "body BLOB NOT NULL, "
+                               "size INTEGER NOT NULL, "
+                               "expires_at REAL, "
+                               "last_access REAL NOT NULL)")
+        self.connexion.execute("CREATE INDEX IF NOT EXISTS response_last_access ON response (last_access)")
+        self.size = self.connexion.execute("SELECT COALESCE(SUM(size), 0) FROM response").fetchone()[0]
+
+    @staticmethod
+    def make_key(url: str, params=None, body=None) -> str:
+        request = json.dumps([url, params or {}, body], sort_keys=True, default=str)
+        return hashlib.sha1(request.encode()).hexdigest()
+
+    def get(self, key: str):
+        """
+        :return: the json body of the response or None if it is not cached or expired
+        """
+        row = self.connexion.execute("SELECT body, expires_at FROM response WHERE key=?", [key]).fetchone()
+        if row is None:
+            return None
+
+        body, expires_at = row
+        now = time.time()
+        if expires_at is not None and expires_at < now:
+            self._delete(key)
+            return None
+
+        self.connexion.execute("UPDATE response SET last_access=? WHERE key=?", [now, key])
+        return zlib.decompress(body)
+
+    def put(self, key: str, response: bytes, ttl=None):
+        """
+
+        :param key: see make_key
+        :param response: json body of the response
+        :param ttl: seconds before expiration, None never expires
+        """
+        body = zlib.compress(response, self.compression_level)
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+
+        self._delete(key)
+        self.connexion.execute("INSERT INTO response (key, body, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                               [key, body, len(body), expires_at, now])
+        self.size += len(body)
+
+        if self.size > self.max_size:
+            self._evict()
+
+    def _delete(self, key: str):
+        row = self.connexion.execute("SELECT size FROM response WHERE key=?", [key]).fetchone()
+        if row is not None:
+            self.connexion.execute("DELETE FROM response WHERE key=?", [key])
+            self.size -= row[0]
+
+    def _evict(self):
+        target_size = self.max_size * ResponseCache.EVICTION_RATIO
+        while self.size > target_size:
+            rows = self.connexion.execute("SELECT key, size FROM response ORDER BY last_access LIMIT 256").fetchall()
+            if len(rows) == 0:
+                break
+            for key, size in rows:
+                self.connexion.execute("DELETE FROM response WHERE key=?", [key])
+                self.size -= size
+                if self.size <= target_size:
+                    break
+
+    def close(self):
+        self.connexion.close()
+
+    def __str__(self):
+        return f"ResponseCache of {self.size / 1024 ** 2:.1f}MB."
@@ -0,0 +1,192 @@
+"""
+Decoders of the json responses of the api. The responses are plain dicts and lists whatever the decoder, the fastest
+one installed is used by default: msgspec, orjson then the json module.
+
+With msgspec, the responses of the endpoints in RESPONSE_SCHEMAS are decoded with a typed schema: only the fields the
+models read are built, the rest of the body is validated and skipped (most of a carnage report or of a history page).
+A response which does not fit its schema is decoded in full.
+"""
+import json
+import logging
+from typing import Any, TypedDict
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class DecodeError(ValueError):
+    """
+    The body of a response is not json.
+    """
+
+
+# Schemas of the fields read by the models, total=False: a missing field is left out like in the full response.
+# Any is decoded in full.
+class BasicValue(TypedDict, total=False):
+    value: Any
+
+
+class StatValue(TypedDict, total=False):
+    basic: BasicValue
+
+
+class CarnageReportUserInfo(TypedDict, total=False):
+    membershipId: Any
+    membershipType: Any
+    isPublic: Any
+    bungieGlobalDisplayName: Any
+    bungieGlobalDisplayNameCode: Any
+
+
+class CarnageReportPlayer(TypedDict, total=False):
+    destinyUserInfo: CarnageReportUserInfo
+
+
+class CarnageReportEntryValues(TypedDict, total=False):
+    team: StatValue
+
+
+class CarnageReportEntry(TypedDict, total=False):
+    characterId: Any
+    player: CarnageReportPlayer
+    values: CarnageReportEntryValues  # without the stats of the player and its "extended" weapons and medals
+
+
+class CarnageReportTeam(TypedDict, total=False):
+    teamId: Any
+    standing: StatValue
+    score: StatValue
+
+
+class CarnageReport(TypedDict, total=False):
+    period: Any
+    activityDetails: dict[str, Any]
+    teams: list[CarnageReportTeam]
+    entries: list[CarnageReportEntry]
+
+
+class HistoryActivity(TypedDict, total=False):
+    period: Any
+    activityDetails: dict[str, Any]  # without the "values" of the character, dropped by iter_activity_history
+
+
+class HistoryPage(TypedDict, total=False):
+    activities: list[HistoryActivity]
+
+
+class PvPStats(TypedDict, total=False):
+    allTime: dict[str, StatValue]
+
+
+class Stats(TypedDict, total=False):
+    allPvP: PvPStats  # without the other modes
+
+
+def response_schema(schema):
+    """
+    :return: schema of the envelope of the api around a Response of the given schema
+    """
+    return TypedDict(f"{schema.__name__}Response", {
+        "Response": schema,
+        "ErrorCode": Any,
+        "ThrottleSeconds": Any,
+        "ErrorStatus": Any,
+        "Message": Any,
+        "MessageData": Any,
+    }, total=False)
+
+
+# endpoint name (see BungieAPI): schema of its responses
+RESPONSE_SCHEMAS = {
+    "carnage_report": response_schema(CarnageReport),
+    "activity_history": response_schema(HistoryPage),
+    "stats": response_schema(Stats),
+}
+
+
+class JSONDecoder:
+    """
+    json module, every field of the responses.
+    """
+    name = "json"
+
+    def decode(self, body: bytes, endpoint: str = None):
+        """
+        :param body: json body of a response
+        :param endpoint: name of the endpoint of the response
+        :return: the response as dicts and lists
+        """
+        try:
+            return json.loads(body)
+        except ValueError as err:
+            raise DecodeError(str(err)) from err
+
+
+class OrjsonDecoder(JSONDecoder):
+    """
+    orjson, every field of the responses.
+    """
+    name = "orjson"
+
+    def decode(self, body: bytes, endpoint: str = None):
+        try:
+            return orjson.loads(body)
+        except orjson.JSONDecodeError as err:
+            raise DecodeError(str(err)) from err
+
+
+class MsgspecDecoder(JSONDecoder):
+    """
+    msgspec, only the fields of the schema of the endpoint for the endpoints with a schema.
+    """
+    name = "msgspec"
+
+    def __init__(self, schemas: dict = None):
+        """
+        :param schemas: endpoint: schema of its responses, RESPONSE_SCHEMAS by default and {} to decode every field
+        """
+        if schemas is None:
+            schemas = RESPONSE_SCHEMAS
+        self.decoder = msgspec.json.Decoder()
+        self.decoders = {endpoint: msgspec.json.Decoder(schema) for endpoint, schema in schemas.items()}
+
+    def decode(self, body: bytes, endpoint: str = None):
+        try:
+            decoder = self.decoders.get(endpoint)
+            if decoder is not None:
+                try:
+                    return decoder.decode(body)
+                except msgspec.ValidationError as err:
+                    logging.debug(f"Response of {endpoint} decoded in full, it does not fit its schema : {err}")
+            return self.decoder.decode(body)
+        except msgspec.DecodeError as err:
+            raise DecodeError(str(err)) from err
+
+
+# By order of preference
+DECODERS = {
+    "msgspec": MsgspecDecoder,
+    "orjson": OrjsonDecoder,
+    "json": JSONDecoder,
+}
+AVAILABLE_DECODERS = [name for name, module in (("msgspec", msgspec), ("orjson", orjson), ("json", json))
+                      if module is not None]
+
+
+def get_decoder(name: str = None) -> JSONDecoder:
+    """
+    :param name: one of AVAILABLE_DECODERS, the first one by default
+    :return:
+    """
+    if name is None:
+        name = AVAILABLE_DECODERS[0]
+    if name not in AVAILABLE_DECODERS:
+        raise ValueError(f"Decoder {name} is not available, installed decoders: {AVAILABLE_DECODERS}.")
+    return DECODERS[name]()
@@ -0,0 +1,24 @@
+"""
+Databases of the benchmarks, seeded with players of the fake server.
+"""
+from benchmarks.fake_bungie_server import SampleResponses
+from db import MainDBHelper, SourceDBHelper
+from models.guardian import Guardian
+
+
+def make_seeds(samples: SampleResponses, n_seeds: int) -> list[Guardian]:
+    return [Guardian(membership_id=samples.membership_id(player),
+                     membership_type=3,
+                     character_id=samples.character_id(samples.membership_id(player), 0))
+            for player in range(n_seeds)]
+
+
+def create_dbs(folder: str, seeds: list[Guardian]):
+    """
+    Create main.db, with the seeds as guardians, and an empty sources.db in folder.
+    """
+    db_helper = MainDBHelper("main.db", folder, create=True)
+    db_helper.insert_guardians(seeds)
+    db_helper.commit()
+    db_helper.close()
+    SourceDBHelper("sources.db", folder, create=True).close()
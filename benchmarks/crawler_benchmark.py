@@ -0,0 +1,84 @@
+"""
+End-to-end throughput of the crawler (CrawlPipeline, BungieAPI and DBWriter) against the local fake server:
+requests/s, rows/s and latency percentiles of the api calls.
+
+    python -m benchmarks.crawler_benchmark --duration 60 --latency 0.1 --latency-sigma 0.5 --error-rate 0.01
+    python -m benchmarks.crawler_benchmark --rate 200 --throttle-rate 150
+"""
+import asyncio
+import tempfile
+import time
+
+import aiohttp
+
+from benchmarks.common import create_dbs, make_seeds
+from benchmarks.fake_bungie_server import FakeBungieServer, parse_args, server_kwargs
+from crawler import CrawlPipeline
+from db import MainDBHelper, SourceDBHelper, DBWriter, ExistenceIndex, CrawlFrontier
+from local_api import BungieAPI
+
+
+def parse_benchmark_args(args=None):
+    parser = parse_args()
+    parser.add_argument("--duration", type=float, default=30, help="seconds of crawl")
+    parser.add_argument("--seeds", type=int, default=16, help="sources in main.db before the crawl")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="requests/s of the client, default BungieAPI.RATE (and MAX_RATE)")
+    return parser.parse_args(args)
+
+
+async def run(args) -> dict:
+    """
+    :param args: see parse_benchmark_args
+    :return: results
+    """
+    if args.rate is not None:
+        BungieAPI.RATE = BungieAPI.MAX_RATE = args.rate
+
+    kwargs = server_kwargs(args)
+    folder = tempfile.mkdtemp()
+    create_dbs(folder, make_seeds(kwargs["samples"], args.seeds))
+    db_helper = MainDBHelper("main.db", folder)
+    source_db_helper = SourceDBHelper("sources.db", folder)
+    frontier = CrawlFrontier(folder=folder)
+
+    async with FakeBungieServer(**kwargs) as server:
+        BungieAPI.ENDPOINT = server.endpoint
+        async with aiohttp.ClientSession() as session:
+            api = BungieAPI(session, api_key="fake-key")
+            pipeline = CrawlPipeline(api, ExistenceIndex(db_helper, source_db_helper), DBWriter(folder=folder))
+
+            start_time = time.monotonic()
+            try:
+                await asyncio.wait_for(pipeline.run(frontier), args.duration)
+            except asyncio.TimeoutError:
+                pass
+            elapsed = time.monotonic() - start_time
+
+    frontier.close()
+    db_helper.close()
+    source_db_helper.close()
+
+    return {
+        "seconds": elapsed,
+        "requests_per_second": server.counters["requests"] / elapsed,
+        "rows_per_second": pipeline.writer.metrics["rows_written"] / elapsed,
+        **api.latency_percentiles(),
+        "server": dict(server.counters),
+        "api": api.metrics,
+        "writer": pipeline.writer.metrics
+    }
+
+
+def main():
+    results = asyncio.run(run(parse_benchmark_args()))
+    print(f"{results['server'].get('requests', 0)} requests in {results['seconds']:.1f}s: "
+          f"{results['requests_per_second']:.1f} req/s, {results['rows_per_second']:.1f} rows/s.")
+    if "latency_p50" in results:
+        print(f"Latency p50 {results['latency_p50'] * 1000:.1f}ms, p99 {results['latency_p99'] * 1000:.1f}ms.")
+    print(f"Server: {results['server']}")
+    print(f"API: {results['api']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Inserts and lookups of MainDBHelper and SourceDBHelper on a large db (10M guardians by default): rows/s of the inserts
+by batch as the db grows, then microseconds by lookup of random rows, half of them missing.
+
+    python -m benchmarks.db_benchmark --folder bench_data --output db_results.json
+    python -m benchmarks.db_benchmark --guardians 1000000 --activities 100000
+
+The dbs of --folder are reused when they exist, only the lookups are measured again.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from db import MainDBHelper, SourceDBHelper, CrawlFrontier
+from models.activity import Activity
+from models.carnage_report import Player
+from models.guardian import Guardian
+
+FIRST_MEMBERSHIP_ID = 4611686018400000000
+FIRST_CHARACTER_ID = 2305843009200000000
+FIRST_INSTANCE_ID = 9000000000
+PLAYERS_BY_ACTIVITY = 12
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folder", default=None, help="folder of the dbs, a temporary folder by default")
+    parser.add_argument("--guardians", type=int, default=10000000, help="rows of the guardian table")
+    parser.add_argument("--activities", type=int, default=1000000,
+                        help=f"rows of the activity table, with {PLAYERS_BY_ACTIVITY} activity_player rows each")
+    parser.add_argument("--sources", type=int, default=1000000, help="rows of sources.db")
+    parser.add_argument("--batch", type=int, default=100000, help="rows by insert transaction")
+    parser.add_argument("--lookups", type=int, default=20000, help="lookups of each kind")
+    parser.add_argument("--output", default=None, help="json file of the results")
+    return parser.parse_args(args)
+
+
+def make_guardian(k: int) -> Guardian:
+    guardian = Guardian(display_name=f"guardian{k}", display_name_code=k % 10000,
+                        membership_id=FIRST_MEMBERSHIP_ID + k, membership_type=3, character_id=FIRST_CHARACTER_ID + k)
+    guardian.activities_entered = k % 5000
+    guardian.combat_rating = k % 300 / 3
+    return guardian
+
+
+def make_activity(k: int, n_guardians: int) -> Activity:
+    activity = Activity(instance_id=FIRST_INSTANCE_ID + k)
+    activity.period = "2021-12-31T00:00:00Z"
+    activity.mode = 5
+    for player in range(PLAYERS_BY_ACTIVITY):
+        g = (k * PLAYERS_BY_ACTIVITY + player) % n_guardians
+        activity.players.append(Player(FIRST_MEMBERSHIP_ID + g, 3, FIRST_CHARACTER_ID + g, player < 6,
+                                       17 if player < 6 else 18))
+    return activity
+
+
+def fill(args, db_helper: MainDBHelper, source_db_helper: SourceDBHelper) -> dict:
+    """
+    Insert the rows in a random order, like the crawler does.
+    :return: rows/s of the first and last batches and of the whole fill, by table
+    """
+    rng = np.random.default_rng(0)
+    results = {}
+    for table, n_rows, insert in (
+            ("guardian", args.guardians,
+             lambda ks: db_helper.insert_guardians([make_guardian(k) for k in ks])),
+            ("activity", args.activities,
+             lambda ks: db_helper.insert_activities([make_activity(k, args.guardians) for k in ks])),
+            ("source", args.sources,
+             lambda ks: source_db_helper.insert_sources([FIRST_MEMBERSHIP_ID + k for k in ks]))):
+        helper = source_db_helper if table == "source" else db_helper
+        order = rng.permutation(n_rows).tolist()
+        total_seconds = 0
+        rates = []
+        for i in range(0, n_rows, args.batch):
+            batch = order[i:i + args.batch]
+            start_time = time.perf_counter()
+            insert(batch)
+            helper.commit()
+            elapsed = time.perf_counter() - start_time
+            total_seconds += elapsed
+            rates.append(len(batch) / elapsed)
+            print(f"{table}: {i + len(batch)} rows, {rates[-1]:.0f} rows/s.")
+        results[f"{table}_insert_rows_per_second"] = n_rows / total_seconds
+        results[f"{table}_insert_first_batch_rows_per_second"] = rates[0]
+        results[f"{table}_insert_last_batch_rows_per_second"] = rates[-1]
+    return results
+
+
+def lookups(args, db_helper: MainDBHelper, source_db_helper: SourceDBHelper, folder: str) -> dict:
+    """
+    :return: microseconds by lookup, by kind of lookup
+    """
+    random.seed(0)
+    n_guardians = db_helper.execute("SELECT MAX(ROWID) FROM guardian", [])[0][0]
+    n_activities = db_helper.execute("SELECT COUNT(*) FROM activity", [])[0][0]
+
+    # Half of the rows are not in the db
+    guardians = [Guardian(membership_id=FIRST_MEMBERSHIP_ID + k, membership_type=3, character_id=FIRST_CHARACTER_ID + k)
+                 for k in (random.randrange(2 * n_guardians) for _ in range(args.lookups))]
+    activities = [Activity(instance_id=str(FIRST_INSTANCE_ID + random.randrange(2 * n_activities)))
+                  for _ in range(args.lookups)]
+    membership_ids = [guardian.membership_id for guardian in guardians]
+
+    def measure(function, items) -> float:
+        start_time = time.perf_counter()
+        for item in items:
+            function(item)
+        return (time.perf_counter() - start_time) / len(items) * 1e6
+
+    results = {
+        "is_guardian_in_db_from_ids_us": measure(db_helper.is_guardian_in_db_from_ids, guardians),
+        "get_guardian_from_ids_us": measure(db_helper.get_guardian_from_ids, guardians),
+        "get_guardian_from_row_id_us": measure(db_helper.get_guardian_from_row_id,
+                                               [random.randint(1, n_guardians) for _ in range(args.lookups)]),
+        "is_activity_in_db_from_id_us": measure(db_helper.is_activity_in_db_from_id, activities),
+        "get_activity_from_id_us": measure(db_helper.get_activity_from_id, activities),
+        "get_player_instance_ids_us": measure(db_helper.get_player_instance_ids, membership_ids),
+        "is_source_already_used_us": measure(source_db_helper.is_source_already_used, membership_ids),
+    }
+
+    # Batches of the frontier, from a random position of each order
+    n_batches = max(1, args.lookups // 100)
+    for order in CrawlFrontier.ORDERS:
+        frontier = CrawlFrontier(folder=folder, order=order)
+        positions = [db_helper.execute(f"SELECT {CrawlFrontier.ORDERS[order][0].replace('g.', '')}, ROWID "
+                                       f"FROM guardian WHERE ROWID=?", [random.randint(1, n_guardians)])[0]
+                     for _ in range(n_batches)]
+
+        def next_batch(position):
+            frontier.cursor = tuple(position)
+            frontier._next_batch()
+
+        results[f"frontier_{order}_batch_us"] = measure(next_batch, positions)
+        frontier.close()
+    return results
+
+
+def run(args) -> dict:
+    folder = args.folder if args.folder is not None else tempfile.mkdtemp()
+    os.makedirs(folder, exist_ok=True)
+    exists = os.path.exists(os.path.join(folder, "main.db"))
+
+    start_time = time.perf_counter()
+    db_helper = MainDBHelper("main.db", folder, create=True)
+    source_db_helper = SourceDBHelper("sources.db", folder, create=True)
+    results = {"open_seconds": time.perf_counter() - start_time}
+    if not exists:
+        results.update(fill(args, db_helper, source_db_helper))
+    results.update(lookups(args, db_helper, source_db_helper, folder))
+    results["main_db_bytes"] = os.path.getsize(os.path.join(folder, "main.db"))
+    db_helper.close()
+    source_db_helper.close()
+    return results
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    for metric, value in results.items():
+        print(f"{metric}: {value:.2f}")
+    if args.output is not None:
+        with open(args.output, "w") as fp:
+            json.dump({"config": vars(args), "results": results}, fp, indent=2)
+        print(f"Results written in {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,354 @@
+"""
+Local stand-in for the Bungie API, used to benchmark the client without network nor api key.
+The endpoints used by the crawler answer synthetic responses built from the json samples, see SampleResponses, or
+responses recorded from the real api (see FakeBungieServer fixtures). Latency, errors and throttling are simulated.
+
+    python -m benchmarks.fake_bungie_server --latency 0.15 --error-rate 0.01 --throttle-rate 25
+    python -m benchmarks.fake_bungie_server --fixtures data/fixtures --upstream https://www.bungie.net/Platform
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import math
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+import aiohttp
+from aiohttp import web
+
+HOST = "127.0.0.1"
+SAMPLES_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "samples")
+API_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+SUCCESS_RESPONSE = {
+    "Response": {},
+    "ErrorCode": 1,
+    "ThrottleSeconds": 0,
+    "ErrorStatus": "Success",
+    "Message": "Ok",
+    "MessageData": {}
+}
+
+THROTTLE_RESPONSE = {
+    "ErrorCode": 51,
+    "ThrottleSeconds": 1,
+    "ErrorStatus": "PerEndpointRequestThrottleExceeded",
+    "Message": "Too many requests.",
+    "MessageData": {}
+}
+
+
+def read_sample(name: str, folder=SAMPLES_FOLDER):
+    with open(os.path.join(folder, name), encoding="utf-8-sig") as fp:
+        return json.load(fp)
+
+
+class SampleResponses:
+    """
+    Synthetic responses built from the samples. Players, characters and matches are drawn from fixed pools with
+    generators seeded by the ids of the request, so every request (and every run) sees the same data: players of a
+    carnage report have a profile, a history made of other matches of the pool, and stats.
+    """
+    FIRST_MEMBERSHIP_ID = 4611686018400000000
+    FIRST_CHARACTER_ID = 2305843009200000000
+    FIRST_INSTANCE_ID = 9000000000
+    LAST_PERIOD = datetime(2021, 12, 31)
+
+    def __init__(self,
+                 folder=SAMPLES_FOLDER,
+                 n_players=100000,
+                 n_activities=1000000,
+                 n_characters=3,
+                 history_size=100,
+                 private_ratio=0.05):
+        """
+
+        :param folder: samples folder
+        :param n_players: size of the player pool
+        :param n_activities: size of the match pool
+        :param n_characters: characters by player
+        :param history_size: matches in the history of a character
+        :param private_ratio: probability for a player of a carnage report to be private
+        """
+        self.n_players = n_players
+        self.n_activities = n_activities
+        self.n_characters = n_characters
+        self.history_size = history_size
+        self.private_ratio = private_ratio
+
+        # Templates are kept serialized, loading them is a cheap deep copy
+        self.carnage_report_template = json.dumps(read_sample("carnage_report.json", folder)["Response"])
+        self.activity_template = json.dumps(read_sample("activities_page_1.json", folder)["activities"][0])
+        characters = read_sample("player_profile.json", folder)["characters"]["data"]
+        self.character_template = json.dumps(next(iter(characters.values())))
+        self.stats = read_sample("player_pvp_stats.json", folder)["Response"]
+
+    def membership_id(self, player: int) -> int:
+        return SampleResponses.FIRST_MEMBERSHIP_ID + player
+
+    def character_id(self, membership_id, k: int) -> int:
+        player = int(membership_id) - SampleResponses.FIRST_MEMBERSHIP_ID
+        return SampleResponses.FIRST_CHARACTER_ID + player * self.n_characters + k
+
+    def profile(self, membership_id, membership_type):
+        data = {}
+        for k in range(self.n_characters):
+            character = json.loads(self.character_template)
+            character["membershipId"] = str(membership_id)
+            character["membershipType"] = int(membership_type)
+            character["characterId"] = str(self.character_id(membership_id, k))
+            data[character["characterId"]] = character
+        return {"characters": {"data": data}}
+
+    def activity_history(self, character_id, page: int, count: int):
+        rng = random.Random(int(character_id))
+        instance_ids = [SampleResponses.FIRST_INSTANCE_ID + rng.randrange(self.n_activities)
+                        for _ in range(self.history_size)]
+
+        activities = []
+        for i in range(page * count, min((page + 1) * count, self.history_size)):
+            activity = json.loads(self.activity_template)
+            activity["period"] = (SampleResponses.LAST_PERIOD - timedelta(hours=i)).strftime(API_DATE_FORMAT)
+            activity["activityDetails"]["instanceId"] = str(instance_ids[i])
+            activities.append(activity)
+
+        # Like the api, no activities attribute past the end of the history
+        return {"activities": activities} if len(activities) > 0 else {}
+
+    def carnage_report(self, instance_id):
+        rng = random.Random(int(instance_id))
+        report = json.loads(self.carnage_report_template)
+        report["period"] = (SampleResponses.LAST_PERIOD - timedelta(minutes=rng.randrange(525600))
+                            ).strftime(API_DATE_FORMAT)
+        report["activityDetails"]["instanceId"] = str(instance_id)
+        for entry in report["entries"]:
+            membership_id = self.membership_id(rng.randrange(self.n_players))
+            user_info = entry["player"]["destinyUserInfo"]
+            user_info["membershipId"] = str(membership_id)
+            user_info["isPublic"] = rng.random() >= self.private_ratio
+            entry["characterId"] = str(self.character_id(membership_id, rng.randrange(self.n_characters)))
+        return report
+
+
+class FakeBungieServer:
+    """
+    Every request goes through the simulation: per key throttling, then latency, then errors, then the response
+    (replayed fixture, recorded upstream response or synthetic sample).
+    """
+    TRANSIENT_HTTP_STATUS = (502, 504)
+
+    def __init__(self,
+                 host=HOST,
+                 port=0,
+                 samples: SampleResponses = None,
+                 latency=0,
+                 latency_sigma=0,
+                 error_rate=0,
+                 throttle_rate=None,
+                 throttle_burst=20,
+                 fixtures=None,
+                 upstream=None,
+                 seed=None):
+        """
+
+        :param host:
+        :param port: 0 to let the os pick a free port
+        :param samples: default SampleResponses()
+        :param latency: median seconds before a response
+        :param latency_sigma: sigma of the log-normal distribution of the latency, 0 for a constant latency
+        :param error_rate: probability of a transient error (502 or 504)
+        :param throttle_rate: requests/s allowed by api key before a throttling error, None for no throttling
+        :param throttle_burst: requests allowed at once by api key
+        :param fixtures: folder of the recorded responses, replayed when they exist
+        :param upstream: api endpoint to forward the requests to, their responses are recorded in fixtures
+        :param seed: of the latency and error draws
+        """
+        self.host = host
+        self.port = port
+        self.samples = samples if samples is not None else SampleResponses()
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.throttle_burst = throttle_burst
+        self.fixtures = fixtures
+        self.upstream = upstream
+        self.random = random.Random(seed)
+
+        self.request_times = []  # time.monotonic() of every request received
+        self.counters = collections.Counter()
+        self.buckets = {}  # api key: (tokens, time.monotonic() of the last refill)
+        self.upstream_session = None
+
+        if fixtures is not None:
+            os.makedirs(fixtures, exist_ok=True)
+
+        self.app = web.Application(middlewares=[self.simulate])
+        self.app.router.add_get("/Platform/Destiny2/{membershipType}/Profile/{membershipId}/", self.handle_profile)
+        self.app.router.add_get(
+            "/Platform/Destiny2/{membershipType}/Account/{membershipId}/Character/{characterId}/Stats/Activities/",
+            self.handle_activity_history)
+        self.app.router.add_get(
+            "/Platform/Destiny2/{membershipType}/Account/{membershipId}/Character/{characterId}/Stats/",
+            self.handle_stats)
+        self.app.router.add_get("/Platform/Destiny2/Stats/PostGameCarnageReport/{instanceId}/",
+                                self.handle_carnage_report)
+        self.app.router.add_route("*", "/Platform/{tail:.*}", self.handle)
+        self.runner = None
+
+    @property
+    def endpoint(self):
+        """Value to use for BungieAPI.ENDPOINT."""
+        return f"http://{self.host}:{self.port}/Platform"
+
+    async def start(self):
+        if self.upstream is not None:
+            self.upstream_session = aiohttp.ClientSession()
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+        if self.upstream_session is not None:
+            await self.upstream_session.close()
+
+    @web.middleware
+    async def simulate(self, request: web.Request, handler):
+        self.request_times.append(time.monotonic())
+        self.counters["requests"] += 1
+
+        if not self._take_token(request.headers.get("X-API-Key")):
+            self.counters["throttled"] += 1
+            return web.json_response(THROTTLE_RESPONSE)
+
+        if self.latency > 0:
+            await asyncio.sleep(self.latency * math.exp(self.random.gauss(0, self.latency_sigma)))
+
+        if self.random.random() < self.error_rate:
+            self.counters["errors"] += 1
+            return web.Response(status=self.random.choice(FakeBungieServer.TRANSIENT_HTTP_STATUS))
+
+        if self.upstream is not None:
+            return await self._record(request)
+
+        fixture = self._fixture_path(request)
+        if fixture is not None and os.path.exists(fixture):
+            self.counters["replayed"] += 1
+            return web.FileResponse(fixture, headers={"Content-Type": "application/json"})
+
+        return await handler(request)
+
+    def _take_token(self, api_key) -> bool:
+        if self.throttle_rate is None:
+            return True
+
+        now = time.monotonic()
+        tokens, last_update = self.buckets.get(api_key, (self.throttle_burst, now))
+        tokens = min(tokens + (now - last_update) * self.throttle_rate, self.throttle_burst)
+        if tokens < 1:
+            self.buckets[api_key] = (tokens, now)
+            return False
+        self.buckets[api_key] = (tokens - 1, now)
+        return True
+
+    def _fixture_path(self, request: web.Request):
+        if self.fixtures is None:
+            return None
+        # Path relative to the endpoint and sorted query, the same call from any client has the same fixture
+        path = request.path[len("/Platform"):]
+        query = sorted(request.query.items())
+        key = hashlib.sha1(json.dumps([request.method, path, query]).encode()).hexdigest()
+        return os.path.join(self.fixtures, f"{key}.json")
+
+    async def _record(self, request: web.Request):
+        url = self.upstream + request.path[len("/Platform"):]
+        async with self.upstream_session.request(request.method, url,
+                                                 params=request.query,
+                                                 data=await request.read(),
+                                                 headers={"X-API-Key": request.headers.get("X-API-Key", "")}) as resp:
+            body = await resp.read()
+            status = resp.status
+
+        fixture = self._fixture_path(request)
+        if status == 200 and fixture is not None and json.loads(body).get("ErrorCode") == 1:
+            with open(fixture, "wb") as fp:
+                fp.write(body)
+            self.counters["recorded"] += 1
+        return web.Response(body=body, status=status, content_type="application/json")
+
+    def respond(self, response):
+        return web.json_response(dict(SUCCESS_RESPONSE, Response=response))
+
+    async def handle(self, request: web.Request):
+        return self.respond({})
+
+    async def handle_profile(self, request: web.Request):
+        info = request.match_info
+        return self.respond(self.samples.profile(info["membershipId"], info["membershipType"]))
+
+    async def handle_activity_history(self, request: web.Request):
+        page = int(request.query.get("page", 0))
+        count = int(request.query.get("count", 25))
+        return self.respond(self.samples.activity_history(request.match_info["characterId"], page, count))
+
+    async def handle_stats(self, request: web.Request):
+        return self.respond(self.samples.stats)
+
+    async def handle_carnage_report(self, request: web.Request):
+        return self.respond(self.samples.carnage_report(request.match_info["instanceId"]))
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+
+def parse_args(parser: argparse.ArgumentParser = None):
+    """
+    Simulation arguments, shared with the benchmarks, see server_kwargs.
+    """
+    parser = parser if parser is not None else argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0, help="median seconds before a response")
+    parser.add_argument("--latency-sigma", type=float, default=0, help="log-normal sigma of the latency")
+    parser.add_argument("--error-rate", type=float, default=0, help="probability of a 502 or 504 error")
+    parser.add_argument("--throttle-rate", type=float, default=None, help="requests/s allowed by api key")
+    parser.add_argument("--fixtures", default=None, help="folder of the recorded responses")
+    parser.add_argument("--upstream", default=None, help="api endpoint to record the responses from")
+    parser.add_argument("--history-size", type=int, default=100, help="matches in the history of a character")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser
+
+
+def server_kwargs(args) -> dict:
+    return {
+        "samples": SampleResponses(history_size=args.history_size),
+        "latency": args.latency,
+        "latency_sigma": args.latency_sigma,
+        "error_rate": args.error_rate,
+        "throttle_rate": args.throttle_rate,
+        "fixtures": args.fixtures,
+        "upstream": args.upstream,
+        "seed": args.seed
+    }
+
+
+async def main():
+    parser = parse_args()
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    async with FakeBungieServer(port=args.port, **server_kwargs(args)) as server:
+        print(f"Fake Bungie API listening on {server.endpoint}")
+        await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
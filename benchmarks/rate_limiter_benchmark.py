@@ -0,0 +1,50 @@
+"""
+Sustained throughput of BungieAPI against the local fake server, compared to the configured rate. The rate is not
+increased above RATE during the benchmark (the fake server never throttles, AIMD would raise it to MAX_RATE).
+
+    python -m benchmarks.rate_limiter_benchmark
+"""
+import asyncio
+import itertools
+import time
+
+import aiohttp
+
+from benchmarks.fake_bungie_server import FakeBungieServer
+from local_api import BungieAPI
+
+N_WORKERS = 200  # concurrent coroutines waiting for a token
+DURATION = 30  # seconds
+TOLERANCE = 0.01
+
+
+async def worker(api: BungieAPI, end_time: float, membership_ids):
+    while time.monotonic() < end_time:
+        # A new profile by call, the same one would be served from the recent responses of the api
+        await api.fetch_profile(next(membership_ids), 3)
+
+
+async def main():
+    BungieAPI.MAX_RATE = BungieAPI.RATE
+    async with FakeBungieServer() as server:
+        BungieAPI.ENDPOINT = server.endpoint
+        async with aiohttp.ClientSession() as session:
+            api = BungieAPI(session, api_key="fake")
+            end_time = time.monotonic() + DURATION
+            membership_ids = itertools.count(4611686018476641937)
+            await asyncio.gather(*[worker(api, end_time, membership_ids) for _ in range(N_WORKERS)])
+
+        times = server.request_times
+
+    # The first MAX_TOKENS requests are the initial burst, the sustained rate is measured after it
+    sustained = times[BungieAPI.MAX_TOKENS:]
+    rate = (len(sustained) - 1) / (sustained[-1] - sustained[0])
+    error = abs(rate - BungieAPI.RATE) / BungieAPI.RATE
+    print(f"{len(times)} requests in {times[-1] - times[0]:.2f}s with {N_WORKERS} concurrent workers.")
+    print(f"Burst: {BungieAPI.MAX_TOKENS} requests in {times[BungieAPI.MAX_TOKENS - 1] - times[0]:.3f}s.")
+    print(f"Sustained throughput: {rate:.3f} req/s for a configured rate of {BungieAPI.RATE} req/s "
+          f"({error:.2%} error, {'OK' if error <= TOLERANCE else 'FAIL'}).")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+"""
+Throughput of the sharded crawl against the local fake server for 1, 2, 4... api keys, compared to a linear scaling
+of the single key throughput. The scaling is measured on the unique guardians and activities in main.db after the
+merge: the requests of the matches fetched by several shards (see shards.py) do not count.
+
+    python -m benchmarks.sharded_crawl_benchmark
+"""
+import asyncio
+import tempfile
+
+from benchmarks.common import create_dbs, make_seeds
+from benchmarks.fake_bungie_server import FakeBungieServer, SampleResponses
+from db import MainDBHelper
+from shards import run_sharded_crawl
+
+N_KEYS = [1, 2, 4, 8]
+DURATION = 30  # seconds of crawl for each number of keys
+N_SEEDS = 64  # sources in main.db before the crawl, spread over every shard
+HISTORY_SIZE = 25
+
+
+async def crawl(samples: SampleResponses, n_keys: int):
+    folder = tempfile.mkdtemp()
+    create_dbs(folder, make_seeds(samples, N_SEEDS))
+
+    async with FakeBungieServer(samples=samples) as server:
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: run_sharded_crawl([f"fake-key-{i}" for i in range(n_keys)],
+                                            folder=folder,
+                                            round_duration=DURATION,
+                                            endpoint=server.endpoint))
+        times = server.request_times
+
+    db_helper = MainDBHelper("main.db", folder)
+    n_rows = db_helper.execute("SELECT (SELECT COUNT(*) FROM guardian) + (SELECT COUNT(*) FROM activity)", [])[0][0]
+    db_helper.close()
+    n_rows -= N_SEEDS
+
+    # Requests are measured from the first one received, workers spend a few seconds starting
+    request_rate = (len(times) - 1) / (times[-1] - times[0])
+    return request_rate, n_rows / DURATION, len(times) / max(n_rows, 1)
+
+
+async def main():
+    samples = SampleResponses(history_size=HISTORY_SIZE)
+    results = {}
+    for n_keys in N_KEYS:
+        results[n_keys] = await crawl(samples, n_keys)
+        request_rate, row_rate, requests_per_row = results[n_keys]
+        efficiency = row_rate / (n_keys * results[N_KEYS[0]][1] / N_KEYS[0])
+        print(f"{n_keys} keys: {request_rate:.1f} req/s, {row_rate:.1f} unique rows/s, "
+              f"{requests_per_row:.2f} requests by unique row, {efficiency:.0%} of a linear scaling.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,481 @@
+"""
+Benchmarks of the hot path of the crawler against the local fake server, written to a json file to be compared across
+commits. The api calls are measured with the rate limit lifted, so the client and the concurrency strategies are
+measured instead of the rate limit (see the end-to-end benchmark for the crawler under a rate).
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --only parsing db_inserts --compare results.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import aiohttp
+
+from benchmarks import crawler_benchmark
+from benchmarks.common import create_dbs
+from benchmarks.fake_bungie_server import FakeBungieServer, SampleResponses, read_sample, SUCCESS_RESPONSE
+import api_decoder
+import dataset
+import features
+from crawler import CrawlPipeline, extract_guardians_from_carnage_report
+from db import MainDBHelper, DBWriter, DBReader
+from local_api import BungieAPI
+from models.activity import Activity
+from models.carnage_report import parse_carnage_report
+from models.guardian import Guardian
+
+UNLIMITED_RATE = 1e6
+
+
+@contextlib.asynccontextmanager
+async def fake_api(latency: float, history_size=100):
+    """
+    BungieAPI without rate limit nor cache, connected to a fake server.
+    """
+    rate, max_rate, max_tokens, endpoint = BungieAPI.RATE, BungieAPI.MAX_RATE, BungieAPI.MAX_TOKENS, BungieAPI.ENDPOINT
+    BungieAPI.RATE = BungieAPI.MAX_RATE = BungieAPI.MAX_TOKENS = UNLIMITED_RATE
+    try:
+        async with FakeBungieServer(samples=SampleResponses(history_size=history_size), latency=latency) as server:
+            BungieAPI.ENDPOINT = server.endpoint
+            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+                yield BungieAPI(session, api_key="fake-key")
+    finally:
+        BungieAPI.RATE, BungieAPI.MAX_RATE, BungieAPI.MAX_TOKENS, BungieAPI.ENDPOINT = rate, max_rate, max_tokens, endpoint
+
+
+async def bench_history(args) -> dict:
+    """
+    Full history of several characters: one page after the other, characters concurrently, and characters
+    concurrently with the next pages prefetched.
+    """
+    samples = SampleResponses()
+    membership_id = samples.membership_id(0)
+    strategies = {
+        "sequential": (False, 0),
+        "concurrent": (True, 0),
+        "pipelined": (True, BungieAPI.HISTORY_PREFETCH_PAGES),
+    }
+    results = {}
+    async with fake_api(args.latency, history_size=args.history_size) as api:
+        for i, (name, (concurrent, prefetch)) in enumerate(strategies.items()):
+            # Other characters for each strategy, nothing is served from memory
+            character_ids = [samples.character_id(membership_id, i * args.characters + k)
+                             for k in range(args.characters)]
+
+            async def crawl(character_id):
+                return [activity async for activity in api.iter_activity_history(membership_id, 3, character_id,
+                                                                                  gamemode=5, prefetch=prefetch)]
+
+            start_time = time.perf_counter()
+            if concurrent:
+                histories = await asyncio.gather(*[crawl(character_id) for character_id in character_ids])
+            else:
+                histories = [await crawl(character_id) for character_id in character_ids]
+            elapsed = time.perf_counter() - start_time
+            results[f"{name}_activities_per_second"] = sum(len(history) for history in histories) / elapsed
+    return results
+
+
+async def bench_carnage_fanout(args) -> dict:
+    """
+    Carnage reports of a history: awaited one by one, all gathered at once, and through a pool of workers like
+    CrawlPipeline.
+    """
+    results = {}
+    async with fake_api(args.latency) as api:
+        for i, name in enumerate(("sequential", "concurrent", "pipelined")):
+            instance_ids = [SampleResponses.FIRST_INSTANCE_ID + i * args.reports + k for k in range(args.reports)]
+
+            start_time = time.perf_counter()
+            if name == "sequential":
+                for instance_id in instance_ids:
+                    await api.fetch_carnage_report(instance_id)
+            elif name == "concurrent":
+                await asyncio.gather(*[api.fetch_carnage_report(instance_id) for instance_id in instance_ids])
+            else:
+                queue = asyncio.Queue()
+                for instance_id in instance_ids:
+                    queue.put_nowait(instance_id)
+
+                async def worker():
+                    while not queue.empty():
+                        await api.fetch_carnage_report(queue.get_nowait())
+
+                await asyncio.gather(*[worker() for _ in range(CrawlPipeline.CARNAGE_WORKERS)])
+            results[f"{name}_reports_per_second"] = len(instance_ids) / (time.perf_counter() - start_time)
+    return results
+
+
+async def bench_parsing(args) -> dict:
+    """
+    Models built from the sample responses.
+    """
+    carnage_report = read_sample("carnage_report.json")["Response"]
+    stats = read_sample("player_pvp_stats.json")["Response"]
+
+    def rate(function):
+        start_time = time.perf_counter()
+        for _ in range(args.iterations):
+            function()
+        return args.iterations / (time.perf_counter() - start_time)
+
+    def parse_match():
+        # The activity and the guardians of a report, like the carnage worker
+        report = parse_carnage_report(carnage_report)
+        Activity().set_carnage_report(report)
+
+    return {
+        "set_carnage_report_per_second": rate(lambda: Activity().set_carnage_report(carnage_report)),
+        "extract_guardians_per_second": rate(lambda: extract_guardians_from_carnage_report(carnage_report)),
+        "parse_match_per_second": rate(parse_match),
+        "set_pvp_stats_per_second": rate(lambda: Guardian().set_pvp_stats(stats)),
+    }
+
+
+async def bench_memory(args) -> dict:
+    """
+    Memory of the models measured with tracemalloc: bytes and blocks by match in flight (its Activity and the Guardians
+    of its players, once the response is dropped), and peak of the carnage worker by report when every player is
+    already known.
+    """
+    response = json.dumps(read_sample("carnage_report.json"))
+
+    def parse_match(carnage_report: dict, skip=None):
+        activity = Activity(instance_id=carnage_report["activityDetails"]["instanceId"])
+        activity.set_carnage_report(carnage_report)
+        return activity, extract_guardians_from_carnage_report(carnage_report, skip)
+
+    def count_blocks() -> int:
+        return sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+
+    tracemalloc.start()
+    try:
+        # A new response by match like the crawler, only what the models keep of it stays in memory
+        start_size = tracemalloc.get_traced_memory()[0]
+        start_blocks = count_blocks()
+        matches = [parse_match(json.loads(response)["Response"]) for _ in range(args.iterations)]
+        match_bytes = (tracemalloc.get_traced_memory()[0] - start_size) / len(matches)
+        match_blocks = (count_blocks() - start_blocks) / len(matches)
+        del matches
+
+        # Everything the worker allocates for a report is dropped after, the peak is its churn
+        report_peak_bytes = 0
+        for _ in range(args.iterations):
+            carnage_report = json.loads(response)["Response"]
+            start_size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            parse_match(carnage_report, skip=lambda character_id, is_private: True)
+            report_peak_bytes = max(report_peak_bytes, tracemalloc.get_traced_memory()[1] - start_size)
+            del carnage_report
+    finally:
+        tracemalloc.stop()
+
+    return {"match_bytes": match_bytes, "match_blocks": match_blocks, "report_peak_bytes": report_peak_bytes}
+
+
+async def bench_decoding(args) -> dict:
+    """
+    Json decoders of api_decoder on the sample responses: CPU time and tracemalloc peak by response. msgspec_full is
+    msgspec without the schemas of the endpoints.
+    """
+    decoders = {name: api_decoder.get_decoder(name) for name in api_decoder.AVAILABLE_DECODERS}
+    if "msgspec" in decoders:
+        decoders["msgspec_full"] = api_decoder.MsgspecDecoder(schemas={})
+
+    results = {}
+    for endpoint, sample in DECODING_SAMPLES.items():
+        response = read_sample(sample)
+        if "ErrorCode" not in response:
+            # Some samples are the Response only
+            response = dict(SUCCESS_RESPONSE, Response=response)
+        body = json.dumps(response).encode()
+        # About the same bytes decoded for every sample, a history page is 10 times a carnage report
+        iterations = max(10, min(args.iterations, 50 * 2 ** 20 // len(body)))
+
+        for name, decoder in decoders.items():
+            start_time = time.process_time()
+            for _ in range(iterations):
+                decoder.decode(body, endpoint)
+            results[f"{name}_{endpoint}_us"] = (time.process_time() - start_time) / iterations * 1e6
+
+            tracemalloc.start()
+            try:
+                start_size = tracemalloc.get_traced_memory()[0]
+                r = decoder.decode(body, endpoint)
+                results[f"{name}_{endpoint}_peak_bytes"] = tracemalloc.get_traced_memory()[1] - start_size
+                del r
+            finally:
+                tracemalloc.stop()
+    return results
+
+
+async def bench_db_inserts(args) -> dict:
+    """
+    Guardians and activities inserted one by one, with executemany, and through the DBWriter thread.
+    """
+    stats = read_sample("player_pvp_stats.json")["Response"]
+    carnage_report = read_sample("carnage_report.json")["Response"]
+
+    def make_rows(first_id: int):
+        guardians, activities = [], []
+        for k in range(first_id, first_id + args.rows):
+            guardian = Guardian(membership_id=k, membership_type=3, character_id=k)
+            guardian.set_pvp_stats(stats)
+            guardians.append(guardian)
+            activity = Activity(instance_id=str(k))
+            activity.set_carnage_report(carnage_report)
+            activities.append(activity)
+        return guardians, activities
+
+    folder = tempfile.mkdtemp()
+    create_dbs(folder, [])
+    results = {}
+    for i, name in enumerate(("row_by_row", "executemany", "writer")):
+        guardians, activities = make_rows(i * args.rows)
+
+        start_time = time.perf_counter()
+        if name == "writer":
+            writer = DBWriter(folder=folder)
+            task = asyncio.create_task(writer.run())
+            for row in guardians + activities:
+                await writer.put(row)
+            await writer.queue.join()
+            task.cancel()
+            await writer.close()
+        else:
+            db_helper = MainDBHelper("main.db", folder)
+            if name == "row_by_row":
+                for guardian in guardians:
+                    db_helper.insert_guardian(guardian)
+                for activity in activities:
+                    db_helper.insert_activity(activity)
+            else:
+                db_helper.insert_guardians(guardians)
+                db_helper.insert_activities(activities)
+            db_helper.commit()
+            db_helper.close()
+        results[f"{name}_rows_per_second"] = 2 * args.rows / (time.perf_counter() - start_time)
+    return results
+
+
+async def bench_db_reads(args) -> dict:
+    """
+    Guardians read by ids: one query at a time, 12 at a time (the players of an activity) as models and as a
+    structured array, with the batched queries of DBReader, and streamed.
+    """
+    folder = tempfile.mkdtemp()
+    create_dbs(folder, [Guardian(membership_id=k, membership_type=3, character_id=k) for k in range(args.rows)])
+    guardians = [Guardian(membership_id=k, membership_type=3, character_id=k) for k in range(0, args.rows, 2)]
+    character_ids = [guardian.character_id for guardian in guardians]
+    results = {}
+
+    db_helper = MainDBHelper("main.db", folder)
+    start_time = time.perf_counter()
+    for guardian in guardians:
+        db_helper.get_guardian_from_ids(guardian)
+    results["row_by_row_rows_per_second"] = len(guardians) / (time.perf_counter() - start_time)
+
+    for name, get in (("models", db_helper.get_guardians_by_ids), ("array", db_helper.get_guardians_array)):
+        start_time = time.perf_counter()
+        for i in range(0, len(character_ids), 12):
+            get(character_ids[i:i + 12])
+        results[f"activity_{name}_rows_per_second"] = len(guardians) / (time.perf_counter() - start_time)
+    db_helper.close()
+
+    reader = DBReader(folder=folder)
+    start_time = time.perf_counter()
+    for i in range(0, len(character_ids), 500):
+        await reader.get_guardians_by_ids(character_ids[i:i + 500])
+    results["batched_rows_per_second"] = len(guardians) / (time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    n_rows = 0
+    async for _ in reader.iter_guardians():
+        n_rows += 1
+    results["stream_rows_per_second"] = n_rows / (time.perf_counter() - start_time)
+    reader.close()
+    return results
+
+
+async def bench_dataset(args) -> dict:
+    """
+    Guardians appended to a parquet dataset with small and large buffers, then read without their duplicates.
+    """
+    stats = read_sample("player_pvp_stats.json")["Response"]
+    guardians = []
+    for k in range(args.rows):
+        guardian = Guardian(membership_id=k % (args.rows // 2), membership_type=3, character_id=k % (args.rows // 2))
+        guardian.set_pvp_stats(stats)
+        guardians.append(guardian)
+
+    results = {}
+    for max_buffer_length in (500, 10000):
+        guardian_dataset = dataset.get_guardian_dataset(tempfile.mkdtemp(), max_buffer_length=max_buffer_length)
+        start_time = time.perf_counter()
+        guardian_dataset.extend(guardians)
+        guardian_dataset.close()
+        results[f"append_buffer_{max_buffer_length}_rows_per_second"] = args.rows / (time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        guardian_dataset.read()
+        results[f"read_buffer_{max_buffer_length}_rows_per_second"] = args.rows / (time.perf_counter() - start_time)
+    return results
+
+
+async def bench_features(args) -> dict:
+    """
+    Training matrix of the activities (features.get_players_matrix), 12 players by activity among as many guardians.
+    """
+    carnage_report = read_sample("carnage_report.json")["Response"]
+    folder = tempfile.mkdtemp()
+    create_dbs(folder, [Guardian(membership_id=k, membership_type=3, character_id=k) for k in range(args.rows)])
+    activities = []
+    for k in range(args.rows):
+        activity = Activity(instance_id=k)
+        activity.set_carnage_report(carnage_report)
+        activity.players = [player._replace(character_id=(k * len(activity.players) + i) % args.rows)
+                            for i, player in enumerate(activity.players)]
+        activities.append(activity)
+    db_helper = MainDBHelper("main.db", folder)
+    db_helper.insert_activities(activities)
+    db_helper.commit()
+
+    start_time = time.perf_counter()
+    features.get_players_matrix(db_helper, range(args.rows))
+    elapsed = time.perf_counter() - start_time
+    db_helper.close()
+    return {"activities_per_second": args.rows / elapsed}
+
+
+async def bench_end_to_end(args) -> dict:
+    """
+    The crawler under a rate limit, see crawler_benchmark.
+    """
+    results = await crawler_benchmark.run(crawler_benchmark.parse_benchmark_args([
+        "--duration", str(args.duration),
+        "--latency", str(args.latency),
+        "--rate", str(args.rate),
+        "--history-size", str(args.history_size)]))
+    return {key: results[key] for key in ("requests_per_second", "rows_per_second", "latency_p50", "latency_p99")
+            if key in results}
+
+
+BENCHMARKS = {
+    "history": bench_history,
+    "carnage_fanout": bench_carnage_fanout,
+    "parsing": bench_parsing,
+    "memory": bench_memory,
+    "decoding": bench_decoding,
+    "db_inserts": bench_db_inserts,
+    "db_reads": bench_db_reads,
+    "dataset": bench_dataset,
+    "features": bench_features,
+    "end_to_end": bench_end_to_end,
+}
+
+# endpoint: sample of its responses, decoded by the decoding benchmark
+DECODING_SAMPLES = {
+    "carnage_report": "carnage_report.json",
+    "activity_history": "activities_page_1.json",
+    "stats": "player_pvp_stats.json",
+    "profile": "player_profile.json",
+}
+
+# Lower is better for the metrics ending like these ones, higher for the others
+LOWER_IS_BETTER = ("latency_p50", "latency_p99", "_bytes", "_blocks", "_us")
+
+
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def compare(results: dict, previous: dict, threshold: float) -> list[str]:
+    """
+    :return: the regressions, metrics worse than the previous ones by more than threshold
+    """
+    regressions = []
+    for name, metrics in results["results"].items():
+        for metric, value in metrics.items():
+            old_value = previous["results"].get(name, {}).get(metric)
+            if not old_value or not value:
+                continue
+            ratio = value / old_value if not metric.endswith(LOWER_IS_BETTER) else old_value / value
+            line = f"{name}.{metric}: {old_value:.2f} -> {value:.2f} ({ratio - 1:+.1%})"
+            print(line)
+            if ratio < 1 - threshold:
+                regressions.append(line)
+    return regressions
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--output", default="benchmark_results.json", help="json file of the results")
+    parser.add_argument("--compare", default=None, help="json file of previous results")
+    parser.add_argument("--threshold", type=float, default=0.1, help="relative loss reported as a regression")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds of the fake server before a response")
+    parser.add_argument("--history-size", type=int, default=1000, help="matches in the history of a character")
+    parser.add_argument("--characters", type=int, default=8, help="histories crawled by the history benchmark")
+    parser.add_argument("--reports", type=int, default=200, help="carnage reports of the fan-out benchmark")
+    parser.add_argument("--iterations", type=int, default=2000, help="models built by the parsing benchmark")
+    parser.add_argument("--rows", type=int, default=10000, help="guardians and activities inserted, guardians read")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of the end-to-end crawl")
+    parser.add_argument("--rate", type=float, default=BungieAPI.RATE, help="requests/s of the end-to-end crawl")
+    return parser.parse_args(args)
+
+
+async def run(args) -> dict:
+    results = {
+        "commit": get_commit(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "only")},
+        "results": {}
+    }
+    for name in args.only:
+        start_time = time.monotonic()
+        results["results"][name] = await BENCHMARKS[name](args)
+        print(f"{name} ({time.monotonic() - start_time:.1f}s): "
+              + ", ".join(f"{metric}={value:.2f}" for metric, value in results["results"][name].items()))
+    return results
+
+
+def main():
+    args = parse_args()
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    results = asyncio.run(run(args))
+
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=2)
+    print(f"Results written in {args.output}.")
+
+    if args.compare is not None:
+        with open(args.compare) as fp:
+            previous = json.load(fp)
+        print(f"Compared to {args.compare} (commit {previous.get('commit')}):")
+        regressions = compare(results, previous, args.threshold)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} regressions above {args.threshold:.0%}:")
+            for regression in regressions:
+                print(f"    {regression}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
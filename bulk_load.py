@@ -0,0 +1,167 @@
+"""
+Bulk copies between parquet files and the tables of the dbs, without the models: the row groups of the parquet files
+are streamed in the table with executemany, in a single transaction during which the indexes of the table are dropped
+and built again at the end. The reverse direction exports a table in a parquet file, a row group by batch of rows.
+
+The load is meant for a db no crawler is writing to: the indexes are missing until the end of the transaction.
+"""
+import logging
+import os
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from dataset import GUARDIAN_SCHEMA, ACTIVITY_SCHEMA, FILE_EXTENSION, TMP_EXTENSION, to_array
+from db import DBHelper, MainDBHelper, insert_request
+
+BATCH_SIZE = 100000
+# Types of the exported columns, the other tables get the types of their declared sqlite types
+SCHEMAS = {"guardian": GUARDIAN_SCHEMA, "activity": ACTIVITY_SCHEMA}
+SQLITE_TYPES = {"INTEGER": pa.int64(), "REAL": pa.float64(), "TEXT": pa.string(), "BLOB": pa.binary()}
+
+
+def get_columns(db_helper: DBHelper, table: str) -> list[str]:
+    return [row[1] for row in db_helper.connexion.execute(f"PRAGMA table_info({table})")]
+
+
+def get_schema(db_helper: DBHelper, table: str) -> pa.Schema:
+    """
+    :return: columns of the table, string for the columns without a declared type
+    """
+    return pa.schema([(row[1], SQLITE_TYPES.get(row[2].upper(), pa.string()))
+                      for row in db_helper.connexion.execute(f"PRAGMA table_info({table})")])
+
+
+def get_indexes(db_helper: DBHelper, tables: list[str]) -> list[tuple[str, str]]:
+    """
+    :return: (name, sql) of the indexes of the tables which can be dropped, not the ones of their unique keys (needed
+    to skip the duplicates and without sql)
+    """
+    return [(row[0], row[1]) for row in db_helper.connexion.execute(
+        f"SELECT name, sql FROM sqlite_master WHERE type='index' AND sql IS NOT NULL "
+        f"AND tbl_name IN ({', '.join('?' * len(tables))})", tables)]
+
+
+def import_parquet(db_helper: DBHelper, table: str, paths: list[str], batch_size=BATCH_SIZE,
+                   drop_indexes=True) -> int:
+    """
+    Insert the rows of parquet files in a table, the columns of the files not in the table are ignored (the pandas
+    index for instance) and the values converted by sqlite to the types of the table. The rows already in the table
+    are skipped. The players of the activities are inserted in activity_player as well.
+    :param db_helper:
+    :param table:
+    :param paths: parquet files
+    :param batch_size: rows read at once
+    :param drop_indexes: drop the indexes during the load, they are built again faster at the end than kept up to date
+    row by row
+    :return: number of rows read
+    """
+    columns = get_columns(db_helper, table)
+    with_players = table == "activity" and isinstance(db_helper, MainDBHelper)
+    tables = [table, "activity_player"] if with_players else [table]
+    indexes = get_indexes(db_helper, tables) if drop_indexes else []
+
+    n_rows = 0
+    total_changes = db_helper.connexion.total_changes
+    start_time = time.monotonic()
+    db_helper.connexion.execute("BEGIN")
+    try:
+        for name, _ in indexes:
+            db_helper.connexion.execute(f"DROP INDEX {name}")
+
+        for path in paths:
+            parquet_file = pq.ParquetFile(path)
+            file_columns = [column for column in columns if column in parquet_file.schema_arrow.names]
+            if len(file_columns) < len(columns):
+                logging.warning(f"Columns {sorted(set(columns) - set(file_columns))} of {table} not in {path}.")
+            request = insert_request(table, tuple(file_columns))
+            players = with_players and "players" in file_columns
+
+            file_start_time = time.monotonic()
+            n_file_rows = 0
+            for batch in parquet_file.iter_batches(batch_size=batch_size, columns=file_columns):
+                values = [batch.column(column).to_pylist() for column in file_columns]
+                db_helper.connexion.executemany(request, zip(*values))
+                if players:
+                    db_helper.insert_stored_players(values[file_columns.index("instance_id")])
+                n_file_rows += batch.num_rows
+            n_rows += n_file_rows
+            logging.info(f"{n_file_rows} rows of {path} loaded in {table}: "
+                         f"{n_file_rows / max(time.monotonic() - file_start_time, 1e-9):.0f} rows/s.")
+
+        index_start_time = time.monotonic()
+        for _, sql in indexes:
+            db_helper.connexion.execute(sql)
+        if len(indexes) > 0:
+            logging.info(f"{len(indexes)} indexes of {table} built in {time.monotonic() - index_start_time:.1f}s.")
+        db_helper.commit()
+    except BaseException:
+        # The dropped indexes are back with the rollback
+        db_helper.connexion.rollback()
+        raise
+
+    elapsed = time.monotonic() - start_time
+    logging.info(f"{n_rows} rows loaded in {table} in {elapsed:.1f}s ({n_rows / max(elapsed, 1e-9):.0f} rows/s), "
+                 f"{db_helper.connexion.total_changes - total_changes} rows inserted.")
+    return n_rows
+
+
+def export_parquet(db_helper: DBHelper, table: str, path: str, batch_size=BATCH_SIZE, schema: pa.Schema = None,
+                   compression="zstd") -> int:
+    """
+    Write the rows of a table in a parquet file, in the order of the table. The file is written under a temporary name
+    until it is complete.
+    :param db_helper:
+    :param table:
+    :param path: parquet file, replaced if it exists
+    :param batch_size: rows by row group
+    :param schema: columns and types of the file, default the one of the dataset for the guardians and the activities,
+    every column of the table with its declared type otherwise
+    :param compression: parquet codec
+    :return: number of rows written
+    """
+    if schema is None:
+        schema = SCHEMAS[table] if table in SCHEMAS else get_schema(db_helper, table)
+
+    cursor = db_helper.connexion.cursor()
+    cursor.row_factory = None  # tuples, transposed in columns
+    cursor.execute(f"SELECT {', '.join(schema.names)} FROM {table}")
+
+    n_rows = 0
+    start_time = time.monotonic()
+    writer = None
+    try:
+        while len(rows := cursor.fetchmany(batch_size)) > 0:
+            batch = pa.RecordBatch.from_arrays([to_array(column, field.type)
+                                                for column, field in zip(zip(*rows), schema)], schema=schema)
+            if writer is None:
+                writer = pq.ParquetWriter(path + TMP_EXTENSION, schema, compression=compression)
+            writer.write_batch(batch)
+            n_rows += len(rows)
+
+        if writer is None:
+            # Empty table, the file has the columns only
+            pq.write_table(schema.empty_table(), path + TMP_EXTENSION, compression=compression)
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(path + TMP_EXTENSION, path)
+
+    elapsed = time.monotonic() - start_time
+    logging.info(f"{n_rows} rows of {table} exported in {path} in {elapsed:.1f}s "
+                 f"({n_rows / max(elapsed, 1e-9):.0f} rows/s).")
+    return n_rows
+
+
+def export_tables(db_helper: DBHelper, folder: str, tables=("guardian", "activity"), **kwargs) -> dict:
+    """
+    :param db_helper:
+    :param folder: the table is exported in folder/table.parquet
+    :param tables:
+    :param kwargs: see export_parquet
+    :return: {table: number of rows}
+    """
+    os.makedirs(folder, exist_ok=True)
+    return {table: export_parquet(db_helper, table, os.path.join(folder, table + FILE_EXTENSION), **kwargs)
+            for table in tables}
@@ -0,0 +1,349 @@
+import asyncio
+import logging
+
+from models.activity import Activity
+from models.carnage_report import parse_carnage_report
+from models.guardian import Guardian, to_id
+
+
+def extract_guardians_from_carnage_report(carnage_report, skip=None) -> list[Guardian]:
+    """
+    :param carnage_report:
+    :param skip: see parse_carnage_report
+    :return: guardians of the players of the report
+    """
+    return parse_carnage_report(carnage_report, skip).guardians
+
+
+class SourceProgress:
+    """
+    Number of work items (activities and guardians) of a source still travelling through the pipeline.
+    The source is done when its history has been fully queued and nothing is pending anymore.
+    """
+    def __init__(self, source: Guardian):
+        self.source = source
+        self.pending = 0
+        self.history_done = False
+        self.n_activities = 0
+
+    @property
+    def done(self):
+        return self.history_done and self.pending == 0
+
+
+class CrawlPipeline:
+    """
+    Staged crawl of the sources: history -> carnage reports -> guardian stats -> db writer.
+    Stages are connected by bounded queues so a heavy source cannot flood the memory with pending coroutines, and
+    each stage has a fixed pool of workers, large enough to keep the api rate limit saturated.
+    Every work item is recorded in the writer journal, a run starts by resuming what the previous one left unfinished.
+    """
+
+    HISTORY_WORKERS = 2
+    CARNAGE_WORKERS = 8
+    STATS_WORKERS = 24
+    QUEUE_SIZE = 256
+
+    RUMBLE_MODE = 48
+
+    def __init__(self,
+                 api,
+                 index,
+                 writer,
+                 gamemodes=(5,),
+                 from_date="",
+                 to_date="",
+                 history_workers=HISTORY_WORKERS,
+                 carnage_workers=CARNAGE_WORKERS,
+                 stats_workers=STATS_WORKERS,
+                 queue_size=QUEUE_SIZE):
+        """
+
+        :param api: BungieAPI, shared by every worker (and so is its rate limiter)
+        :param index: ExistenceIndex of the main and source dbs, updated as rows are queued for writing
+        :param writer: DBWriter of the main and source dbs, run and closed by the pipeline
+        :param gamemodes: modes of the activity history crawled for each character
+        :param from_date: see BungieAPI.fetch_activity_history
+        :param to_date: see BungieAPI.fetch_activity_history
+        :param history_workers: number of sources crawled at the same time
+        :param carnage_workers: number of concurrent carnage report fetches
+        :param stats_workers: number of concurrent guardian stats fetches
+        :param queue_size: max number of items waiting between two stages
+        """
+        self.api = api
+        self.index = index
+        self.writer = writer
+        self.gamemodes = gamemodes
+        self.from_date = from_date
+        self.to_date = to_date
+        self.history_workers = history_workers
+        self.carnage_workers = carnage_workers
+        self.stats_workers = stats_workers
+
+        self.source_queue = asyncio.Queue(history_workers)
+        self.activity_queue = asyncio.Queue(queue_size)
+        self.guardian_queue = asyncio.Queue(queue_size)
+
+        self.sources_in_flight = set()
+        self.activities_in_flight = set()  # instance ids
+        self.guardians_in_flight = set()  # character ids
+
+    async def run(self, sources):
+        """
+        Crawl every source and return when all of them are written in db.
+        :param sources: iterable of Guardian, consumed lazily as the history workers get free
+        :return:
+        """
+        workers = [asyncio.create_task(self._history_worker()) for _ in range(self.history_workers)]
+        workers += [asyncio.create_task(self._carnage_worker()) for _ in range(self.carnage_workers)]
+        workers += [asyncio.create_task(self._stats_worker()) for _ in range(self.stats_workers)]
+        writer = asyncio.create_task(self.writer.run())
+        workers.append(writer)
+
+        try:
+            await self._resume()
+
+            for source in sources:
+                await self.source_queue.put(source)
+
+            # Each stage feeds the next one before marking its item done, so joining in order drains everything
+            for queue in (self.source_queue, self.activity_queue, self.guardian_queue, self.writer.queue):
+                await self._join(queue, writer)
+        finally:
+            await self._cancel(workers)
+            await self.writer.close()
+
+    @staticmethod
+    async def _join(queue: asyncio.Queue, writer: asyncio.Task):
+        """
+        queue.join(), unless the writer stops before: the error of the writer is raised, the rows would never be written.
+        """
+        join = asyncio.ensure_future(queue.join())
+        try:
+            await asyncio.wait([join, writer], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not join.done():
+                join.cancel()
+        if writer.done():
+            writer.result()
+            raise RuntimeError("DBWriter stopped")
+
+    @staticmethod
+    async def _cancel(tasks: list):
+        # Before python 3.12, asyncio.wait_for loses the cancellation if the awaited call finishes at the same time,
+        # the task goes on with its loop and must be cancelled again
+        while len(tasks) > 0:
+            for task in tasks:
+                task.cancel()
+            done, tasks = await asyncio.wait(tasks, timeout=1)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    logging.error(f"Pipeline worker failed. Error : {task.exception()}")
+
+    async def _resume(self):
+        """
+        Queue the work left in the journal by the previous run: guardians without their stats, activities without
+        their carnage report and histories not fully crawled.
+        """
+        journal = await self.writer.load_journal()
+        if len(journal) == 0:
+            return
+
+        n_activities = n_guardians = 0
+        for source, history_done, instance_ids, guardians in journal:
+            self.sources_in_flight.add(source.membership_id)
+            progress = SourceProgress(source)
+
+            for guardian in guardians:
+                self.guardians_in_flight.add(guardian.character_id)
+                progress.pending += 1
+                await self.guardian_queue.put((progress, guardian))
+
+            for instance_id in instance_ids:
+                self.activities_in_flight.add(instance_id)
+                progress.pending += 1
+                progress.n_activities += 1
+                await self.activity_queue.put((progress, Activity(instance_id=instance_id)))
+
+            n_activities += len(instance_ids)
+            n_guardians += len(guardians)
+            if history_done:
+                progress.history_done = True
+                if progress.done:
+                    await self._source_done(progress)
+            else:
+                await self.source_queue.put(progress)
+
+        logging.info(f"Resuming {len(journal)} sources with {n_activities} activities "
+                     f"and {n_guardians} guardians left by the previous run.")
+
+    async def _history_worker(self):
+        while True:
+            item = await self.source_queue.get()
+            try:
+                if isinstance(item, SourceProgress):
+                    await self._fetch_history(item)
+                else:
+                    await self._fetch_source_activities(item)
+            except Exception as err:
+                logging.error(f"Unexpected error while crawling history of {item}. Error : {err}")
+            finally:
+                self.source_queue.task_done()
+
+    async def _carnage_worker(self):
+        while True:
+            progress, activity = await self.activity_queue.get()
+            try:
+                await self._fetch_activity_details(progress, activity)
+            except Exception as err:
+                logging.error(f"Unexpected error while processing {activity}. Error : {err}")
+            finally:
+                self.activities_in_flight.discard(activity.instance_id)
+                await self._item_done(progress)
+                self.activity_queue.task_done()
+
+    async def _stats_worker(self):
+        while True:
+            progress, guardian = await self.guardian_queue.get()
+            try:
+                await self._fetch_guardian_stats(guardian)
+            except Exception as err:
+                logging.error(f"Unexpected error while processing {guardian}. Error : {err}")
+            finally:
+                self.guardians_in_flight.discard(guardian.character_id)
+                await self._item_done(progress)
+                self.guardian_queue.task_done()
+
+    async def _item_done(self, progress: SourceProgress):
+        progress.pending -= 1
+        if progress.done:
+            await self._source_done(progress)
+
+    async def _source_done(self, progress: SourceProgress):
+        # The writer marks the source as used after every row of the source queued before
+        def on_written():
+            self.index.add_source(progress.source.membership_id)
+            self.sources_in_flight.discard(progress.source.membership_id)
+            logging.info(f"Source ({progress.source}) done with {progress.n_activities} activities. "
+                         f"API metrics: {self.api.metrics}. DB writer metrics: {self.writer.metrics}. "
+                         f"Index metrics: {self.index.metrics}")
+
+        await self.writer.put_source(progress.source.membership_id, on_written)
+
+    async def _fetch_source_activities(self, source: Guardian):
+        if source.membership_id in self.sources_in_flight \
+                or self.index.is_source_already_used(source.membership_id):
+            logging.info(f"Source ({source}) is already in source db. Skipping.")
+            return
+
+        self.sources_in_flight.add(source.membership_id)
+        await self.writer.journal_source(source)
+        await self._fetch_history(SourceProgress(source))
+
+    async def _fetch_history(self, progress: SourceProgress):
+        source = progress.source
+        character_ids = await self._fetch_character_ids(source)
+        logging.info(f"Fetching activity history of {source} ({len(character_ids)} characters).")
+
+        # Every character and mode is crawled concurrently, a match seen in several histories is fetched once
+        seen_instance_ids = set()
+        histories = [self._fetch_character_activities(progress, character_id, gamemode, seen_instance_ids)
+                     for character_id in character_ids
+                     for gamemode in self.gamemodes]
+        await asyncio.gather(*histories)
+
+        await self.writer.journal_history_done(source.membership_id)
+        # No await from here to the check, or the last _item_done could see the source done as well
+        progress.history_done = True
+        if progress.done:
+            await self._source_done(progress)
+
+    async def _fetch_character_ids(self, source: Guardian) -> list[str]:
+        try:
+            return await self.api.fetch_character_ids(source.membership_id, source.membership_type)
+        except Exception as err:
+            logging.warning(f"Cannot fetch characters of Guardian ({source}), only its own character is crawled. "
+                            f"Error : {err}")
+            return [source.character_id] if source.character_id else []
+
+    async def _fetch_character_activities(self, progress: SourceProgress, character_id, gamemode, seen_instance_ids: set):
+        source = progress.source
+        try:
+            # Carnage reports are fetched while the next pages of the history are downloaded
+            async for activity_json in self.api.iter_activity_history(source.membership_id,
+                                                                      source.membership_type,
+                                                                      character_id,
+                                                                      gamemode=gamemode,
+                                                                      from_date=self.from_date,
+                                                                      to_date=self.to_date):
+                instance_id = to_id(activity_json["activityDetails"]["instanceId"])
+                if instance_id in seen_instance_ids:
+                    continue
+                seen_instance_ids.add(instance_id)
+
+                # Already crawled, or queued by another source
+                activity = Activity(instance_id=instance_id)
+                if instance_id in self.activities_in_flight or self.index.is_activity_in_db(activity):
+                    continue
+                self.activities_in_flight.add(instance_id)
+
+                progress.pending += 1
+                progress.n_activities += 1
+                await self.writer.journal_activity(source.membership_id, instance_id)
+                await self.activity_queue.put((progress, activity))
+        except Exception as err:
+            logging.warning(f"Cannot fetch history of Guardian ({source}) "
+                            f"for character {character_id} and mode {gamemode}. Error : {err}")
+
+    async def _fetch_activity_details(self, progress: SourceProgress, activity: Activity):
+        if self.index.is_activity_in_db(activity):
+            await self.writer.journal_activity_done(activity.instance_id)
+            return
+
+        try:
+            carnage_report = await self.api.fetch_carnage_report(activity.instance_id)
+            if carnage_report["activityDetails"]["mode"] == CrawlPipeline.RUMBLE_MODE:
+                await self.writer.journal_activity_done(activity.instance_id)
+                return
+            # A single pass for the activity and its guardians, the players already known are skipped before a
+            # Guardian is built for them, most of them are
+            report = parse_carnage_report(carnage_report, self._skip_guardian)
+            activity.set_carnage_report(report)
+            guardians = report.guardians
+        except Exception as err:
+            logging.warning(f"Error fetching Activity (instanceId={activity.instance_id}). Error : {err}.")
+            await self.writer.journal_activity_done(activity.instance_id)
+            return
+
+        # The guardians are journaled before the activity is removed from the journal
+        for guardian in guardians:
+            self.guardians_in_flight.add(guardian.character_id)
+            progress.pending += 1
+            await self.writer.journal_guardian(progress.source.membership_id, guardian)
+            await self.guardian_queue.put((progress, guardian))
+
+        self.index.add_activity(activity)
+        await self.writer.put(activity)
+
+    def _skip_guardian(self, character_id: int, is_private: bool) -> bool:
+        return is_private or character_id in self.guardians_in_flight or self.index.is_character_in_db(character_id)
+
+    async def _fetch_guardian_stats(self, guardian: Guardian):
+        if self.index.is_guardian_in_db(guardian):
+            await self.writer.journal_guardian_done(guardian.character_id)
+            return
+
+        try:
+            guardian.set_pvp_stats(
+                await self.api.fetch_stats(guardian.membership_id, guardian.membership_type, guardian.character_id))
+        except Exception as err:
+            logging.warning(f"Error fetching Guardian stats "
+                            f"(membership_id={guardian.membership_id}, "
+                            f"membership_type={guardian.membership_type}, "
+                            f"character_id={guardian.character_id}). "
+                            f"Error : {err}")
+            await self.writer.journal_guardian_done(guardian.character_id)
+            return
+
+        self.index.add_guardian(guardian)
+        await self.writer.put(guardian)
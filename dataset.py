@@ -0,0 +1,230 @@
+"""
+Append-only parquet datasets of the models, for the analytics: the rows are appended in immutable parquet files, one by
+flush and partition (the month of the activities for instance), and a file is never rewritten. An append costs the same
+whatever the size of the dataset. The duplicates are dropped when the dataset is read, or once for all by compact.
+
+    data/activities/month=2021-12/1639000000000-1234-0.parquet
+"""
+import os
+import time
+import logging
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Same columns and types as the tables of main.db
+GUARDIAN_SCHEMA = pa.schema([("membership_id", pa.int64()),
+                             ("membership_type", pa.int64()),
+                             ("character_id", pa.int64()),
+                             ("display_name", pa.string()),
+                             ("display_name_code", pa.string()),
+                             ("is_private", pa.bool_()),
+                             ("activities_entered", pa.int64()),
+                             ("activities_won", pa.int64()),
+                             ("assists", pa.int64()),
+                             ("kills", pa.int64()),
+                             ("seconds_played", pa.int64()),
+                             ("deaths", pa.int64()),
+                             ("average_lifespan", pa.float64()),
+                             ("score", pa.int64()),
+                             ("opponents_defeated", pa.int64()),
+                             ("precision_kills", pa.int64()),
+                             ("combat_rating", pa.float64())])
+GUARDIAN_ID = ["membership_id", "membership_type", "character_id"]
+ACTIVITY_SCHEMA = pa.schema([("instance_id", pa.int64()),
+                             ("period", pa.string()),
+                             ("mode", pa.int64()),
+                             ("is_private", pa.bool_()),
+                             ("win_score", pa.int64()),
+                             ("loss_score", pa.int64()),
+                             ("players", pa.string())])  # json, like in main.db
+ACTIVITY_ID = ["instance_id"]
+
+FILE_EXTENSION = ".parquet"
+TMP_EXTENSION = ".tmp"
+
+
+def to_array(values: list, type_: pa.DataType) -> pa.Array:
+    """
+    :param values: python values of a column
+    :param type_: type of the column in the schema
+    """
+    try:
+        return pa.array(values, type_)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # The booleans of sqlite are integers and the ids of the old rows strings, converted like sqlite does
+        return pa.array(values).cast(type_)
+
+
+class ParquetDataset:
+    def __init__(self,
+                 folder: str,
+                 schema: pa.Schema,
+                 id_subset: list[str],
+                 partition=None,
+                 max_buffer_length=10000,
+                 compression="zstd"):
+        """
+
+        :param folder: root of the dataset, created if needed
+        :param schema: columns of the rows, the attributes of the models (see Guardian.data and Activity.data)
+        :param id_subset: columns identifying a row, the last row appended for an id is kept
+        :param partition: (name, function) where function(row) is the partition of a row (a dict of the data of a
+        model), stored in the folder name/value like hive. None to write every row in folder
+        :param max_buffer_length: rows kept in memory before they are written
+        :param compression: parquet codec
+        """
+        self.folder = folder
+        self.schema = schema
+        self.id_subset = id_subset
+        self.partition = partition
+        self.max_buffer_length = max_buffer_length
+        self.compression = compression
+
+        self.buffer = {}  # partition value: {column: [values]}
+        self.n_buffered = 0
+        self.n_files = 0  # files written by this process, part of their name
+        os.makedirs(self.folder, exist_ok=True)
+
+    def append(self, element):
+        """
+        :param element: Guardian or Activity
+        """
+        row = element.data
+        value = self.partition[1](row) if self.partition is not None else None
+        columns = self.buffer.get(value)
+        if columns is None:
+            columns = self.buffer[value] = {name: [] for name in self.schema.names}
+        for name, values in columns.items():
+            values.append(row[name])
+
+        self.n_buffered += 1
+        if self.n_buffered >= self.max_buffer_length:
+            self.flush()
+
+    def extend(self, elements):
+        for element in elements:
+            self.append(element)
+
+    def flush(self):
+        """
+        Write the rows appended since the last flush, a new file by partition.
+        """
+        for value, columns in self.buffer.items():
+            self._write_file(self._partition_folder(value), self._record_batch(columns))
+        self.buffer = {}
+        self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+
+    def _record_batch(self, columns: dict) -> pa.RecordBatch:
+        return pa.RecordBatch.from_arrays([to_array(columns[field.name], field.type) for field in self.schema],
+                                          schema=self.schema)
+
+    def _partition_folder(self, value) -> str:
+        if self.partition is None:
+            return self.folder
+        return os.path.join(self.folder, f"{self.partition[0]}={value}")
+
+    def _write_file(self, folder: str, data):
+        """
+        Write a new file, under a temporary name until it is complete so a reader never sees a partial file.
+        """
+        os.makedirs(folder, exist_ok=True)
+        # Sorted by name in the order of the writes
+        name = f"{time.time_ns() // 1000000}-{os.getpid()}-{self.n_files}"
+        self.n_files += 1
+        path = os.path.join(folder, name + FILE_EXTENSION)
+        pq.write_table(pa.Table.from_batches([data]) if isinstance(data, pa.RecordBatch) else data,
+                       path + TMP_EXTENSION, compression=self.compression)
+        os.replace(path + TMP_EXTENSION, path)
+        return path
+
+    def files(self) -> dict:
+        """
+        :return: {partition folder: [files in the order of the writes]}
+        """
+        folders = [self.folder]
+        if self.partition is not None:
+            folders = [entry.path for entry in os.scandir(self.folder)
+                       if entry.is_dir() and entry.name.startswith(self.partition[0] + "=")]
+        files = {}
+        for folder in sorted(folders):
+            names = sorted((name for name in os.listdir(folder) if name.endswith(FILE_EXTENSION)),
+                           key=lambda name: [int(part) for part in name[:-len(FILE_EXTENSION)].split("-")])
+            if len(names) > 0:
+                files[folder] = [os.path.join(folder, name) for name in names]
+        return files
+
+    def read(self, columns=None, deduplicate=True) -> pa.Table:
+        """
+        :param columns: default every column of the schema, and the partition column
+        :param deduplicate: keep only the last row of each id
+        :return: rows in the order of the writes, partition by partition
+        """
+        tables = []
+        for folder, paths in self.files().items():
+            table = pa.concat_tables([pq.read_table(path, schema=self.schema) for path in paths])
+            if deduplicate:
+                table = self._deduplicate(table)
+            if self.partition is not None:
+                value = os.path.basename(folder)[len(self.partition[0]) + 1:]
+                table = table.append_column(self.partition[0], pa.array([value] * len(table), pa.string()))
+            tables.append(table if columns is None else table.select(columns))
+
+        if len(tables) == 0:
+            schema = self.schema
+            if self.partition is not None:
+                schema = schema.append(pa.field(self.partition[0], pa.string()))
+            empty = schema.empty_table()
+            return empty if columns is None else empty.select(columns)
+        return pa.concat_tables(tables)
+
+    def _deduplicate(self, table: pa.Table) -> pa.Table:
+        """
+        Last row of each id of a partition, the rows of an id are always in the same partition.
+        """
+        table = table.append_column("_index", pa.array(np.arange(len(table), dtype=np.int64)))
+        last = table.group_by(self.id_subset, use_threads=False).aggregate([("_index", "max")])
+        indices = pc.sort_indices(last["_index_max"])
+        return table.take(pc.take(last["_index_max"], indices)).drop_columns(["_index"])
+
+    def compact(self) -> int:
+        """
+        Rewrite each partition of several files in a single file without duplicates. The new file is written before
+        the old ones are removed, an interrupted compaction leaves duplicates dropped on read.
+        :return: number of duplicates dropped
+        """
+        n_dropped = 0
+        for folder, paths in self.files().items():
+            if len(paths) < 2:
+                continue
+            table = pa.concat_tables([pq.read_table(path, schema=self.schema) for path in paths])
+            compacted = self._deduplicate(table)
+            self._write_file(folder, compacted)
+            for path in paths:
+                os.remove(path)
+            n_dropped += len(table) - len(compacted)
+            logging.info(f"{len(paths)} files of {folder} compacted, {len(table) - len(compacted)} duplicates dropped.")
+        return n_dropped
+
+
+def get_guardian_dataset(data_folder="data", **kwargs) -> ParquetDataset:
+    """
+    :param data_folder:
+    :param kwargs: see ParquetDataset
+    """
+    return ParquetDataset(os.path.join(data_folder, "guardians"), GUARDIAN_SCHEMA, GUARDIAN_ID, **kwargs)
+
+
+def get_activity_dataset(data_folder="data", **kwargs) -> ParquetDataset:
+    """
+    Activities partitioned by the month of their period.
+    :param data_folder:
+    :param kwargs: see ParquetDataset
+    """
+    return ParquetDataset(os.path.join(data_folder, "activities"), ACTIVITY_SCHEMA, ACTIVITY_ID,
+                          partition=("month", lambda row: row["period"][:7] or "unknown"), **kwargs)
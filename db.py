@@ -1,134 +1,24 @@
 ﻿import os
+import ast
 import sys
+import json
+import shutil
+import time
+import asyncio
+import functools
+import contextlib
+import urllib.request
+import numpy as np
 import pandas as pd
 import logging
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
 from models.activity import Activity
+from models.carnage_report import Player
 from models.guardian import Guardian
 
 
-class PandasBufferDB:
-    def __init__(self,
-                 filename,
-                 columns,
-                 id_subset,
-                 dtypes=None,
-                 data_folder="D:/GameDev/D2FunnyStats/v2/data",
-                 max_buffer_length=500,
-                 max_db_length=50000):
-        """
-        
-        :param filename:
-        :param columns: name of the columns of the dataframe
-        :param dtypes: dict of {'column_name': dtype}
-        :param id_subset: list of columns representing the column id. For instance for a guardian it would be [membership_id, membership_type, character_id]. Used to drop duplicates.
-        :param data_folder:
-        :param max_buffer_length:
-        :param max_db_length:
-        """
-        self.filename = filename
-        self.columns = columns
-        self.dtypes = dtypes
-        self.id_subset = id_subset
-        self.data_folder = data_folder
-        self.max_buffer_length = max_buffer_length
-        self.max_db_length = max_db_length
-
-        self.buffer = []
-
-        # Init filename with last in data_folder (or 00)
-        self.filename = self._read_current_chunk_filename()
-        
-        if self.filename in os.listdir(self.data_folder):
-            self.db = pd.read_parquet(os.path.join(self.data_folder, self.filename))
-            self._ensure_dtypes()
-            if list(self.db.columns) != columns:
-                raise RuntimeError(f"{self.filename} columns do not correspond to model attributes.")
-        else:
-            self._create_new_df()
-
-    def append(self, element):
-        self.buffer.append(element)
-        if len(self.buffer) > self.max_buffer_length:
-            self._concat()
-
-    def save(self):
-        self._concat()
-        self._export()
-        
-    def _ensure_dtypes(self):
-        for dt in self.dtypes.keys():
-            self.db[dt] = self.db[dt].astype(self.dtypes[dt])
-
-    def _create_new_df(self):
-        self.filename = self._get_next_chunck_filename()
-        self.db = pd.DataFrame(columns=self.columns)
-        self._ensure_dtypes()
-        
-    def _get_next_chunck_filename(self):
-        basename, ext = os.path.splitext(self.filename)
-        
-        if basename[-3] == "-":
-            basename = basename[:-3]  # prefer regexp
-            
-        n = 0
-        for i in range(100):  # arbitrary limit
-            number = str(n) if n >= 10 else "0" + str(n)
-            name = basename + "-" + number
-            if name + ext in os.listdir(self.data_folder):
-                n += 1
-                continue
-            else:
-                return name + ext
-            
-    def _read_current_chunk_filename(self):
-        basename, ext = os.path.splitext(self.filename)
-
-        if basename[-3] == "-":
-            basename = basename[:-3]  # prefer regexp
-
-        n = 0
-        number = str(n) if n >= 10 else "0" + str(n)
-        previous_name = basename + "-" + number
-        for i in range(100):  # arbitrary limit
-            number = str(n) if n >= 10 else "0" + str(n)
-            name = basename + "-" + number
-            if name + ext in os.listdir(self.data_folder):
-                n += 1
-                previous_name = name
-                continue
-            else:
-                return previous_name + ext
-                
-    def _concat(self):
-        # logging.info(f"Empty buffer {self.filename}.")
-        df = pd.DataFrame([vars(g) for g in self.buffer])
-        self.db = pd.concat([self.db, df], ignore_index=True)
-        self._ensure_dtypes()
-        self.db.drop_duplicates(subset=self.id_subset, keep="last", inplace=True, ignore_index=True)
-        self.db.reset_index(drop=True, inplace=True)
-        self.buffer = []
-        # logging.info("Empty buffer finished.")
-        if len(self.db) > self.max_db_length:
-            self._split()
-
-    def _split(self):
-        logging.info(f"Split df {self.filename}.")
-        self._export()
-        self._create_new_df()
-        self._concat()
-        logging.info("Split finished.")
-
-    def _export(self):
-        logging.info(f"Export {self.filename}.")
-        self.db.to_parquet(os.path.join(self.data_folder, self.filename), compression="brotli")
-        logging.info("Export finished.")
-
-    def __del__(self):
-        self.save()
-
-
 class PandasSourceDB:
     BREEKY_DISPLAY_NAME = "Breeky"
     BREEKY_DISPLAY_NAME_CODE = "8283"
@@ -160,15 +50,18 @@ class PandasSourceDB:
         self.add_source(breeky)
 
     def add_source(self, guardian: Guardian):
-        if len(self.db.loc[(self.db["membership_id"] == guardian.membership_id)
-                           & (self.db["membership_type"] == guardian.membership_type)
-                           & (self.db["character_id"] == guardian.character_id)]) > 0:
+        # Strings in the csv, integers in the models
+        membership_id, membership_type, character_id = (str(guardian.membership_id), str(guardian.membership_type),
+                                                        str(guardian.character_id))
+        if len(self.db.loc[(self.db["membership_id"] == membership_id)
+                           & (self.db["membership_type"] == membership_type)
+                           & (self.db["character_id"] == character_id)]) > 0:
             return
 
         self.db = pd.concat([self.db, pd.DataFrame(data={
-            "membership_id": guardian.membership_id,
-            "membership_type": guardian.membership_type,
-            "character_id": guardian.character_id,
+            "membership_id": membership_id,
+            "membership_type": membership_type,
+            "character_id": character_id,
         }, index=[0])]).reset_index(drop=True)
         
         self._ensure_dtype()
@@ -179,14 +72,99 @@ class PandasSourceDB:
         self.db.to_csv(os.path.join(self.data_folder, self.filename), index=False)
         
 
+@functools.lru_cache(maxsize=None)
+def insert_request(table: str, columns: tuple) -> str:
+    """
+    Build the insert request once per table and columns, sqlite keeps the statement prepared for the same string.
+    """
+    return f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+
+def ids_json(ids) -> str:
+    """
+    Ids as a single parameter for any number of them, read in a query with json_each(?).
+    """
+    return json.dumps([int(id_) for id_ in ids])
+
+
+# Players of an activity a as json: the players saved with str() by the pandas dbs are python literals, made json like
+# the notebook did. The other ones are json already and read as is, NULL if the players cannot be read
+FIXED_PLAYERS = "REPLACE(REPLACE(REPLACE(a.players, '''', '\"'), 'False', 'false'), 'True', 'true')"
+PLAYERS_JSON = (f"CASE WHEN json_valid(a.players) THEN a.players "
+                f"WHEN json_valid({FIXED_PLAYERS}) THEN {FIXED_PLAYERS} END")
+
+
 class DBHelper:
-    def __init__(self, name: str, folder: str):
-        if name not in os.listdir(folder):
+    # Set on every connexion
+    PRAGMAS = {
+        "journal_mode": "WAL",  # readers do not block the writer, and a commit is an append to the wal
+        "synchronous": "NORMAL",  # no fsync by commit, a power loss can lose the last commits but not corrupt the db
+        "mmap_size": 1024 ** 3,  # pages read from the os cache without a copy
+        "cache_size": -256 * 1024,  # KiB, the pages of the indexes stay in memory
+        "temp_store": "MEMORY",
+    }
+    # Schema steps of the db, the version of a db (PRAGMA user_version) is the number of steps already applied
+    MIGRATIONS = ()
+
+    def __init__(self, name: str, folder: str, check_same_thread=True, create=False):
+        """
+
+        :param name:
+        :param folder:
+        :param check_same_thread: see sqlite3.connect
+        :param create: create the db if it does not exist, otherwise it is an error
+        """
+        if not create and name not in os.listdir(folder):
             raise Exception(f"DB {name} not found in {folder}")
 
         self.name = name
         self.folder = folder
-        self.connexion = sqlite3.connect(os.path.join(self.folder, self.name))
+        self.connexion = sqlite3.connect(os.path.join(self.folder, self.name), check_same_thread=check_same_thread)
+        for pragma, value in DBHelper.PRAGMAS.items():
+            self.connexion.execute(f"PRAGMA {pragma}={value}")
+        self.migrate()
+
+    @property
+    def version(self) -> int:
+        return self.connexion.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        """
+        Apply the migrations the db does not have yet, each one in its own transaction with the new version.
+        """
+        version = self.version
+        for i, migration in enumerate(self.MIGRATIONS[version:], start=version + 1):
+            start_time = time.monotonic()
+            self.connexion.execute("BEGIN")
+            migration(self)
+            self.connexion.execute(f"PRAGMA user_version={i}")
+            self.commit()
+            logging.info(f"{self} migrated to version {i} ({migration.__name__}) in "
+                         f"{time.monotonic() - start_time:.1f}s.")
+
+    def _rebuild_table(self, table: str, schema: str, keep_row_id=True):
+        """
+        Create the table, or if it exists copy its rows in a new table with schema: the values are converted to the
+        types of the schema and the duplicates of its unique keys are dropped.
+        :param table:
+        :param schema: columns and constraints
+        :param keep_row_id: copy the ROWIDs, for the tables whose ROWID is not an INTEGER PRIMARY KEY of schema
+        """
+        columns = [row[1] for row in self.connexion.execute(f"PRAGMA table_info({table})")]
+        if len(columns) == 0:
+            self.connexion.execute(f"CREATE TABLE {table} ({schema})")
+            return
+
+        self.connexion.execute(f"CREATE TABLE {table}_new ({schema})")
+        new_columns = [row[1] for row in self.connexion.execute(f"PRAGMA table_info({table}_new)")]
+        copied = [column for column in new_columns if column in columns]
+        if keep_row_id:
+            copied = ["ROWID"] + copied
+        n_rows = self.connexion.execute(f"INSERT OR IGNORE INTO {table}_new ({', '.join(copied)}) "
+                                        f"SELECT {', '.join(copied)} FROM {table} ORDER BY ROWID").rowcount
+        self.connexion.execute(f"DROP TABLE {table}")
+        self.connexion.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+        logging.info(f"Table {table} of {self} rebuilt with {n_rows} rows.")
 
     def commit(self):
         self.connexion.commit()
@@ -206,18 +184,109 @@ class DBHelper:
         
 
 class MainDBHelper(DBHelper):
-    def __init__(self, name: str, folder: str):
-        super().__init__(name, folder)
+    ACTIVITY_PLAYER_COLUMNS = ("instance_id", "membership_id", "membership_type", "character_id", "is_winner", "team")
+    # Columns in the order of Guardian.data and Activity.data, the ids are integers (8 bytes at most instead of the
+    # 19 characters of a membership id)
+    GUARDIAN_SCHEMA = ("membership_id INTEGER NOT NULL, "
+                       "membership_type INTEGER NOT NULL, "
+                       "character_id INTEGER NOT NULL, "
+                       "display_name TEXT, "
+                       "display_name_code TEXT, "
+                       "is_private INTEGER, "
+                       "activities_entered INTEGER, "
+                       "activities_won INTEGER, "
+                       "assists INTEGER, "
+                       "kills INTEGER, "
+                       "seconds_played INTEGER, "
+                       "deaths INTEGER, "
+                       "average_lifespan REAL, "
+                       "score INTEGER, "
+                       "opponents_defeated INTEGER, "
+                       "precision_kills INTEGER, "
+                       "combat_rating REAL, "
+                       "UNIQUE (membership_id, membership_type, character_id)")
+    ACTIVITY_SCHEMA = ("instance_id INTEGER PRIMARY KEY, "  # the activity is stored in the b-tree of its id
+                       "period TEXT, "
+                       "mode INTEGER, "
+                       "is_private INTEGER, "
+                       "win_score INTEGER, "
+                       "loss_score INTEGER, "
+                       "players TEXT")
+    GUARDIAN_STATS = ("activities_entered", "activities_won", "assists", "kills", "seconds_played", "deaths",
+                      "average_lifespan", "score", "opponents_defeated", "precision_kills", "combat_rating")
+    # Row of get_guardians_array, NaN stats for the guardians not found
+    GUARDIAN_DTYPE = np.dtype([("found", np.bool_),
+                               ("membership_id", np.int64),
+                               ("membership_type", np.int64),
+                               ("character_id", np.int64),
+                               ("is_private", np.bool_)]
+                              + [(stat, np.float64) for stat in GUARDIAN_STATS])
+
+    def __init__(self, name: str, folder: str, check_same_thread=True, create=False):
+        super().__init__(name, folder, check_same_thread, create)
         self.connexion.row_factory = sqlite3.Row  # return dict from db instead of list of values
 
+    def _create_tables(self):
+        # The guardians keep their ROWID, it is the position of the frontier cursors
+        self._rebuild_table("guardian", MainDBHelper.GUARDIAN_SCHEMA)
+        self._rebuild_table("activity", MainDBHelper.ACTIVITY_SCHEMA, keep_row_id=False)
+
+    def _create_activity_player(self):
+        # One row per player of an activity, clustered by activity
+        self.connexion.execute("CREATE TABLE IF NOT EXISTS activity_player ("
+                               "instance_id INTEGER NOT NULL, "
+                               "membership_id INTEGER NOT NULL, "
+                               "membership_type INTEGER NOT NULL, "
+                               "character_id INTEGER NOT NULL, "
+                               "is_winner INTEGER NOT NULL, "
+                               "team INTEGER, "
+                               "PRIMARY KEY (instance_id, character_id)) WITHOUT ROWID")
+        # Matches of a player, and players of the guardian table joined on their character
+        self.connexion.execute("CREATE INDEX IF NOT EXISTS activity_player_membership "
+                               "ON activity_player (membership_id, instance_id)")
+        self.connexion.execute("CREATE INDEX IF NOT EXISTS activity_player_character "
+                               "ON activity_player (character_id)")
+        # In the transaction of the migration, an interrupted migration leaves no player behind
+        self.migrate_activity_players(commit=False)
+
+    def _create_indexes(self):
+        # Lookup by character (ExistenceIndex, joins with activity_player), the guardian is found by its ids with the
+        # unique key of the table
+        self.connexion.execute("CREATE INDEX IF NOT EXISTS guardian_character ON guardian (character_id)")
+        # Frontier ordered by activities_entered: the ROWID follows the key in the index, so the index is in the order
+        # of the frontier cursor and a batch reads only its rows (the ids in the index would sort the ties instead)
+        self.connexion.execute("CREATE INDEX IF NOT EXISTS guardian_activities_entered ON guardian (activities_entered)")
+
+    def _create_priority_index(self):
+        # Frontier ordered by activities_entered, NULL read as -1 so the key of the cursor is never NULL
+        self.connexion.execute("DROP INDEX IF EXISTS guardian_activities_entered")
+        self.connexion.execute("CREATE INDEX IF NOT EXISTS guardian_priority ON guardian (IFNULL(activities_entered, -1))")
+
+    MIGRATIONS = (_create_tables, _create_activity_player, _create_indexes, _create_priority_index)
+
+    @staticmethod
+    def _activity_player_rows(instance_id, players: list[Player]) -> list[tuple]:
+        return [(int(instance_id), player.membership_id, player.membership_type, player.character_id,
+                 int(player.is_winner), player.team)
+                for player in players]
+
+    def insert_activity_players(self, activities: list[Activity]):
+        rows = [row for activity in activities for row in self._activity_player_rows(activity.instance_id,
+                                                                                      activity.players)]
+        self.connexion.executemany(insert_request("activity_player", MainDBHelper.ACTIVITY_PLAYER_COLUMNS), rows)
+
     def insert_guardian(self, guardian: Guardian):
         data = guardian.data
-        columns = ", ".join([f"{value}" for value in data])
-        empty_values = ", ".join([f"?" for v in data])
-        request = f"INSERT OR IGNORE INTO guardian ({columns}) VALUES ({empty_values})"
-        self.connexion.execute(request, list(data.values()))
+        self.connexion.execute(insert_request("guardian", tuple(data)), list(data.values()))
         # self.connexion.commit()
 
+    def insert_guardians(self, guardians: list[Guardian]):
+        if len(guardians) == 0:
+            return
+        columns = tuple(guardians[0].data)
+        self.connexion.executemany(insert_request("guardian", columns),
+                                   [tuple(guardian.data.values()) for guardian in guardians])
+
     def get_guardian_from_ids(self, guardian: Guardian):
         cursor = self.connexion.execute(
             "SELECT * FROM guardian WHERE guardian.membership_id=? AND guardian.membership_type=? AND guardian.character_id=?",
@@ -229,12 +298,8 @@ class MainDBHelper(DBHelper):
         
         if len(data) > 1:
             raise Exception("Multiple corresponding guardians.")
-        
-        r = dict(data[0])
-        g = Guardian()
-        for k in r:
-            g.__dict__[k] = r[k]
-        return g
+
+        return self.guardian_from_row(data[0])
     
     def get_guardian_from_row_id(self, row_id: int):
         cursor = self.connexion.execute(
@@ -248,11 +313,7 @@ class MainDBHelper(DBHelper):
         if len(data) > 1:
             raise Exception("Multiple corresponding guardians.")
 
-        r = dict(data[0])
-        g = Guardian()
-        for k in r:
-            g.__dict__[k] = r[k]
-        return g
+        return self.guardian_from_row(data[0])
     
     def is_guardian_in_db_from_ids(self, guardian: Guardian):
         cursor = self.connexion.execute(
@@ -263,11 +324,157 @@ class MainDBHelper(DBHelper):
 
     def insert_activity(self, activity: Activity):
         data = activity.data
-        columns = ", ".join([f"{value}" for value in data])
-        empty_values = ", ".join([f"?" for v in data])
-        request = f"INSERT OR IGNORE INTO activity ({columns}) VALUES ({empty_values})"
-        self.connexion.execute(request, list(data.values()))
+        self.connexion.execute(insert_request("activity", tuple(data)), list(data.values()))
+        self.insert_activity_players([activity])
         # self.connexion.commit()
+
+    def insert_activities(self, activities: list[Activity]):
+        if len(activities) == 0:
+            return
+        columns = tuple(activities[0].data)
+        self.connexion.executemany(insert_request("activity", columns),
+                                   [tuple(activity.data.values()) for activity in activities])
+        self.insert_activity_players(activities)
+
+    def get_player_instance_ids(self, membership_id) -> list[int]:
+        """
+        :return: instance ids of the activities of a player, with any of its characters
+        """
+        cursor = self.connexion.execute("SELECT instance_id FROM activity_player WHERE membership_id=?",
+                                        [int(membership_id)])
+        return [row[0] for row in cursor]
+
+    def migrate_activity_players(self, batch_size=10000, commit=True) -> int:
+        """
+        Fill activity_player from the json players of the activities inserted before the table existed.
+        Can be stopped and run again, the activities already in activity_player are skipped.
+        :param batch_size: activities read at once
+        :param commit: commit after each batch, False to run in the transaction of the caller (the migration of the
+        table)
+        :return: number of activities migrated
+        """
+        n_activities = 0
+        last_row_id = 0
+        while True:
+            rows = self.connexion.execute(
+                "SELECT a.ROWID, a.instance_id, a.players FROM activity AS a "
+                "WHERE a.ROWID > ? AND NOT EXISTS "
+                "(SELECT 1 FROM activity_player AS p WHERE p.instance_id = CAST(a.instance_id AS INTEGER)) "
+                "ORDER BY a.ROWID LIMIT ?",
+                [last_row_id, batch_size]).fetchall()
+            if len(rows) == 0:
+                return n_activities
+
+            self.insert_stored_players([instance_id for _, instance_id, _ in rows])
+            if commit:
+                self.commit()
+
+            last_row_id = rows[-1][0]
+            n_activities += len(rows)
+            logging.info(f"{n_activities} activities migrated to activity_player.")
+
+    def insert_stored_players(self, instance_ids: list):
+        """
+        Insert in activity_player the players of activities already in the activity table, read from their json by
+        sqlite. Only the players which are not json even once fixed are parsed in python.
+        :param instance_ids:
+        """
+        self.connexion.execute(
+            f"INSERT OR IGNORE INTO activity_player ({', '.join(MainDBHelper.ACTIVITY_PLAYER_COLUMNS)}) "
+            f"SELECT a.instance_id, json_extract(p.value, '$.membership_id'), "
+            f"json_extract(p.value, '$.membership_type'), json_extract(p.value, '$.character_id'), "
+            f"json_extract(p.value, '$.is_winner'), json_extract(p.value, '$.team') "
+            f"FROM json_each(?) AS ids "
+            f"JOIN activity AS a ON a.instance_id = ids.value "
+            f"JOIN json_each({PLAYERS_JSON}) AS p",
+            [ids_json(instance_ids)])
+
+        rows = self.connexion.execute(f"SELECT a.instance_id, a.players FROM json_each(?) AS ids "
+                                      f"JOIN activity AS a ON a.instance_id = ids.value "
+                                      f"WHERE {PLAYERS_JSON} IS NULL",
+                                      [ids_json(instance_ids)]).fetchall()
+        player_rows = []
+        for instance_id, players in rows:
+            try:
+                player_rows += self._activity_player_rows(instance_id, self._parse_players(players))
+            except (ValueError, SyntaxError, KeyError, TypeError) as err:
+                logging.warning(f"Players of Activity ({instance_id}) cannot be inserted. Error : {err}")
+        self.connexion.executemany(insert_request("activity_player", MainDBHelper.ACTIVITY_PLAYER_COLUMNS),
+                                   player_rows)
+
+    def get_guardians_by_ids(self, character_ids: list) -> list[Guardian]:
+        """
+        Guardians among character_ids, with a single query. The missing ones are not returned.
+        """
+        cursor = self.connexion.execute("SELECT * FROM guardian WHERE character_id IN (SELECT value FROM json_each(?))",
+                                        [ids_json(character_ids)])
+        return self.guardians_from_rows(cursor)
+
+    def get_activities_by_ids(self, instance_ids: list) -> list[Activity]:
+        """
+        Activities among instance_ids, with a single query. The missing ones are not returned.
+        """
+        cursor = self.connexion.execute("SELECT * FROM activity WHERE instance_id IN (SELECT value FROM json_each(?))",
+                                        [ids_json(instance_ids)])
+        return self.activities_from_rows(cursor)
+
+    def get_guardians_array(self, character_ids: list) -> np.ndarray:
+        """
+        Ids and stats of the guardians of character_ids with a single query, without any model: a structured array of
+        GUARDIAN_DTYPE with a row per character id, in the same order. A guardian not found has found False and NaN
+        stats.
+        """
+        cursor = self.connexion.cursor()
+        cursor.row_factory = None  # tuples, read as is by numpy (NULL is NaN in the float columns)
+        rows = cursor.execute(f"SELECT g.character_id IS NOT NULL, IFNULL(g.membership_id, 0), "
+                              f"IFNULL(g.membership_type, 0), IFNULL(g.character_id, 0), IFNULL(g.is_private, 0), "
+                              f"{', '.join('g.' + stat for stat in MainDBHelper.GUARDIAN_STATS)} "
+                              f"FROM json_each(?) AS ids LEFT JOIN guardian AS g ON g.character_id = ids.value "
+                              f"ORDER BY ids.key",
+                              [ids_json(character_ids)]).fetchall()
+        return np.array(rows, dtype=MainDBHelper.GUARDIAN_DTYPE)
+
+    @staticmethod
+    def guardians_from_rows(cursor: sqlite3.Cursor) -> list[Guardian]:
+        """
+        Guardians of the rows of a query, the column names are read once for all of them.
+        """
+        columns = [column[0] for column in cursor.description]
+        return [MainDBHelper.guardian_from_row(row, columns) for row in cursor]
+
+    @staticmethod
+    def activities_from_rows(cursor: sqlite3.Cursor) -> list[Activity]:
+        columns = [column[0] for column in cursor.description]
+        return [MainDBHelper.activity_from_row(row, columns) for row in cursor]
+
+    @staticmethod
+    def guardian_from_row(row, columns=None) -> Guardian:
+        """
+        :param row: sqlite3.Row, or values of columns
+        :param columns: default the keys of the sqlite3.Row
+        """
+        guardian = Guardian.from_data(zip(columns if columns is not None else row.keys(), row))
+        guardian.is_private = bool(guardian.is_private)
+        return guardian
+
+    @staticmethod
+    def activity_from_row(row, columns=None) -> Activity:
+        """
+        See guardian_from_row.
+        """
+        activity = Activity.from_data(zip(columns if columns is not None else row.keys(), row))
+        activity.is_private = bool(activity.is_private)
+        activity.players = MainDBHelper._parse_players(activity.players)
+        return activity
+
+    @staticmethod
+    def _parse_players(players: str) -> list[Player]:
+        try:
+            players = json.loads(players)
+        except json.JSONDecodeError:
+            # Saved with str() by the pandas dbs: python literals with single quotes and True/False
+            players = ast.literal_eval(players)
+        return [Player.from_dict(player) for player in players]
     
     def get_activity_from_id(self, activity: Activity):
         cursor = self.connexion.execute("SELECT * FROM main.activity WHERE activity.instance_id=?", [activity.instance_id])
@@ -279,11 +486,7 @@ class MainDBHelper(DBHelper):
         if len(data) > 1:
             raise Exception("Multiple corresponding activities.")
 
-        r = dict(data[0])
-        a = Activity()
-        for k in r:
-            a.__dict__[k] = r[k]
-        return a
+        return self.activity_from_row(data[0])
     
     def is_activity_in_db_from_id(self, activity: Activity):
         cursor = self.connexion.execute(
@@ -293,16 +496,833 @@ class MainDBHelper(DBHelper):
     
     
 class SourceDBHelper(DBHelper):
-    def __init__(self, name: str, folder: str):
-        super().__init__(name, folder)
+    def __init__(self, name: str, folder: str, check_same_thread=True, create=False):
+        super().__init__(name, folder, check_same_thread, create)
+
+    def _create_tables(self):
+        # The membership id is the ROWID
+        self._rebuild_table("guardian", "membership_id INTEGER PRIMARY KEY", keep_row_id=False)
+
+    MIGRATIONS = (_create_tables,)
     
     def insert_source(self, membership_id: int):
         request = f"INSERT OR IGNORE INTO guardian (membership_id) VALUES (?)"
         self.connexion.execute(request, [int(membership_id)])
 
+    def insert_sources(self, membership_ids: list[int]):
+        request = f"INSERT OR IGNORE INTO guardian (membership_id) VALUES (?)"
+        self.connexion.executemany(request, [(int(membership_id),) for membership_id in membership_ids])
+
     def is_source_already_used(self, membership_id):
         request = f"SELECT COUNT(membership_id) FROM guardian WHERE guardian.membership_id=?"
         cursor = self.connexion.execute(request, [membership_id])
         return cursor.fetchall()[0][0] > 0
-    
-    
\ No newline at end of file
+
+
+class CrawlFrontier:
+    """
+    Guardians of main.db whose membership is not a used source yet, read in batches with a single anti-join query on
+    the attached sources.db. The position in the ordering is persisted and each query starts from it, so a pass does
+    not scan again the guardians already crawled.
+    The guardians inserted behind the cursor during a pass (above it for a DESC order, the guardians found by the
+    crawl) are read by the next pass: the frontier starts again from the top once a pass is over, and it is exhausted
+    when a pass from the top does not find any new guardian.
+    With a shard, only the memberships with membership_id % n_shards == index are read, each shard has its cursor.
+    """
+    # name: (expression, direction), the ROWID breaks ties and the expression is never NULL
+    ORDERS = {
+        "rowid": ("g.ROWID", "ASC"),
+        "recent": ("g.ROWID", "DESC"),  # last inserted guardians first
+        "activities_entered": ("IFNULL(g.activities_entered, -1)", "DESC"),  # most productive sources first
+    }
+
+    def __init__(self, name="main.db", source_name="sources.db", folder="data", order="rowid", batch_size=100,
+                 shard=None, cursor_folder=None):
+        """
+
+        :param name: main db
+        :param source_name: source db
+        :param folder:
+        :param order: key of ORDERS
+        :param batch_size: number of guardians read by query
+        :param shard: (index, n_shards) to read a partition of the memberships, None for all of them
+        :param cursor_folder: folder of the source db where the cursor is saved, folder by default (the folder of a
+        shard keeps the dbs of folder read only)
+        """
+        self.helper = DBHelper(name, folder)
+        self.helper.connexion.execute("ATTACH DATABASE ? AS sources", [os.path.join(folder, source_name)])
+        self.cursor_db = "sources"
+        if cursor_folder is not None and os.path.abspath(cursor_folder) != os.path.abspath(folder):
+            self.helper.connexion.execute("ATTACH DATABASE ? AS cursors", [os.path.join(cursor_folder, source_name)])
+            self.cursor_db = "cursors"
+        self.helper.connexion.execute(f"CREATE TABLE IF NOT EXISTS {self.cursor_db}.frontier_cursor "
+                                      f"(name TEXT PRIMARY KEY, key, row_id INTEGER)")
+        self.helper.commit()
+
+        self.order = order
+        self.expression, self.direction = CrawlFrontier.ORDERS[order]
+        self.batch_size = batch_size
+        self.shard = shard
+        self.cursor_name = order if shard is None else f"{order}/{shard[0]}-{shard[1]}"
+        self.cursor = self._read_cursor()  # (key, row_id) of the last guardian served, None from the start
+        self.claimed = set()  # memberships already served in this run
+
+    def __iter__(self):
+        # A pass resumed from a saved cursor has not seen the guardians before it
+        full_pass = self.cursor is None
+        n_served = 0  # in this pass
+        while True:
+            # Persist the start of the batch, a restart reads again the sources in progress
+            self._save_cursor()
+            rows = self._next_batch()
+            if len(rows) == 0:
+                if full_pass and n_served == 0:
+                    return
+                # Next pass, for the guardians behind the cursor
+                self.cursor = None
+                full_pass = True
+                n_served = 0
+                continue
+
+            for row_id, key, membership_id, membership_type, character_id in rows:
+                self.cursor = (key, row_id)
+                if membership_id in self.claimed:
+                    continue
+                self.claimed.add(membership_id)
+                n_served += 1
+                yield Guardian(membership_id=membership_id, membership_type=membership_type, character_id=character_id)
+
+    def reset(self):
+        self.cursor = None
+        self._save_cursor()
+
+    def _next_batch(self):
+        condition = ""
+        params = []
+        if self.cursor is not None:
+            comparison = ">" if self.direction == "ASC" else "<"
+            # The bound on the expression alone lets sqlite search an index on an expression
+            condition = f"{self.expression} {comparison}= ? AND ({self.expression}, g.ROWID) {comparison} (?, ?) AND "
+            params = [self.cursor[0], *self.cursor]
+        if self.shard is not None:
+            condition += "CAST(g.membership_id AS INTEGER) % ? = ? AND "
+            params += [self.shard[1], self.shard[0]]
+
+        request = (f"SELECT g.ROWID, {self.expression}, g.membership_id, g.membership_type, g.character_id "
+                   f"FROM main.guardian AS g "
+                   f"WHERE {condition}"
+                   f"NOT EXISTS (SELECT 1 FROM sources.guardian AS s WHERE s.membership_id = g.membership_id) "
+                   f"ORDER BY {self.expression} {self.direction}, g.ROWID {self.direction} "
+                   f"LIMIT ?")
+        return self.helper.execute(request, params + [self.batch_size])
+
+    def _read_cursor(self):
+        rows = self.helper.execute(f"SELECT key, row_id FROM {self.cursor_db}.frontier_cursor WHERE name=?",
+                                   [self.cursor_name])
+        return tuple(rows[0]) if len(rows) > 0 and rows[0][1] is not None else None
+
+    def _save_cursor(self):
+        key, row_id = self.cursor if self.cursor is not None else (None, None)
+        self.helper.execute(f"INSERT OR REPLACE INTO {self.cursor_db}.frontier_cursor (name, key, row_id) "
+                            f"VALUES (?, ?, ?)", [self.cursor_name, key, row_id])
+        self.helper.commit()
+
+    def close(self):
+        self.helper.close()
+
+
+class IdIndex:
+    """
+    Set of int64 ids: a sorted numpy array of the ids loaded from the db (8 bytes per id, about 10 times less than a
+    python set) and a python set of the ids added since, merged into the array when it gets big.
+    """
+    MAX_ADDED = 1000000
+
+    def __init__(self, ids: np.ndarray = None):
+        self.ids = np.unique(ids) if ids is not None else np.empty(0, dtype=np.int64)
+        self.added = set()
+        self.n_lookups = 0
+        self.lookup_seconds = 0
+
+    def __contains__(self, id_: int):
+        if id_ is None:
+            return False
+        
+        start_time = time.perf_counter()
+        if id_ in self.added:
+            found = True
+        else:
+            i = np.searchsorted(self.ids, id_)
+            found = bool(i < len(self.ids) and self.ids[i] == id_)
+        self.lookup_seconds += time.perf_counter() - start_time
+        self.n_lookups += 1
+        return found
+
+    def __len__(self):
+        return len(self.ids) + len(self.added)
+
+    def update(self, ids: np.ndarray):
+        self.ids = np.union1d(self.ids, ids)
+
+    def add(self, id_: int):
+        if id_ is None:
+            return
+        
+        self.added.add(id_)
+        if len(self.added) > IdIndex.MAX_ADDED:
+            self.ids = np.union1d(self.ids, np.fromiter(self.added, dtype=np.int64, count=len(self.added)))
+            self.added = set()
+
+    @property
+    def nbytes(self):
+        # set slots plus the int objects
+        return self.ids.nbytes + sys.getsizeof(self.added) + 32 * len(self.added)
+
+    @property
+    def metrics(self):
+        return {
+            "size": len(self),
+            "memory_MB": self.nbytes / 1024 ** 2,
+            "lookups": self.n_lookups,
+            "lookups_per_second": self.n_lookups / self.lookup_seconds if self.lookup_seconds > 0 else 0
+        }
+
+
+class ExistenceIndex:
+    """
+    In-memory index of what is already in main.db and sources.db, to know if an entity has been seen without querying
+    sqlite. Guardians are indexed by character id (unique among all accounts), activities by instance id and sources
+    by membership id. It must be updated as rows are inserted.
+    """
+    def __init__(self, db_helper: DBHelper, source_db_helper: DBHelper):
+        self.guardians = IdIndex()
+        self.activities = IdIndex()
+        self.sources = IdIndex()
+        self.load(db_helper, source_db_helper)
+
+    def load(self, db_helper: DBHelper, source_db_helper: DBHelper):
+        """
+        Add the ids of other dbs (a shard for instance).
+        """
+        start_time = time.monotonic()
+        self.guardians.update(self._load_ids(db_helper, "SELECT CAST(character_id AS INTEGER) FROM guardian"))
+        self.activities.update(self._load_ids(db_helper, "SELECT CAST(instance_id AS INTEGER) FROM activity"))
+        self.sources.update(self._load_ids(source_db_helper, "SELECT CAST(membership_id AS INTEGER) FROM guardian"))
+        logging.info(f"Existence index of {db_helper} loaded in {time.monotonic() - start_time:.1f}s: {self.metrics}")
+
+    @staticmethod
+    def _load_ids(db_helper: DBHelper, request: str) -> np.ndarray:
+        cursor = db_helper.connexion.execute(request)
+        return np.fromiter((row[0] for row in cursor), dtype=np.int64)
+
+    @staticmethod
+    def _key(id_):
+        try:
+            return int(id_)
+        except ValueError:  # empty id
+            return None
+
+    def is_guardian_in_db(self, guardian: Guardian) -> bool:
+        return self._key(guardian.character_id) in self.guardians
+
+    def is_character_in_db(self, character_id) -> bool:
+        return self._key(character_id) in self.guardians
+
+    def add_guardian(self, guardian: Guardian):
+        self.guardians.add(self._key(guardian.character_id))
+
+    def is_activity_in_db(self, activity: Activity) -> bool:
+        return self._key(activity.instance_id) in self.activities
+
+    def add_activity(self, activity: Activity):
+        self.activities.add(self._key(activity.instance_id))
+
+    def is_source_already_used(self, membership_id) -> bool:
+        return self._key(membership_id) in self.sources
+
+    def add_source(self, membership_id):
+        self.sources.add(self._key(membership_id))
+
+    @property
+    def metrics(self):
+        return {
+            "guardians": self.guardians.metrics,
+            "activities": self.activities.metrics,
+            "sources": self.sources.metrics
+        }
+
+
+def create_shard(folder: str, shard_folder: str, names=("main.db", "sources.db")):
+    """
+    Create the empty dbs of a shard with the schema and the version of the dbs of folder, existing shard dbs are kept.
+    :param folder:
+    :param shard_folder:
+    :param names:
+    """
+    os.makedirs(shard_folder, exist_ok=True)
+    for name in names:
+        if os.path.exists(os.path.join(shard_folder, name)):
+            continue
+
+        helper = DBHelper(name, folder)
+        schema = helper.execute("SELECT sql FROM sqlite_master "
+                                "WHERE type IN ('table', 'index') AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%'", [])
+        version = helper.version
+        helper.close()
+
+        connexion = sqlite3.connect(os.path.join(shard_folder, name))
+        for (request,) in schema:
+            connexion.execute(request)
+        connexion.execute(f"PRAGMA user_version={version}")
+        connexion.commit()
+        connexion.close()
+
+
+def merge_shard(folder: str, shard_folder: str, name="main.db", source_name="sources.db") -> int:
+    """
+    Insert the rows of a shard in the dbs of folder. The shard is removed if its crawl journal is empty, otherwise it is
+    kept to be resumed by the next crawl of the shard.
+    :return: number of rows inserted
+    """
+    n_rows = 0
+    for db_name, tables in ((name, ("guardian", "activity", "activity_player")), (source_name, ("guardian",))):
+        helper = DBHelper(db_name, folder)
+        helper.connexion.execute("ATTACH DATABASE ? AS shard", [os.path.join(shard_folder, db_name)])
+        for table in tables:
+            n_rows += helper.connexion.execute(f"INSERT OR IGNORE INTO main.{table} SELECT * FROM shard.{table}").rowcount
+        helper.commit()
+        helper.connexion.execute("DETACH DATABASE shard")
+        helper.close()
+
+    helper = DBHelper(name, shard_folder)
+    journal_exists = len(helper.execute("SELECT name FROM sqlite_master WHERE name='journal_source'", [])) > 0
+    unfinished = journal_exists and helper.execute("SELECT COUNT(*) FROM journal_source", [])[0][0] > 0
+    helper.close()
+    if unfinished:
+        logging.info(f"Shard {shard_folder} merged ({n_rows} rows), its unfinished sources are kept.")
+    else:
+        shutil.rmtree(shard_folder)
+        logging.info(f"Shard {shard_folder} merged ({n_rows} rows) and removed.")
+    return n_rows
+
+
+class CrawlJournal:
+    """
+    Progress of the crawl, stored in main.db next to the rows so it is committed in the same transactions: the sources
+    being crawled, the activities waiting for their carnage report and the guardians waiting for their stats.
+    A row is removed with the write of its work item, what is left after a crash is the work to resume.
+    """
+    def __init__(self, db_helper: DBHelper):
+        self.connexion = db_helper.connexion
+        self.connexion.execute("CREATE TABLE IF NOT EXISTS journal_source ("
+                               "membership_id INTEGER PRIMARY KEY, "
+                               "membership_type INTEGER, "
+                               "character_id, "
+                               "history_done INTEGER NOT NULL DEFAULT 0)")
+        self.connexion.execute("CREATE TABLE IF NOT EXISTS journal_activity ("
+                               "instance_id INTEGER PRIMARY KEY, "
+                               "source_id INTEGER NOT NULL)")
+        self.connexion.execute("CREATE TABLE IF NOT EXISTS journal_guardian ("
+                               "character_id INTEGER PRIMARY KEY, "
+                               "membership_id INTEGER, "
+                               "membership_type INTEGER, "
+                               "display_name TEXT, "
+                               "display_name_code TEXT, "
+                               "source_id INTEGER NOT NULL)")
+        self.connexion.commit()
+
+    def add_sources(self, rows: list):
+        """
+        :param rows: (membership_id, membership_type, character_id, history_done)
+        """
+        self.connexion.executemany("INSERT OR REPLACE INTO journal_source "
+                                   "(membership_id, membership_type, character_id, history_done) VALUES (?, ?, ?, ?)",
+                                   rows)
+
+    def set_history_done(self, membership_ids):
+        self.connexion.executemany("UPDATE journal_source SET history_done=1 WHERE membership_id=?",
+                                   [(membership_id,) for membership_id in membership_ids])
+
+    def remove_sources(self, membership_ids):
+        self.connexion.executemany("DELETE FROM journal_source WHERE membership_id=?",
+                                   [(membership_id,) for membership_id in membership_ids])
+
+    def add_activities(self, rows: list):
+        """
+        :param rows: (instance_id, source_id)
+        """
+        self.connexion.executemany("INSERT OR REPLACE INTO journal_activity (instance_id, source_id) VALUES (?, ?)", rows)
+
+    def remove_activities(self, instance_ids):
+        self.connexion.executemany("DELETE FROM journal_activity WHERE instance_id=?",
+                                   [(instance_id,) for instance_id in instance_ids])
+
+    def add_guardians(self, rows: list):
+        """
+        :param rows: (character_id, membership_id, membership_type, display_name, display_name_code, source_id)
+        """
+        self.connexion.executemany("INSERT OR REPLACE INTO journal_guardian "
+                                   "(character_id, membership_id, membership_type, display_name, display_name_code, "
+                                   "source_id) VALUES (?, ?, ?, ?, ?, ?)",
+                                   rows)
+
+    def remove_guardians(self, character_ids):
+        self.connexion.executemany("DELETE FROM journal_guardian WHERE character_id=?",
+                                   [(character_id,) for character_id in character_ids])
+
+    def load(self) -> list:
+        """
+        :return: list of (source, history_done, instance ids, guardians) of the sources left unfinished
+        """
+        # Items of a source removed by a failed write would never be resumed
+        n_orphans = 0
+        for table in ("journal_activity", "journal_guardian"):
+            n_orphans += self.connexion.execute(f"DELETE FROM {table} "
+                                                f"WHERE source_id NOT IN (SELECT membership_id FROM journal_source)"
+                                                ).rowcount
+        self.connexion.commit()
+        if n_orphans > 0:
+            logging.warning(f"{n_orphans} journal items without their source are dropped.")
+
+        sources = {}
+        for membership_id, membership_type, character_id, history_done in self.connexion.execute(
+                "SELECT membership_id, membership_type, character_id, history_done FROM journal_source"):
+            source = Guardian(membership_id=membership_id,
+                              membership_type=membership_type,
+                              character_id=character_id if character_id is not None else "")
+            sources[membership_id] = (source, bool(history_done), [], [])
+
+        for instance_id, source_id in self.connexion.execute("SELECT instance_id, source_id FROM journal_activity"):
+            sources[source_id][2].append(instance_id)
+
+        for character_id, membership_id, membership_type, display_name, display_name_code, source_id \
+                in self.connexion.execute("SELECT character_id, membership_id, membership_type, display_name, "
+                                          "display_name_code, source_id FROM journal_guardian"):
+            sources[source_id][3].append(Guardian(display_name=display_name,
+                                                  display_name_code=display_name_code,
+                                                  membership_id=membership_id,
+                                                  membership_type=membership_type,
+                                                  character_id=character_id))
+        return list(sources.values())
+
+
+class DBWriter:
+    """
+    Write guardians, activities and used sources from a dedicated thread so sqlite never blocks the event loop.
+    Rows are batched per table and inserted with executemany, then committed, every `batch_size` rows or
+    `flush_interval` seconds.
+    The crawl journal (see CrawlJournal) is written in the same transactions. A journal item added and done in the same
+    batch is never written.
+    A batch which cannot be written is rolled back and written again, the writer stops with the error after
+    WRITE_ATTEMPTS (the journal of the last commit is resumed by the next run).
+    """
+    WRITE_ATTEMPTS = 3
+    WRITE_RETRY_DELAY = 1  # seconds, doubled at each attempt
+
+    def __init__(self,
+                 name="main.db",
+                 source_name="sources.db",
+                 folder="data",
+                 batch_size=500,
+                 flush_interval=1.0,
+                 queue_size=10000):
+        """
+
+        :param name: main db
+        :param source_name: source db
+        :param folder:
+        :param batch_size: max number of rows waiting to be written
+        :param flush_interval: max seconds a row waits to be written
+        :param queue_size:
+        """
+        self.name = name
+        self.source_name = source_name
+        self.folder = folder
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.queue = asyncio.Queue(queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="DBWriter")
+        self.db_helper = None  # connexions are opened in the writer thread
+        self.source_db_helper = None
+        self.journal = None
+
+        self.guardians = []
+        self.activities = []
+        self.sources = []  # (membership_id, callback)
+        self.n_buffered = 0  # items taken from the queue and not written yet
+        self._reset_journal_buffer()
+
+        self.n_rows_written = 0
+        self.n_flushes = 0
+        self.write_seconds = 0
+
+    @property
+    def metrics(self):
+        return {
+            "rows_written": self.n_rows_written,
+            "flushes": self.n_flushes,
+            "rows_per_second": self.n_rows_written / self.write_seconds if self.write_seconds > 0 else 0
+        }
+
+    async def put(self, item):
+        """
+        :param item: Guardian or Activity
+        """
+        await self.queue.put(item)
+
+    async def put_source(self, membership_id, callback=None):
+        """
+        Mark a source as used once every row put before it is written, and remove it from the journal.
+        :param membership_id:
+        :param callback: called in the event loop once the source is committed
+        """
+        await self.queue.put(("source_used", membership_id, callback))
+
+    async def journal_source(self, source: Guardian):
+        await self.queue.put(("source", source))
+
+    async def journal_history_done(self, membership_id):
+        await self.queue.put(("history_done", membership_id))
+
+    async def journal_activity(self, source_id, instance_id):
+        """
+        Record an activity waiting for its carnage report, done with put(activity) or journal_activity_done.
+        :param source_id: membership id of the source whose history contains the activity
+        :param instance_id:
+        """
+        await self.queue.put(("activity", source_id, instance_id))
+
+    async def journal_activity_done(self, instance_id):
+        """
+        Remove an activity from the journal without writing it (skipped or failed).
+        """
+        await self.queue.put(("activity_done", instance_id))
+
+    async def journal_guardian(self, source_id, guardian: Guardian):
+        """
+        Record a guardian waiting for its stats, done with put(guardian) or journal_guardian_done.
+        :param source_id: membership id of the source whose activity contains the guardian
+        :param guardian:
+        """
+        await self.queue.put(("guardian", source_id, guardian))
+
+    async def journal_guardian_done(self, character_id):
+        """
+        Remove a guardian from the journal without writing it (skipped or failed).
+        """
+        await self.queue.put(("guardian_done", character_id))
+
+    async def load_journal(self) -> list:
+        """
+        :return: see CrawlJournal.load
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._connect)
+        return await loop.run_in_executor(self.executor, self.journal.load)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._connect)
+
+        last_flush = loop.time()
+        while True:
+            timeout = None if self.n_buffered == 0 else max(last_flush + self.flush_interval - loop.time(), 0)
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+                self._buffer(item)
+            except asyncio.TimeoutError:
+                pass
+
+            if self.n_buffered >= self.batch_size \
+                    or len(self.sources) > 0 \
+                    or (self.n_buffered > 0 and loop.time() >= last_flush + self.flush_interval):
+                await self.flush()
+                last_flush = loop.time()
+
+    async def flush(self):
+        guardians, activities, sources = self.guardians, self.activities, self.sources
+        journal_buffer = self.journal_buffer
+        n_items = self.n_buffered
+        self.guardians, self.activities, self.sources = [], [], []
+        self._reset_journal_buffer()
+        self.n_buffered = 0
+
+        loop = asyncio.get_running_loop()
+        try:
+            for attempt in range(1, DBWriter.WRITE_ATTEMPTS + 1):
+                try:
+                    await loop.run_in_executor(self.executor, self._write,
+                                               guardians, activities, sources, journal_buffer)
+                    break
+                except Exception as err:
+                    # Nothing of the batch is left in the transaction, the rows are written again (or never)
+                    await loop.run_in_executor(self.executor, self._rollback)
+                    logging.error(f"Error while writing {len(guardians)} guardians, {len(activities)} activities "
+                                  f"and {len(sources)} sources in db (attempt {attempt}/{DBWriter.WRITE_ATTEMPTS}). "
+                                  f"Error : {err}")
+                    if attempt == DBWriter.WRITE_ATTEMPTS:
+                        raise
+                    await asyncio.sleep(DBWriter.WRITE_RETRY_DELAY * 2 ** (attempt - 1))
+
+            for membership_id, callback in sources:
+                if callback is not None:
+                    callback()
+        finally:
+            for _ in range(n_items):
+                self.queue.task_done()
+
+    async def close(self):
+        """
+        Write what is left and close the connexions.
+        """
+        while not self.queue.empty():
+            self._buffer(self.queue.get_nowait())
+        await self.flush()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._disconnect)
+        self.executor.shutdown()
+
+    def _reset_journal_buffer(self):
+        self.journal_buffer = {
+            "sources": {},  # membership_id: [membership_id, membership_type, character_id, history_done]
+            "history_done": set(),  # sources journaled in a previous batch
+            "activities": {},  # instance_id: (instance_id, source_id)
+            "activities_done": set(),
+            "guardians": {},  # character_id: (character_id, membership_id, ..., source_id)
+            "guardians_done": set()
+        }
+
+    @staticmethod
+    def _journal_add(added: dict, done: set, key, row):
+        done.discard(key)
+        added[key] = row
+
+    @staticmethod
+    def _journal_done(added: dict, done: set, key):
+        # Added in this batch, it does not need to be written at all
+        if added.pop(key, None) is None:
+            done.add(key)
+
+    def _buffer(self, item):
+        journal = self.journal_buffer
+        if isinstance(item, Guardian):
+            self.guardians.append(item)
+            self._journal_done(journal["guardians"], journal["guardians_done"], int(item.character_id))
+        elif isinstance(item, Activity):
+            self.activities.append(item)
+            self._journal_done(journal["activities"], journal["activities_done"], int(item.instance_id))
+        elif item[0] == "source_used":
+            self.sources.append(item[1:])
+        elif item[0] == "source":
+            source = item[1]
+            journal["sources"][int(source.membership_id)] = [int(source.membership_id), int(source.membership_type),
+                                                            source.character_id, 0]
+        elif item[0] == "history_done":
+            membership_id = int(item[1])
+            if membership_id in journal["sources"]:
+                journal["sources"][membership_id][3] = 1
+            else:
+                journal["history_done"].add(membership_id)
+        elif item[0] == "activity":
+            instance_id = int(item[2])
+            self._journal_add(journal["activities"], journal["activities_done"], instance_id,
+                              (instance_id, int(item[1])))
+        elif item[0] == "activity_done":
+            self._journal_done(journal["activities"], journal["activities_done"], int(item[1]))
+        elif item[0] == "guardian":
+            guardian = item[2]
+            character_id = int(guardian.character_id)
+            self._journal_add(journal["guardians"], journal["guardians_done"], character_id,
+                              (character_id, int(guardian.membership_id), int(guardian.membership_type),
+                               guardian.display_name, guardian.display_name_code, int(item[1])))
+        elif item[0] == "guardian_done":
+            self._journal_done(journal["guardians"], journal["guardians_done"], int(item[1]))
+        self.n_buffered += 1
+
+    def _connect(self):
+        if self.db_helper is None:
+            self.db_helper = MainDBHelper(self.name, self.folder, check_same_thread=False)
+            self.source_db_helper = SourceDBHelper(self.source_name, self.folder, check_same_thread=False)
+            self.journal = CrawlJournal(self.db_helper)
+
+    def _rollback(self):
+        if self.db_helper is not None:
+            self.db_helper.connexion.rollback()
+            self.source_db_helper.connexion.rollback()
+
+    def _disconnect(self):
+        if self.db_helper is not None:
+            self.db_helper.close()
+            self.source_db_helper.close()
+
+    def _write(self, guardians: list[Guardian], activities: list[Activity], sources: list, journal_buffer: dict):
+        # Also called by close() if run() was never started
+        self._connect()
+        
+        start_time = time.perf_counter()
+        self.journal.add_sources(list(journal_buffer["sources"].values()))
+        self.journal.set_history_done(journal_buffer["history_done"])
+        self.journal.add_activities(list(journal_buffer["activities"].values()))
+        self.journal.add_guardians(list(journal_buffer["guardians"].values()))
+        self.db_helper.insert_guardians(guardians)
+        self.db_helper.insert_activities(activities)
+        self.journal.remove_activities(journal_buffer["activities_done"])
+        self.journal.remove_guardians(journal_buffer["guardians_done"])
+        self.db_helper.commit()
+
+        # Sources after the commit of their rows, out of the journal once used (a crash in between resumes an empty
+        # source)
+        if len(sources) > 0:
+            membership_ids = [int(membership_id) for membership_id, callback in sources]
+            self.source_db_helper.insert_sources(membership_ids)
+            self.source_db_helper.commit()
+            self.journal.remove_sources(membership_ids)
+            self.db_helper.commit()
+
+        self.write_seconds += time.perf_counter() - start_time
+        self.n_rows_written += len(guardians) + len(activities)
+        self.n_flushes += 1
+
+
+class DBReader:
+    """
+    Read main.db from coroutines: the queries run on a pool of threads, each query on a read-only connexion taken from a
+    pool, so they never block the event loop. With WAL a reader sees the last commit when its query starts, it does not
+    wait for the writer (DBWriter, the scraper in another process) nor blocks it.
+    A long read only delays the checkpoint of the wal, until the read ends.
+    """
+    def __init__(self, name="main.db", folder="data", n_connexions=4, batch_size=1000):
+        """
+
+        :param name:
+        :param folder:
+        :param n_connexions: max number of concurrent queries, the other ones wait for a connexion
+        :param batch_size: rows read at a time by the streams
+        """
+        if name not in os.listdir(folder):
+            raise Exception(f"DB {name} not found in {folder}")
+
+        self.name = name
+        self.folder = folder
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=n_connexions, thread_name_prefix="DBReader")
+        self.connexions = [self._connect() for _ in range(n_connexions)]
+        self.pool = asyncio.Queue()
+        for connexion in self.connexions:
+            self.pool.put_nowait(connexion)
+
+    def _connect(self):
+        # The db is opened by MainDBHelper before (schema, WAL), a read-only connexion cannot migrate it
+        uri = "file:" + urllib.request.pathname2url(os.path.abspath(os.path.join(self.folder, self.name))) + "?mode=ro"
+        connexion = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        connexion.execute("PRAGMA query_only=1")
+        for pragma in ("mmap_size", "cache_size"):
+            connexion.execute(f"PRAGMA {pragma}={DBHelper.PRAGMAS[pragma]}")
+        connexion.row_factory = sqlite3.Row
+        return connexion
+
+    @contextlib.asynccontextmanager
+    async def _connexion(self):
+        connexion = await self.pool.get()
+        try:
+            yield connexion
+        finally:
+            self.pool.put_nowait(connexion)
+
+    async def _run(self, connexion: sqlite3.Connection, function, *args):
+        future = asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # The query stops at its next step, the connexion goes back to the pool once it is not used anymore
+            connexion.interrupt()
+            await asyncio.wait([future])
+            raise
+
+    async def execute(self, request: str, params=(), row_function=None) -> list:
+        """
+        :param request:
+        :param params:
+        :param row_function: row_function(row, columns) applied to each row in the thread of the query (like
+        MainDBHelper.guardian_from_row), sqlite3.Row are returned if None
+        :return: every row of the query
+        """
+        def fetch(connexion):
+            cursor = connexion.execute(request, params)
+            return self._apply(row_function, cursor, cursor.fetchall())
+
+        async with self._connexion() as connexion:
+            return await self._run(connexion, fetch, connexion)
+
+    async def stream(self, request: str, params=(), row_function=None, batch_size=None):
+        """
+        Rows of a query read batch_size at a time, only one batch is in memory. The stream holds a connexion of the
+        pool until it is exhausted or closed (use contextlib.aclosing to break out of it early).
+        :param request:
+        :param params:
+        :param row_function: see execute
+        :param batch_size: default self.batch_size
+        """
+        batch_size = batch_size if batch_size is not None else self.batch_size
+
+        def fetch(cursor):
+            return self._apply(row_function, cursor, cursor.fetchmany(batch_size))
+
+        async with self._connexion() as connexion:
+            cursor = await self._run(connexion, connexion.execute, request, params)
+            try:
+                while True:
+                    rows = await self._run(connexion, fetch, cursor)
+                    if len(rows) == 0:
+                        return
+                    for row in rows:
+                        yield row
+            finally:
+                cursor.close()
+
+    @staticmethod
+    def _apply(row_function, cursor: sqlite3.Cursor, rows: list) -> list:
+        if row_function is None:
+            return rows
+        columns = [column[0] for column in cursor.description]
+        return [row_function(row, columns) for row in rows]
+
+    async def get_guardians_by_ids(self, character_ids: list) -> list[Guardian]:
+        """
+        Guardians of main.db among character_ids, with a single query. The missing ones are not returned.
+        """
+        return await self.execute("SELECT * FROM guardian WHERE character_id IN (SELECT value FROM json_each(?))",
+                                  [ids_json(character_ids)], MainDBHelper.guardian_from_row)
+
+    async def get_activities_by_ids(self, instance_ids: list) -> list[Activity]:
+        """
+        Activities of main.db among instance_ids, with a single query. The missing ones are not returned.
+        """
+        return await self.execute("SELECT * FROM activity WHERE instance_id IN (SELECT value FROM json_each(?))",
+                                  [ids_json(instance_ids)], MainDBHelper.activity_from_row)
+
+    async def get_player_activities(self, membership_id) -> list[Activity]:
+        """
+        Activities of a player, with any of its characters.
+        """
+        return await self.execute("SELECT a.* FROM activity_player AS p "
+                                  "JOIN activity AS a ON a.instance_id = p.instance_id "
+                                  "WHERE p.membership_id=?",
+                                  [int(membership_id)], MainDBHelper.activity_from_row)
+
+    def iter_guardians(self, batch_size=None):
+        """
+        Every guardian of main.db, see stream.
+        """
+        return self.stream("SELECT * FROM guardian", (), MainDBHelper.guardian_from_row, batch_size)
+
+    def iter_activities(self, batch_size=None):
+        """
+        Every activity of main.db, see stream.
+        """
+        return self.stream("SELECT * FROM activity", (), MainDBHelper.activity_from_row, batch_size)
+
+    def close(self):
+        self.executor.shutdown()
+        for connexion in self.connexions:
+            connexion.close()
@@ -3,6 +3,7 @@ import time
 import aiohttp
 import json
 from local_api import BungieAPI
+from api_cache import ResponseCache
 
 
 IFROSTBOLT_DISPLAY_NAME = "IFrostBolt"
@@ -31,22 +32,11 @@ async def fetch_activity_history(session, membership_id, membership_type, charac
         return r
 
 
-async def fetch_map_definition(session, reference_id):
-    url = BungieAPI.ENDPOINT + "/Destiny2/Manifest/{entityType}/{hashIdentifier}/"
-    url = url.format(
-        entityType="DestinyActivityDefinition",
-        hashIdentifier=reference_id)
-    headers = {"X-API-Key": API_KEY}
-
-    async with await session.get(url, headers=headers) as resp:
-        r = await resp.json()
-        return r
-
-
 async def main():
     global maps
 
     async with aiohttp.ClientSession() as session:
+        api = BungieAPI(session, api_key=API_KEY, cache=ResponseCache())  # definitions are immutable, cache them
         activity_history = await fetch_activity_history(session, IFROSTBOLT_MEMBERSHIP_ID, IFROSTBOLT_MEMBERSHIP_TYPE,
                                          IFROSTBOLT_CHARACTER_ID, page=0)
         reference_ids = []
@@ -55,11 +45,11 @@ async def main():
 
         for reference_id in reference_ids:
             if reference_id not in maps:
-                r = await fetch_map_definition(session, reference_id)
+                r = await api.fetch_entity_definition("DestinyActivityDefinition", reference_id)
                 map_info = {
-                    "name": r["Response"]["displayProperties"]["name"],
-                    "description": r["Response"]["displayProperties"]["description"],
-                    "pgcrImage": r["Response"]["pgcrImage"]
+                    "name": r["displayProperties"]["name"],
+                    "description": r["displayProperties"]["description"],
+                    "pgcrImage": r["pgcrImage"]
                 }
                 maps[reference_id] = map_info
 
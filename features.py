@@ -0,0 +1,122 @@
+"""
+Training features of the activities: the stats of their 12 players (winners first, 6 by team), read from main.db in a
+single query and computed with numpy.
+"""
+import numpy as np
+
+from db import MainDBHelper, ids_json, PLAYERS_JSON
+
+# To use different features, modify STATS_NAME and compute_stats accordingly
+STATS_NAME = ["activities_entered", "combat_rating", "kills_pga", "assists_pga", "deaths_pga", "score_pga", "win_ratio",
+              "kd", "kda"]
+N_STATS = len(STATS_NAME)
+N_PLAYERS_BY_TEAM = 6
+N_PLAYERS = 2 * N_PLAYERS_BY_TEAM
+PLAYERS_COLUMNS = np.array([[f"player_{i}_{stat}" for stat in STATS_NAME]
+                            for i in range(1, N_PLAYERS + 1)]).reshape(N_PLAYERS * N_STATS)
+
+MISSING_STAT = -1  # guardian not found, private, without activity or death
+NO_PLAYER = 0  # empty slot, a 4v4 on a 6v6 game for ex
+
+PLAYER_DTYPE = np.dtype([("activity", np.int64),  # index of the activity in the instance ids
+                         ("is_winner", np.bool_),
+                         ("found", np.bool_),
+                         ("is_private", np.bool_),
+                         ("activities_entered", np.float64),
+                         ("activities_won", np.float64),
+                         ("kills", np.float64),
+                         ("assists", np.float64),
+                         ("deaths", np.float64),
+                         ("score", np.float64),
+                         ("combat_rating", np.float64)])
+
+
+def get_cols_name(player_range_start: int, player_range_end: int) -> np.ndarray:
+    """
+    :return: columns of the players from player_range_start (included, starting at 1) to player_range_end (excluded)
+    """
+    return PLAYERS_COLUMNS[(player_range_start - 1) * N_STATS:(player_range_end - 1) * N_STATS]
+
+
+def read_players(db_helper: MainDBHelper, instance_ids) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Players of the activities joined to their guardian, in one pass over the activities.
+    :param db_helper:
+    :param instance_ids:
+    :return: players as an array of PLAYER_DTYPE, by activity then winners first then in the order of the carnage
+    report, and the indexes of the activities whose players cannot be read
+    """
+    cursor = db_helper.connexion.cursor()
+    cursor.row_factory = None  # tuples, read as is by numpy (NULL is NaN in the float columns)
+    rows = cursor.execute(
+        f"SELECT ids.key, IFNULL(json_extract(p.value, '$.is_winner'), 0), g.character_id IS NOT NULL, "
+        f"IFNULL(g.is_private, 0), g.activities_entered, g.activities_won, g.kills, g.assists, g.deaths, g.score, "
+        f"g.combat_rating "
+        f"FROM json_each(?) AS ids "
+        f"JOIN activity AS a ON a.instance_id = ids.value "
+        f"JOIN json_each(IFNULL({PLAYERS_JSON}, '[]')) AS p "
+        f"LEFT JOIN guardian AS g ON g.character_id = json_extract(p.value, '$.character_id') "
+        f"ORDER BY ids.key, 2 DESC, p.key",
+        [ids_json(instance_ids)]).fetchall()
+    players = np.array(rows, dtype=PLAYER_DTYPE)
+
+    invalid = cursor.execute(f"SELECT ids.key FROM json_each(?) AS ids "
+                             f"JOIN activity AS a ON a.instance_id = ids.value "
+                             f"WHERE {PLAYERS_JSON} IS NULL",
+                             [ids_json(instance_ids)]).fetchall()
+    return players, np.array([row[0] for row in invalid], dtype=np.int64)
+
+
+def compute_stats(players: np.ndarray) -> np.ndarray:
+    """
+    :param players: array of PLAYER_DTYPE
+    :return: (n_players, N_STATS) array of the STATS_NAME of each player, MISSING_STAT for all the stats of a player
+    whose guardian is not found, is private, or has no activity or no death
+    """
+    n = players["activities_entered"]
+    kills, assists, deaths = players["kills"], players["assists"], players["deaths"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stats = np.stack([n,
+                          players["combat_rating"],
+                          kills / n,
+                          assists / n,
+                          deaths / n,
+                          players["score"] / n,
+                          players["activities_won"] / n,
+                          kills / deaths,
+                          (kills + assists) / deaths], axis=1)
+
+    missing = ~players["found"] | players["is_private"] | ~(n >= 1) | ~(deaths != 0)
+    stats[missing] = MISSING_STAT
+    return stats
+
+
+def get_players_matrix(db_helper: MainDBHelper, instance_ids) -> np.ndarray:
+    """
+    Features of the activities, like the PLAYERS_COLUMNS of the notebook.
+    :param db_helper:
+    :param instance_ids: activities, the rows of the matrix are in the same order
+    :return: (len(instance_ids), N_PLAYERS * N_STATS) matrix: the stats of the winners then of the losers, 6 players
+    by team in the order of the carnage report (the next ones are dropped), NO_PLAYER for the empty slots (every
+    slot of an activity not in db) and MISSING_STAT for every stat of an activity whose players cannot be read
+    """
+    instance_ids = list(instance_ids)
+    players, invalid = read_players(db_helper, instance_ids)
+    stats = compute_stats(players)
+
+    # Rank of each player in its team, the players are sorted by activity and team
+    activity = players["activity"]
+    is_winner = players["is_winner"]
+    new_team = np.ones(len(players), dtype=np.bool_)
+    new_team[1:] = (activity[1:] != activity[:-1]) | (is_winner[1:] != is_winner[:-1])
+    team_start = np.maximum.accumulate(np.where(new_team, np.arange(len(players)), 0))
+    rank = np.arange(len(players)) - team_start
+    slot = rank + np.where(is_winner, 0, N_PLAYERS_BY_TEAM)
+    kept = rank < N_PLAYERS_BY_TEAM
+
+    matrix = np.full((len(instance_ids), N_PLAYERS, N_STATS), NO_PLAYER, dtype=np.float64)
+    matrix[activity[kept], slot[kept]] = stats[kept]
+
+    # Like an activity whose players are not json in the notebook
+    matrix[invalid] = MISSING_STAT
+    return matrix.reshape(len(instance_ids), N_PLAYERS * N_STATS)
@@ -1,66 +1,422 @@
 ﻿import asyncio
+import collections
 import logging
+import random
+import statistics
 import time
 import json
 from datetime import datetime
 
-import aiohttp.client_exceptions
+import aiohttp
+
+from api_cache import ResponseCache
+from api_decoder import JSONDecoder, DecodeError, get_decoder
+
+
+class RateLimiter:
+    """
+    Token bucket refilled continuously at `rate` tokens per second and holding at most `max_tokens` (burst).
+    Waiters are served in FIFO order: only the head of the queue has a timer, set at the exact time its token will be
+    available, so the event loop is not woken up by polling.
+    """
+    EPSILON = 1e-9  # float error on refill
+
+    def __init__(self, rate: float, max_tokens: float):
+        self.rate = rate
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.last_update = time.monotonic()
+        self._waiters = collections.deque()
+        self._timer = None
+
+    async def acquire(self):
+        self._refill()
+        if not self._waiters and self.tokens >= 1 - RateLimiter.EPSILON:
+            self.tokens -= 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._schedule()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Token was granted but the task got cancelled before using it, hand it to the next waiter
+                self.tokens = min(self.tokens + 1, self.max_tokens)
+                self._wake()
+            raise
+
+    def set_rate(self, rate: float):
+        self._refill()
+        self.rate = rate
+        self._reschedule()
+
+    def pause(self, seconds: float):
+        """
+        Empty the bucket and do not refill it for `seconds`.
+        """
+        self._refill()
+        self.tokens = 0
+        self.last_update = max(self.last_update, time.monotonic() + seconds)
+        self._reschedule()
+
+    def _refill(self):
+        now = time.monotonic()
+        if now <= self.last_update:  # paused
+            return
+        self.tokens = min(self.tokens + (now - self.last_update) * self.rate, self.max_tokens)
+        self.last_update = now
+
+    def _schedule(self):
+        if self._timer is not None:
+            return
+        delay = max(self.last_update - time.monotonic(), 0) + max(1 - self.tokens, 0) / self.rate
+        self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _reschedule(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._waiters:
+            self._schedule()
+
+    def _on_timer(self):
+        self._timer = None
+        self._wake()
+
+    def _wake(self):
+        self._refill()
+        while self._waiters:
+            waiter = self._waiters[0]
+            if waiter.done():  # cancelled while waiting
+                self._waiters.popleft()
+                continue
+            if self.tokens < 1 - RateLimiter.EPSILON:
+                break
+            self.tokens -= 1
+            self._waiters.popleft()
+            waiter.set_result(None)
+
+        if self._waiters:
+            self._schedule()
+
+
+class RetryBudget:
+    """
+    Retries allowed for an endpoint. Every successful call earns `ratio` retry, up to `max_retries`, so a failing
+    endpoint cannot multiply the load with retries.
+    """
+    def __init__(self, ratio: float, max_retries: float):
+        self.ratio = ratio
+        self.max_retries = max_retries
+        self.balance = max_retries
+
+    def deposit(self):
+        self.balance = min(self.balance + self.ratio, self.max_retries)
+
+    def withdraw(self) -> bool:
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
 
 
 class BungieAPI:
     
-    RATE = 20  # Max number of calls per second, Bungie tells us it's 25 but to be sure...
+    RATE = 20  # Starting number of calls per second, then adapted to the server throttling (AIMD)
+    MIN_RATE = 1
+    MAX_RATE = 25  # Bungie tells us it's 25
     MAX_TOKENS = 20
+    RATE_INCREASE = 1  # calls per second added after about one second of successful calls
+    RATE_DECREASE_FACTOR = 0.5  # rate multiplier when throttled
+    DEFAULT_THROTTLE_SECONDS = 1  # backoff when the server throttles without telling for how long
+    
+    REQUEST_DEADLINE = 120  # seconds for a call, including rate limit waits and retries
+    RETRY_BASE_DELAY = 0.5  # seconds, doubled at each retry
+    RETRY_MAX_DELAY = 30
+    RETRY_BUDGET_RATIO = 0.1  # retries earned per successful call of an endpoint
+    RETRY_BUDGET_MAX = 50
+    
+    # Seconds before a cached response expires (None: immutable), endpoints not listed are not cached
+    CACHE_TTL = {
+        "carnage_report": None,  # never changes once the match is finished
+        "entity_definition": None,  # immutable per hash
+        "stats": 3600,
+    }
+    
+    # Concurrent identical calls to these endpoints share one request, and the last responses are kept in memory until
+    # they expire like in the cache (RECENT_RESPONSES_TTL for the endpoints not cached). Their callers get a copy of the
+    # response and of its Response, the nested values are shared: these endpoints are only read by the models.
+    COALESCED_ENDPOINTS = {"carnage_report", "entity_definition", "stats", "profile"}
+    RECENT_RESPONSES_SIZE = 128
+    RECENT_RESPONSES_TTL = 60
+    
+    LATENCY_SAMPLES = 10000  # last requests kept for the latency percentiles
+    
+    HISTORY_PAGE_SIZE = 250  # Max
+    HISTORY_PREFETCH_PAGES = 2
+    
+    TRANSIENT_HTTP_STATUS = {502, 504}
+    THROTTLE_HTTP_STATUS = {429, 503}
+    THROTTLE_ERROR_CODES = {
+        31,  # ThrottleLimitExceeded
+        32,  # ThrottleLimitExceededMinutes
+        33,  # ThrottleLimitExceededMomentarily
+        34,  # ThrottleLimitExceededSeconds
+        51,  # PerEndpointRequestThrottleExceeded
+        52,  # PerApplicationThrottleExceeded
+        53,  # PerApplicationAnonymousThrottleExceeded
+        54,  # PerApplicationAuthenticatedThrottleExceeded
+        55,  # PerUserThrottleExceeded
+        1672,  # DestinyThrottledByGameServer
+    }
     
     API_KEY_FILE = "secret_tokens.json"
     ENDPOINT = "https://www.bungie.net/Platform"
     HEADERS = {"X-API-Key": None}
     API_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
     
-    def __init__(self, session):
+    def __init__(self, session, api_key=None, cache: ResponseCache = None, decoder: JSONDecoder = None):
+        """
+        
+        :param session: aiohttp.ClientSession
+        :param api_key: first key of API_KEY_FILE if not given
+        :param cache: optional on-disk cache of the responses, see CACHE_TTL
+        :param decoder: json decoder of the responses, the fastest one installed if not given (see api_decoder). The
+        responses of some endpoints only have the fields read by the models with msgspec
+        """
         self.session = session
-        self.tokens = BungieAPI.MAX_TOKENS
-        self.last_token_update = time.monotonic()
-        self._read_api_key()
+        self.cache = cache
+        self.decoder = get_decoder() if decoder is None else decoder
+        self.in_flight = {}  # key: asyncio.Future of the response
+        self.recent_responses = collections.OrderedDict()  # LRU, key: (expires_at, response)
+        self.rate_limiter = RateLimiter(BungieAPI.RATE, BungieAPI.MAX_TOKENS)
+        self.rate = BungieAPI.RATE  # AIMD rate, given to the rate limiter when its rounded value changes
+        self.backoff_until = 0  # one rate decrease per throttling episode
+        self.counters = collections.Counter()
+        self.latencies = collections.deque(maxlen=BungieAPI.LATENCY_SAMPLES)  # seconds, without the rate limiter wait
+        self.retry_budgets = collections.defaultdict(
+            lambda: RetryBudget(BungieAPI.RETRY_BUDGET_RATIO, BungieAPI.RETRY_BUDGET_MAX))
+        if api_key is None:
+            api_key = BungieAPI.read_api_keys()[0]
+        # Per instance, each key has its own rate limit
+        self.headers = dict(BungieAPI.HEADERS, **{"X-API-Key": api_key})
         
-    def _read_api_key(self):
-        with open(BungieAPI.API_KEY_FILE) as fp:
+    @staticmethod
+    def read_api_keys(filename=API_KEY_FILE) -> list[str]:
+        """
+        :param filename: json with a single key {"X-API-Key": "..."} or a list of keys {"X-API-Key": ["...", ...]}
+        :return: list of the keys
+        """
+        with open(filename) as fp:
             secrets = json.load(fp)
-            BungieAPI.HEADERS["X-API-Key"] = secrets["X-API-Key"]
+        keys = secrets["X-API-Key"]
+        return [keys] if isinstance(keys, str) else list(keys)
+
+    @property
+    def metrics(self):
+        return {"current_rate": self.rate_limiter.rate, **self.latency_percentiles(), **self.counters}
+
+    def latency_percentiles(self, percentiles=(50, 99)) -> dict:
+        """
+        :return: {"latency_p50": seconds, ...} of the last LATENCY_SAMPLES requests, empty before two requests
+        """
+        if len(self.latencies) < 2:
+            return {}
+        quantiles = statistics.quantiles(self.latencies, n=100, method="inclusive")
+        return {f"latency_p{p}": quantiles[p - 1] for p in percentiles}
 
     async def wait_for_token(self):
-        while self.tokens < 1:
-            self.add_new_tokens()
-            await asyncio.sleep(0.1)
-        self.tokens -= 1
+        await self.rate_limiter.acquire()
 
-    def add_new_tokens(self):
+    def _on_success(self):
+        if self.rate < BungieAPI.MAX_RATE:
+            # Additive increase: RATE_INCREASE spread over the next `rate` calls, ie about one second
+            self.rate = min(self.rate + BungieAPI.RATE_INCREASE / self.rate, BungieAPI.MAX_RATE)
+            # set_rate reschedules the refill timer, not on every call
+            if round(self.rate) != round(self.rate_limiter.rate) or self.rate == BungieAPI.MAX_RATE:
+                self.rate_limiter.set_rate(self.rate)
+
+    def _on_throttle(self, throttle_seconds: float):
+        self.counters["rejected_requests"] += 1
+        throttle_seconds = throttle_seconds or BungieAPI.DEFAULT_THROTTLE_SECONDS
+        
         now = time.monotonic()
-        time_since_update = now - self.last_token_update
-        new_tokens = int(time_since_update * self.RATE)
-        if self.tokens + new_tokens >= 1:
-            self.tokens = min(self.tokens + new_tokens, self.MAX_TOKENS)
-            self.last_token_update = now
+        if now >= self.backoff_until:
+            # Multiplicative decrease, only once for all the calls in flight rejected by the same throttling
+            self.counters["backoff_events"] += 1
+            self.rate = max(self.rate * BungieAPI.RATE_DECREASE_FACTOR, BungieAPI.MIN_RATE)
+            self.rate_limiter.set_rate(self.rate)
+            logging.warning(f"BungieAPI throttled for {throttle_seconds}s, rate decreased to {self.rate:.2f} calls/s.")
+        self.backoff_until = max(self.backoff_until, now + throttle_seconds)
+        self.rate_limiter.pause(throttle_seconds)
 
-    async def get(self, *args, **kwargs):
-        await self.wait_for_token()
+    async def _read_response(self, resp, endpoint: str = None, cache_key: str = None):
+        """
+        Parse the json of a response and adapt the rate to the throttling of the server.
+        :param resp: aiohttp.ClientResponse
+        :param endpoint: name of the endpoint, for the schema of its response
+        :param cache_key: the body of a successful response is cached with this key, see CACHE_TTL
+        :return: json response
+        """
+        if resp.status in BungieAPI.THROTTLE_HTTP_STATUS:
+            try:
+                throttle_seconds = float(resp.headers.get("Retry-After", 0))
+            except ValueError:
+                throttle_seconds = 0
+            self._on_throttle(throttle_seconds)
+            raise BungieAPIThrottleError({"status": resp.status}, f"Throttled with HTTP {resp.status}")
+        
+        if resp.status in BungieAPI.TRANSIENT_HTTP_STATUS:
+            raise BungieAPITransientError({"status": resp.status}, f"Server error HTTP {resp.status}")
+
+        body = await resp.read()
         try:
-            return self.session.get(*args, **kwargs)
-        except (aiohttp.client_exceptions.ServerDisconnectedError,
-                aiohttp.client_exceptions.ClientPayloadError) as error:
-            logging.warning(f"BungieAPI get error: {error}")
-            await asyncio.sleep(1)
-            return self.get(*args, **kwargs)   # recursive strategy
-    
-    async def post(self, *args, **kwargs):
+            r = self.decoder.decode(body, endpoint)
+        except DecodeError as err:
+            # An error page of a proxy for instance
+            raise BungieAPITransientError({"status": resp.status}, f"Invalid json with HTTP {resp.status} : {err}")
+        
+        if r.get("ErrorCode") in BungieAPI.THROTTLE_ERROR_CODES:
+            self._on_throttle(r.get("ThrottleSeconds", 0))
+            raise BungieAPIThrottleError(r, "Throttled")
+        
+        if r.get("ThrottleSeconds", 0) > 0:
+            self.rate_limiter.pause(r["ThrottleSeconds"])
+        self._on_success()
+
+        if cache_key is not None and r.get("ErrorCode") == 1:
+            # The body as received, whatever the fields read by the decoder
+            self.cache.put(cache_key, body, BungieAPI.CACHE_TTL[endpoint])
+        return r
+
+    async def request(self, method: str, url: str, endpoint: str, idempotent=None, deadline=REQUEST_DEADLINE,
+                      cache_key=None, **kwargs):
+        """
+        Call the api and read the json response, retrying transient errors with a jittered exponential backoff.
+        :param method: "GET" or "POST"
+        :param url: 
+        :param endpoint: name of the endpoint, for its retry budget and the metrics
+        :param idempotent: GET calls by default. A call that is not idempotent is only retried when the server surely 
+        did not process it (connection refused or throttled)
+        :param deadline: seconds for the call including its retries
+        :param cache_key: see _read_response
+        :param kwargs: aiohttp request arguments
+        :return: json response
+        """
+        if idempotent is None:
+            idempotent = method == "GET"
+            
+        loop = asyncio.get_running_loop()
+        end_time = loop.time() + deadline
+        budget = self.retry_budgets[endpoint]
+        
+        attempt = 0
+        while True:
+            try:
+                r = await asyncio.wait_for(self._send(method, url, endpoint, cache_key, **kwargs), end_time - loop.time())
+                budget.deposit()
+                return r
+            except (BungieAPIThrottleError, aiohttp.ClientConnectorError) as err:
+                # Not processed by the server, the rate limiter already waits for the throttling
+                error = err
+                delay = 0
+            except (BungieAPITransientError, aiohttp.ClientError, asyncio.TimeoutError) as err:
+                if not idempotent:
+                    raise
+                error = err
+                delay = random.uniform(0, min(BungieAPI.RETRY_MAX_DELAY, BungieAPI.RETRY_BASE_DELAY * 2 ** attempt))
+
+            if loop.time() + delay >= end_time:
+                self.counters["deadline_exceeded"] += 1
+                raise asyncio.TimeoutError(f"BungieAPI {endpoint} call exceeded its deadline of {deadline}s "
+                                           f"after {attempt} retries. Last error : {error!r}")
+            if not budget.withdraw():
+                self.counters["retry_budget_exhausted"] += 1
+                raise error
+            
+            attempt += 1
+            self.counters["retries"] += 1
+            self.counters[f"retries_{endpoint}"] += 1
+            logging.debug(f"BungieAPI {endpoint} retry {attempt} in {delay:.2f}s after error : {error!r}")
+            await asyncio.sleep(delay)
+
+    async def _send(self, method: str, url: str, endpoint: str, cache_key: str = None, **kwargs):
         await self.wait_for_token()
+        start_time = time.monotonic()
         try:
-            return self.session.post(*args, **kwargs)
-        except (aiohttp.client_exceptions.ServerDisconnectedError,
-                aiohttp.client_exceptions.ClientPayloadError) as error:
-            logging.warning(f"BungieAPI post error: {error}")
-            await asyncio.sleep(1)
-            return self.post(*args, **kwargs)   # recursive strategy
+            async with self.session.request(method, url, headers=self.headers, **kwargs) as resp:
+                return await self._read_response(resp, endpoint, cache_key)
+        finally:
+            self.latencies.append(time.monotonic() - start_time)
+
+    async def get(self, url: str, endpoint="get", **kwargs):
+        """
+        Responses of COALESCED_ENDPOINTS are shared between the callers, only their first two levels are copied.
+        """
+        if endpoint not in BungieAPI.COALESCED_ENDPOINTS:
+            return await self._cached_get(url, endpoint, **kwargs)
+        
+        key = ResponseCache.make_key(url, kwargs.get("params"))
+        if key in self.recent_responses:
+            expires_at, r = self.recent_responses[key]
+            if expires_at is None or expires_at >= time.time():
+                self.recent_responses.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return self._copy_response(r)
+            del self.recent_responses[key]
+
+        future = self.in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._cached_get(url, endpoint, **kwargs))
+            future.add_done_callback(lambda f: self._on_flight_done(key, endpoint, f))
+            self.in_flight[key] = future
+        else:
+            self.counters["coalesced_requests"] += 1
+        
+        # A cancelled caller must not cancel the request of the others
+        return self._copy_response(await asyncio.shield(future))
+
+    @staticmethod
+    def _copy_response(r):
+        r = dict(r)
+        if isinstance(r.get("Response"), dict):
+            r["Response"] = dict(r["Response"])
+        return r
+
+    def _on_flight_done(self, key: str, endpoint: str, future: asyncio.Future):
+        del self.in_flight[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        
+        r = future.result()
+        if r.get("ErrorCode") == 1:
+            ttl = BungieAPI.CACHE_TTL.get(endpoint, BungieAPI.RECENT_RESPONSES_TTL)
+            self.recent_responses[key] = (None if ttl is None else time.time() + ttl, r)
+            if len(self.recent_responses) > BungieAPI.RECENT_RESPONSES_SIZE:
+                self.recent_responses.popitem(last=False)
+    
+    async def _cached_get(self, url: str, endpoint: str, **kwargs):
+        if self.cache is None or endpoint not in BungieAPI.CACHE_TTL:
+            return await self.request("GET", url, endpoint, **kwargs)
+        
+        key = ResponseCache.make_key(url, kwargs.get("params"))
+        body = self.cache.get(key)
+        if body is not None:
+            try:
+                r = self.decoder.decode(body, endpoint)
+                self.counters["cache_hits"] += 1
+                return r
+            except DecodeError as err:
+                # Entry of an older version of the cache for instance, fetched again
+                logging.warning(f"Cached response of {endpoint} not decoded : {err}")
+        
+        self.counters["cache_misses"] += 1
+        return await self.request("GET", url, endpoint, cache_key=key, **kwargs)
+    
+    async def post(self, url: str, endpoint="post", **kwargs):
+        return await self.request("POST", url, endpoint, **kwargs)
 
     async def fetch_info(self, display_name: str, display_name_code: str):
         if len(display_name) == 0 or len(display_name_code) == 0:
@@ -73,14 +429,14 @@ class BungieAPI:
             "displayNameCode": display_name_code
         }
         
-        async with await self.post(url, headers=BungieAPI.HEADERS, json=body) as resp:
-            r = await resp.json()
+        # Search only reads, it can be retried like a GET
+        r = await self.post(url, "info", idempotent=True, json=body)
 
-            if len(r["Response"]) == 0:
-                logging.error("Empty response when fetching guardian info.")
-                return None
+        if len(r["Response"]) == 0:
+            logging.error("Empty response when fetching guardian info.")
+            return None
 
-            return r["Response"]
+        return r["Response"]
 
     async def fetch_profile(self, membership_id: int, membership_type: int):
         url = BungieAPI.ENDPOINT + "/Destiny2/{membershipType}/Profile/{destinyMembershipId}/"
@@ -91,9 +447,14 @@ class BungieAPI:
             "components": "Characters"
         }
 
-        async with await self.get(url, headers=BungieAPI.HEADERS, params=query_params) as resp:
-            r = await resp.json()
-            return r
+        return await self.get(url, "profile", params=query_params)
+
+    async def fetch_character_ids(self, membership_id: int, membership_type: int) -> list[str]:
+        r = await self.fetch_profile(membership_id, membership_type)
+        if r["ErrorCode"] == 1:
+            return list(r["Response"]["characters"]["data"].keys())
+        else:
+            raise BungieAPIError(r, f"Fetch profile error (membership_id-{membership_id} membership_type-{membership_type})")
 
     async def fetch_stats(self, membership_id: int, membership_type: int, character_id: int):
         url = BungieAPI.ENDPOINT + "/Destiny2/{membershipType}/Account/{destinyMembershipId}/Character/{characterId}/Stats/"
@@ -102,40 +463,44 @@ class BungieAPI:
             destinyMembershipId=membership_id,
             characterId=character_id)
 
-        async with await self.get(url, headers=BungieAPI.HEADERS) as resp:
-            r = await resp.json()
-            if r["ErrorCode"] == 1:
-                return r["Response"]
-            else:
-                raise BungieAPIError(r, f"Fetch player stats error (membership_id-{membership_id} membership_type-{membership_type} character_id-{character_id})")
+        r = await self.get(url, "stats")
+        if r["ErrorCode"] == 1:
+            return r["Response"]
+        else:
+            raise BungieAPIError(r, f"Fetch player stats error (membership_id-{membership_id} membership_type-{membership_type} character_id-{character_id})")
 
     async def fetch_activity_history(self, membership_id: int, membership_type: int, character_id: int, from_date="", to_date="", gamemode="PvPQuickplay"):
         """
+        See iter_activity_history.
+        :return: list of activities, None if the dates are invalid
+        """
+        try:
+            self._history_periods(from_date, to_date)
+        except ValueError as err:
+            logging.error(f"Error while parsing dates to fetch activity history. Error : {err}")
+            return None
+        
+        return [activity async for activity in self.iter_activity_history(membership_id, membership_type, character_id,
+                                                                           from_date, to_date, gamemode)]
+
+    async def iter_activity_history(self, membership_id: int, membership_type: int, character_id: int, from_date="", to_date="", gamemode="PvPQuickplay", prefetch=HISTORY_PREFETCH_PAGES):
+        """
+        Yield the activities of the history between from_date and to_date, newest first, while the next pages are 
+        fetched in the background.
         :param membership_id: 
         :param membership_type: 
         :param character_id: 
         :param from_date: datetime object or string formatted like BUNGIEAPI_DATE_FORMAT
         :param to_date: 
         :param gamemode: see https://bungie-net.github.io/multi/schema_Destiny-HistoricalStats-Definitions-DestinyActivityModeType.html#schema_Destiny-HistoricalStats-Definitions-DestinyActivityModeType
+        :param prefetch: number of pages fetched ahead of the one being read
         :return: 
         """
-        # Init date interval
         try:
-            if from_date == "":
-                from_date = datetime(2015, 1, 1, 0, 0, 0)   # oldest
-            if to_date == "":
-                to_date = datetime.now()   # newest
-
-            if not isinstance(from_date, datetime):
-                from_date = datetime.strptime(from_date, BungieAPI.API_DATE_FORMAT)
-            if not isinstance(to_date, datetime):
-                to_date = datetime.strptime(to_date, BungieAPI.API_DATE_FORMAT)
+            from_period, to_period = self._history_periods(from_date, to_date)
         except ValueError as err:
-            print("Error while parsing dates to fetch activity history.")
-            return None
-
-        if from_date > to_date:
-            from_date, to_date = (to_date, from_date)
+            logging.error(f"Error while parsing dates to fetch activity history. Error : {err}")
+            return
 
         url = BungieAPI.ENDPOINT + "/Destiny2/{membershipType}/Account/{destinyMembershipId}/Character/{characterId}/Stats/Activities/"
         url = url.format(
@@ -143,50 +508,101 @@ class BungieAPI:
             destinyMembershipId=membership_id,
             characterId=character_id)
 
-        activities = []
-        current_page = 0
-        while True:
-            current_page += 1
-            query_params = {
-                "count": 250,  # Max
-                "mode": gamemode,
-                "page": current_page}
-
-            async with await self.get(url, headers=BungieAPI.HEADERS, params=query_params) as resp:
-                r = await resp.json()
-
-                if r["ErrorCode"] != 1:
-                    raise BungieAPIError(r, "Fetch activity history error.")
-                
-                if len(r["Response"]) == 0:
+        pages = collections.deque([asyncio.ensure_future(self._fetch_history_page(url, gamemode, 0))])
+        next_page = 1
+        try:
+            while len(pages) > 0:
+                activities = await pages.popleft()
+                if len(activities) == 0:
                     break
 
-                for activity in r["Response"]["activities"]:
-                    activity_date = datetime.strptime(activity["period"], BungieAPI.API_DATE_FORMAT)
-                    if to_date > activity_date > from_date:
-                        # strip "values" attribute from the history to save space (not needed, it is in carnage report)
+                # Pages are sorted newest first and ISO dates compare like strings
+                has_next_page = (activities[-1]["period"] > from_period
+                                 and len(activities) == BungieAPI.HISTORY_PAGE_SIZE)
+                if has_next_page:
+                    # Fetch the next page and `prefetch` more while this one is consumed
+                    while len(pages) <= prefetch:
+                        pages.append(asyncio.ensure_future(self._fetch_history_page(url, gamemode, next_page)))
+                        next_page += 1
+
+                for activity in activities:
+                    if to_period > activity["period"] > from_period:
+                        # strip "values" attribute from the history to save space (not needed, it is in carnage report),
+                        # already skipped by the msgspec decoder
                         activity.pop("values", None)
-                        activities.append(activity)
+                        yield activity
 
-                start_date = datetime.strptime(r["Response"]["activities"][0]["period"], BungieAPI.API_DATE_FORMAT)
-                end_date = datetime.strptime(r["Response"]["activities"][-1]["period"], BungieAPI.API_DATE_FORMAT)
-                if start_date > from_date > end_date:
+                if not has_next_page:
                     break
+        finally:
+            # Speculative pages past the end of the history
+            for page in pages:
+                if page.done() and not page.cancelled():
+                    page.exception()  # retrieved, not logged by asyncio
+                page.cancel()
+            
+    async def _fetch_history_page(self, url: str, gamemode, page: int):
+        query_params = {
+            "count": BungieAPI.HISTORY_PAGE_SIZE,
+            "mode": gamemode,
+            "page": page}
+
+        r = await self.get(url, "activity_history", params=query_params)
 
-        return activities
+        if r["ErrorCode"] != 1:
+            raise BungieAPIError(r, "Fetch activity history error.")
+        
+        return r["Response"].get("activities", [])
+    
+    @staticmethod
+    def _history_periods(from_date="", to_date=""):
+        """
+        :return: from_date and to_date as strings formatted like API_DATE_FORMAT, from_date first
+        """
+        if from_date == "":
+            from_date = datetime(2015, 1, 1, 0, 0, 0)   # oldest
+        if to_date == "":
+            to_date = datetime.now()   # newest
+        
+        # Validate strings
+        if not isinstance(from_date, datetime):
+            from_date = datetime.strptime(from_date, BungieAPI.API_DATE_FORMAT)
+        if not isinstance(to_date, datetime):
+            to_date = datetime.strptime(to_date, BungieAPI.API_DATE_FORMAT)
+
+        if from_date > to_date:
+            from_date, to_date = (to_date, from_date)
+        
+        return from_date.strftime(BungieAPI.API_DATE_FORMAT), to_date.strftime(BungieAPI.API_DATE_FORMAT)
     
+    async def fetch_entity_definition(self, entity_type: str, hash_identifier: int):
+        """
+        :param entity_type: for instance DestinyActivityDefinition
+        :param hash_identifier: 
+        :return: 
+        """
+        url = BungieAPI.ENDPOINT + "/Destiny2/Manifest/{entityType}/{hashIdentifier}/"
+        url = url.format(
+            entityType=entity_type,
+            hashIdentifier=hash_identifier)
+
+        r = await self.get(url, "entity_definition")
+        if r["ErrorCode"] == 1:
+            return r["Response"]
+        else:
+            raise BungieAPIError(r, f"Fetch entity definition error ({entity_type}-{hash_identifier})")
+
     async def fetch_carnage_report(self, instance_id: int):
         url = BungieAPI.ENDPOINT + "/Destiny2/Stats/PostGameCarnageReport/{instanceId}/"
         url = url.format(
             instanceId=instance_id
         )
 
-        async with await self.get(url, headers=BungieAPI.HEADERS) as resp:
-            r = await resp.json()
-            if r["ErrorCode"] == 1:
-                return r["Response"]
-            else:
-                raise BungieAPIError(r, f"Fetch carnage_report error (instance_id-{instance_id})")
+        r = await self.get(url, "carnage_report")
+        if r["ErrorCode"] == 1:
+            return r["Response"]
+        else:
+            raise BungieAPIError(r, f"Fetch carnage_report error (instance_id-{instance_id})")
     
             
 class BungieAPIError(Exception):
@@ -197,4 +613,12 @@ class BungieAPIError(Exception):
         
     def __str__(self):
         return f"{self.message} with API response: {self.response}"
+
+
+class BungieAPIThrottleError(BungieAPIError):
+    pass
+
+
+class BungieAPITransientError(BungieAPIError):
+    pass
         
\ No newline at end of file
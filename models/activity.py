@@ -1,12 +1,16 @@
 ﻿import json
+
 import pandas as pd
 
-from models.guardian import Guardian
+from models.carnage_report import CarnageReport, Player, parse_carnage_report
+from models.guardian import Guardian, to_id
 
 
 class Activity:
-    def __init__(self, instance_id=""):
-        self.instance_id = instance_id  # new for activity_id
+    __slots__ = ("instance_id", "period", "mode", "is_private", "win_score", "loss_score", "players")
+
+    def __init__(self, instance_id=0):
+        self.instance_id = to_id(instance_id)  # new for activity_id
         
         # carnage report
         self.period = ""
@@ -14,35 +18,35 @@ class Activity:
         self.is_private = False
         self.win_score = 0
         self.loss_score = 0
-        self.players = []
+        self.players: list[Player] = []
         
     def set_carnage_report(self, report):
-        self.period = report["period"]
-        self.mode = report["activityDetails"]["mode"]
-        self.is_private = report["activityDetails"]["isPrivate"]
-        self.win_score = report["teams"][0]["score"]["basic"]["value"]
-        self.loss_score = report["teams"][1]["score"]["basic"]["value"]
-        if self.win_score < self.loss_score:
-            self.win_score, self.loss_score = (self.loss_score, self.win_score)
-        
-        if report["teams"][0]["standing"]["basic"]["value"] < 0.5:
-            winning_team_id = report["teams"][0]["teamId"]
-        else:
-            winning_team_id = report["teams"][1]["teamId"]
-        for entry in report["entries"]:
-            membership_id = entry["player"]["destinyUserInfo"]["membershipId"]
-            membership_type = entry["player"]["destinyUserInfo"]["membershipType"]
-            character_id = entry["characterId"]
-            is_winner = entry["values"]["team"]["basic"]["value"] == winning_team_id
-            self.players.append({"membership_id": membership_id,
-                                 "membership_type": membership_type,
-                                 "character_id": character_id,
-                                 "is_winner": is_winner})
+        """
+        :param report: Response of the carnage report, or the CarnageReport already parsed from it
+        """
+        if not isinstance(report, CarnageReport):
+            report = parse_carnage_report(report, with_guardians=False)
+        self.period = report.period
+        self.mode = report.mode
+        self.is_private = report.is_private
+        self.win_score = report.win_score
+        self.loss_score = report.loss_score
+        self.players = report.players
+
+    @classmethod
+    def from_data(cls, items):
+        """
+        :param items: (attribute, value) pairs, like the items of data
+        """
+        activity = cls()
+        for attribute, value in items:
+            setattr(activity, attribute, value)
+        return activity
             
     @staticmethod
     def get_dtypes_dict():
         return {
-            "instance_id": pd.StringDtype(),
+            "instance_id": int,
             "period": pd.StringDtype(),
             "mode": int,
             "is_private": bool,
@@ -60,7 +64,7 @@ class Activity:
             "is_private": self.is_private,
             "win_score": self.win_score,
             "loss_score": self.loss_score,
-            "players": json.dumps(self.players)
+            "players": json.dumps([player._asdict() for player in self.players])
         }
         
     def __str__(self):
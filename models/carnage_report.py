@@ -0,0 +1,123 @@
+from typing import NamedTuple
+
+from models.guardian import Guardian, to_id
+
+EMPTY = {}
+
+
+class Player(NamedTuple):
+    """
+    Player of an activity, a tuple instead of a dict by player.
+    """
+    membership_id: int
+    membership_type: int
+    character_id: int
+    is_winner: bool
+    team: int = None  # not in the players saved before the team was
+
+    @classmethod
+    def from_dict(cls, player: dict):
+        """
+        :param player: player as stored in the json players of an activity
+        """
+        return cls(to_id(player["membership_id"]),
+                   int(player["membership_type"]),
+                   to_id(player["character_id"]),
+                   bool(player["is_winner"]),
+                   player.get("team"))
+
+
+class Team(NamedTuple):
+    team_id: int
+    score: float
+    standing: float  # 0 for the winner, 1 for the loser
+
+
+class CarnageReport(NamedTuple):
+    instance_id: int
+    period: str
+    mode: int
+    modes: list[int]
+    is_private: bool
+    teams: list[Team]
+    winning_team: int  # None without teams
+    win_score: float
+    loss_score: float
+    players: list[Player]  # in the order of the entries
+    guardians: list[Guardian]  # of the players not skipped, in the order of the entries
+
+
+def basic_value(stats: dict, name: str, default=None):
+    """
+    :return: stats[name]["basic"]["value"], default if any of them is missing
+    """
+    return stats.get(name, EMPTY).get("basic", EMPTY).get("value", default)
+
+
+def parse_carnage_report(carnage_report: dict, skip=None, with_guardians=True) -> CarnageReport:
+    """
+    Everything read from a post game carnage report (PGCR), in a single pass over its entries. A missing field gets a
+    default value instead of an error, an entry without its ids is dropped.
+    :param carnage_report: Response of the carnage report
+    :param skip: skip(character_id, is_private) is True for the players whose Guardian is not needed, checked before
+    it is built
+    :param with_guardians: build the Guardians of the players, an Activity needs the players only
+    :return:
+    """
+    details = carnage_report.get("activityDetails", EMPTY)
+
+    teams = [Team(team.get("teamId"), basic_value(team, "score", 0), basic_value(team, "standing"))
+             for team in carnage_report.get("teams", ())]
+    winning_team = None
+    win_score = loss_score = 0
+    if len(teams) > 0:
+        # The standing of the first team is enough, the other team is the loser or the winner
+        if teams[0].standing is not None and teams[0].standing < 0.5:
+            winning_team = teams[0].team_id
+        elif len(teams) > 1:
+            winning_team = teams[1].team_id
+        win_score = teams[0].score
+        loss_score = teams[1].score if len(teams) > 1 else 0
+        if win_score < loss_score:
+            win_score, loss_score = loss_score, win_score
+
+    players = []
+    guardians = []
+    for entry in carnage_report.get("entries", ()):
+        user = entry.get("player", EMPTY).get("destinyUserInfo", EMPTY)
+        membership_id = user.get("membershipId")
+        character_id = entry.get("characterId")
+        if not membership_id or not character_id:
+            continue
+        membership_id = int(membership_id)
+        character_id = int(character_id)
+        membership_type = user.get("membershipType", 0)
+        team = entry.get("values", EMPTY).get("team", EMPTY).get("basic", EMPTY).get("value")
+        if team is not None:
+            team = int(team)
+        # tuple.__new__ skips the python __new__ of the named tuple
+        players.append(tuple.__new__(Player, (membership_id, membership_type, character_id,
+                                              team is not None and team == winning_team, team)))
+
+        if with_guardians:
+            is_private = not user.get("isPublic", False)
+            if skip is None or not skip(character_id, is_private):
+                # The display name is not always available (old or private profile)
+                guardians.append(Guardian(display_name=user.get("bungieGlobalDisplayName", ""),
+                                          display_name_code=user.get("bungieGlobalDisplayNameCode", ""),
+                                          membership_id=membership_id,
+                                          membership_type=membership_type,
+                                          character_id=character_id,
+                                          is_private=is_private))
+
+    return CarnageReport(instance_id=to_id(details.get("instanceId")),
+                         period=carnage_report.get("period", ""),
+                         mode=details.get("mode", 0),
+                         modes=details.get("modes", []),
+                         is_private=details.get("isPrivate", False),
+                         teams=teams,
+                         winning_team=winning_team,
+                         win_score=win_score,
+                         loss_score=loss_score,
+                         players=players,
+                         guardians=guardians)
@@ -1,20 +1,33 @@
 ﻿import pandas as pd
 
 
+def to_id(value) -> int:
+    """
+    Ids of the api are strings of integers, kept as int (32 bytes instead of 68 for a 19 digits str). 0 for a missing
+    id.
+    """
+    return int(value) if value else 0
+
+
 class Guardian:
+    # No __dict__ by guardian, the crawler creates a dozen of them by carnage report
+    __slots__ = ("display_name", "display_name_code", "membership_id", "membership_type", "character_id", "is_private",
+                 "activities_entered", "activities_won", "assists", "kills", "seconds_played", "deaths",
+                 "average_lifespan", "score", "opponents_defeated", "precision_kills", "combat_rating")
+
     def __init__(self,
                  display_name="",
                  display_name_code="",
-                 membership_id="",
-                 membership_type="",
-                 character_id="",
+                 membership_id=0,
+                 membership_type=0,
+                 character_id=0,
                  is_private=False):
         self.display_name = str(display_name)
         self.display_name_code = str(display_name_code)
         
-        self.membership_id = str(membership_id)
-        self.membership_type = str(membership_type)
-        self.character_id = str(character_id)
+        self.membership_id = to_id(membership_id)
+        self.membership_type = to_id(membership_type)
+        self.character_id = to_id(character_id)
         
         self.is_private = is_private
         
@@ -44,6 +57,16 @@ class Guardian:
         self.opponents_defeated = v["opponentsDefeated"]["basic"]["value"]
         self.precision_kills =    v["precisionKills"]["basic"]["value"]
         self.combat_rating =      v["combatRating"]["basic"]["value"]
+
+    @classmethod
+    def from_data(cls, items):
+        """
+        :param items: (attribute, value) pairs, like the items of data
+        """
+        guardian = cls()
+        for attribute, value in items:
+            setattr(guardian, attribute, value)
+        return guardian
         
     @staticmethod
     def get_dtypes_dict():
@@ -97,5 +120,5 @@ class Guardian:
             return f"Guardian {self.membership_id}-{self.membership_type}-{self.character_id}"
     
     def __repr__(self):
-        return str(vars(self))
+        return str(self.data)
     
@@ -1,67 +1,48 @@
 ﻿import os
 import time
-import warnings
+import logging
 import pandas as pd
 
+from bulk_load import import_parquet
 from db import MainDBHelper, SourceDBHelper
-from models.activity import Activity
-from models.guardian import Guardian
 
 ROOT_DATA_FOLDER = "../data"
 
-db_helper = MainDBHelper("main.db", ROOT_DATA_FOLDER)
+logging.basicConfig(level=logging.INFO)
 
-# Transfer guardians from df to sql
-n = 0
-df_name = "guardians-" + f"{n:02}" + ".parquet"
-while df_name in os.listdir(ROOT_DATA_FOLDER):
-    df = pd.read_parquet(os.path.join(ROOT_DATA_FOLDER, df_name))
 
-    start_time = time.monotonic()
-    with warnings.catch_warnings():
-        warnings.simplefilter(action='ignore', category=FutureWarning)
-        
-        for i, g in df.iterrows():
-            guardian = Guardian()
-            for attr in guardian.data:
-                guardian.__dict__[attr] = g[attr]
-            db_helper.insert_guardian(guardian)
-    db_helper.commit()
-    print(f"Inserting guardians from {df_name} took {time.monotonic() - start_time}s.")
-                
-    n += 1
-    df_name = "guardians-" + f"{n:02}" + ".parquet"
+def get_chunks(prefix: str) -> list[str]:
+    """
+    :return: paths of the chunks prefix-00.parquet, prefix-01.parquet... in order, until the first missing one
+    """
+    paths = []
+    df_name = prefix + "-" + f"{len(paths):02}" + ".parquet"
+    while df_name in os.listdir(ROOT_DATA_FOLDER):
+        paths.append(os.path.join(ROOT_DATA_FOLDER, df_name))
+        df_name = prefix + "-" + f"{len(paths):02}" + ".parquet"
+    return paths
 
 
-# Transfer activities from df to sql
-n = 0
-df_name = "activities-" + f"{n:02}" + ".parquet"
-while df_name in os.listdir(ROOT_DATA_FOLDER):
-    df = pd.read_parquet(os.path.join(ROOT_DATA_FOLDER, df_name))
+db_helper = MainDBHelper("main.db", ROOT_DATA_FOLDER, create=True)
 
+# Transfer guardians and activities (and their players) from the parquet chunks to sql
+for table, prefix in (("guardian", "guardians"), ("activity", "activities")):
+    paths = get_chunks(prefix)
     start_time = time.monotonic()
-    
-    for i, a in df.iterrows():
-        activity = Activity()
-        for attr in activity.data:
-            activity.__dict__[attr] = a[attr]
-        db_helper.insert_activity(activity)
-    db_helper.commit()
-    
-    print(f"Inserting activities from {df_name} took {time.monotonic() - start_time}s.")
+    n_rows = import_parquet(db_helper, table, paths)
+    elapsed = time.monotonic() - start_time
+    print(f"Inserting {n_rows} {prefix} from {len(paths)} files took {elapsed:.1f}s "
+          f"({n_rows / max(elapsed, 1e-9):.0f} rows/s).")
+db_helper.close()
+
 
-    n += 1
-    df_name = "activities-" + f"{n:02}" + ".parquet"
-    
-    
 # Transfer sources from df to sql
-source_db_helper = SourceDBHelper(name="sources.db", folder=ROOT_DATA_FOLDER)
+source_db_helper = SourceDBHelper(name="sources.db", folder=ROOT_DATA_FOLDER, create=True)
 df = pd.read_csv(os.path.join(ROOT_DATA_FOLDER, "guardian_source.csv"))
 
 start_time = time.monotonic()
-
-for i, g in df.iterrows():
-    source_db_helper.insert_source(g.membership_id)
+source_db_helper.insert_sources(df["membership_id"].tolist())
 source_db_helper.commit()
+source_db_helper.close()
 
-print(f"Inserting sources from guardian_source.csv took {time.monotonic() - start_time}s.")
+print(f"Inserting {len(df)} sources from guardian_source.csv took {time.monotonic() - start_time:.1f}s.")
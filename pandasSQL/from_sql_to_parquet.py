@@ -0,0 +1,20 @@
+﻿import time
+import logging
+
+from bulk_load import export_tables
+from db import MainDBHelper
+
+ROOT_DATA_FOLDER = "../data"
+EXPORT_FOLDER = "../data/export"
+
+logging.basicConfig(level=logging.INFO)
+
+# Export the guardians and the activities of main.db in EXPORT_FOLDER/guardian.parquet and activity.parquet, for the
+# analytics
+db_helper = MainDBHelper("main.db", ROOT_DATA_FOLDER)
+
+start_time = time.monotonic()
+n_rows_by_table = export_tables(db_helper, EXPORT_FOLDER, tables=("guardian", "activity", "activity_player"))
+db_helper.close()
+
+print(f"Exporting {n_rows_by_table} rows to {EXPORT_FOLDER} took {time.monotonic() - start_time:.1f}s.")
@@ -0,0 +1,17 @@
+﻿import time
+import logging
+
+from db import MainDBHelper, SourceDBHelper
+
+logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)-8s] %(message)s")
+
+ROOT_DATA_FOLDER = "../data"
+
+# The dbs are migrated to the last version of their schema when they are opened (integer ids, unique keys, the
+# activity_player table filled from the json players of the activities, indexes), it can take a while on a big db
+start_time = time.monotonic()
+for helper in (MainDBHelper("main.db", ROOT_DATA_FOLDER), SourceDBHelper("sources.db", ROOT_DATA_FOLDER)):
+    print(f"{helper} at version {helper.version}.")
+    helper.close()
+
+print(f"Migrating the dbs took {time.monotonic() - start_time}s.")
@@ -0,0 +1,45 @@
+"""
+Crawl with every key of secret_tokens.json, one worker process and one shard per key (see shards.py).
+"""
+import logging
+from datetime import datetime
+
+from local_api import BungieAPI
+from shards import run_sharded_crawl
+
+# Logging configuration, also run by the worker processes
+logging.basicConfig(format="[%(asctime)s] [%(processName)-10s] [%(levelname)-8s] %(message)s",
+                    datefmt="%Y/%m/%d %I:%M:%S",
+                    filename="sharded_scraping.log",
+                    encoding="utf-8",
+                    level=logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.INFO)
+console_handler.setFormatter(logging.Formatter("[%(asctime)s] [%(processName)-10s] [%(levelname)-8s] %(message)s",
+                                               "%Y/%m/%d %I:%M:%S"))
+logging.getLogger().addHandler(console_handler)
+
+# Folder config
+ROOT_DATA_FOLDER = "data"
+
+# Scraping parameters
+GAMEMODES = [5]  # AllPvP
+START_DATE = datetime(year=2021, month=1, day=1)  # minimum date for activities fetched
+END_DATE = datetime(year=2022, month=1, day=1)  # maximum date for activities fetched
+FRONTIER_ORDER = "activities_entered"  # see CrawlFrontier.ORDERS
+ROUND_DURATION = 3600  # seconds of crawl between two merges of the shards
+MAX_ROUNDS = None  # until nothing new is found
+
+
+if __name__ == "__main__":
+    api_keys = BungieAPI.read_api_keys()
+    logging.info(f"New sharded run with {len(api_keys)} keys.")
+    n_rows = run_sharded_crawl(api_keys,
+                               folder=ROOT_DATA_FOLDER,
+                               gamemodes=GAMEMODES,
+                               from_date=START_DATE,
+                               to_date=END_DATE,
+                               frontier_order=FRONTIER_ORDER,
+                               round_duration=ROUND_DURATION,
+                               max_rounds=MAX_ROUNDS)
+    logging.info(f"Run finished, {n_rows} rows merged.")
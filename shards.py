@@ -0,0 +1,154 @@
+"""
+Crawl with several api keys: one worker process per key, each with its own BungieAPI (so its own rate limiter), its
+own partition of the frontier and its own shard of the dbs. Shards are merged into main.db and sources.db at the end of
+each round, the guardians found during a round are sources of the next one.
+
+The sources are partitioned, not the matches: during a round, a shard only knows the activities and guardians of
+main.db and of its own shard. When the sources of two shards share matches, both shards fetch these carnage reports
+and the stats of their players, and the merge keeps one copy. This duplication grows with the number of shards and
+the overlap of the histories, it is measured by benchmarks.sharded_crawl_benchmark (requests per merged row).
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import aiohttp
+
+from api_cache import ResponseCache
+from crawler import CrawlPipeline
+from db import MainDBHelper, SourceDBHelper, DBWriter, ExistenceIndex, CrawlFrontier, create_shard, merge_shard
+from local_api import BungieAPI
+
+SHARDS_FOLDER = "shards"
+PROCESS_CONTEXT = multiprocessing.get_context("spawn")  # like on windows, workers do not inherit an event loop
+TIMEOUT = aiohttp.ClientTimeout(total=10800)   # 3 hours
+
+
+def get_shard_folder(folder: str, index: int) -> str:
+    return os.path.join(folder, SHARDS_FOLDER, f"shard_{index}")
+
+
+def crawl_shard(index: int,
+                n_shards: int,
+                api_key: str,
+                folder="data",
+                gamemodes=(5,),
+                from_date="",
+                to_date="",
+                frontier_order="rowid",
+                duration=None,
+                endpoint=None):
+    """
+    Entry point of a worker process.
+    :param index: shard index
+    :param n_shards:
+    :param api_key: key of this worker
+    :param folder: folder of main.db and sources.db, read only (the cursor of the frontier is kept in the shard)
+    :param gamemodes: see CrawlPipeline
+    :param from_date: see CrawlPipeline
+    :param to_date: see CrawlPipeline
+    :param frontier_order: see CrawlFrontier.ORDERS
+    :param duration: seconds before the crawl is stopped (the work left is in the journal of the shard), None to crawl
+    the whole partition
+    :param endpoint: BungieAPI.ENDPOINT override, to crawl a fake server
+    """
+    if sys.platform == "win32":
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    if endpoint is not None:
+        BungieAPI.ENDPOINT = endpoint
+
+    asyncio.run(_crawl_shard(index, n_shards, api_key, folder, gamemodes, from_date, to_date, frontier_order, duration))
+
+
+async def _crawl_shard(index, n_shards, api_key, folder, gamemodes, from_date, to_date, frontier_order, duration):
+    shard_folder = get_shard_folder(folder, index)
+    create_shard(folder, shard_folder)
+
+    # The shard rows of an unfinished previous round are not merged yet
+    db_helper = MainDBHelper("main.db", folder)
+    source_db_helper = SourceDBHelper("sources.db", folder)
+    shard_db_helper = MainDBHelper("main.db", shard_folder)
+    shard_source_db_helper = SourceDBHelper("sources.db", shard_folder)
+    index_ = ExistenceIndex(db_helper, source_db_helper)
+    index_.load(shard_db_helper, shard_source_db_helper)
+    for helper in (db_helper, source_db_helper, shard_db_helper, shard_source_db_helper):
+        helper.close()
+
+    frontier = CrawlFrontier(folder=folder, order=frontier_order, shard=(index, n_shards), cursor_folder=shard_folder)
+    cache = ResponseCache(folder=shard_folder)
+    try:
+        async with aiohttp.ClientSession(timeout=TIMEOUT) as session:
+            api = BungieAPI(session, api_key=api_key, cache=cache)
+            pipeline = CrawlPipeline(api, index_, DBWriter(folder=shard_folder),
+                                     gamemodes=gamemodes,
+                                     from_date=from_date,
+                                     to_date=to_date)
+            try:
+                await asyncio.wait_for(pipeline.run(frontier), duration)
+            except asyncio.TimeoutError:
+                logging.info(f"Shard {index} stopped after {duration}s.")
+            logging.info(f"Shard {index} done. API metrics: {api.metrics}. "
+                         f"DB writer metrics: {pipeline.writer.metrics}")
+    finally:
+        cache.close()
+        frontier.close()
+
+
+def run_sharded_crawl(api_keys: list[str],
+                      folder="data",
+                      gamemodes=(5,),
+                      from_date="",
+                      to_date="",
+                      frontier_order="rowid",
+                      round_duration=None,
+                      max_rounds=1,
+                      endpoint=None) -> int:
+    """
+    Crawl in rounds with one worker process per key, merging the shards after each round.
+    The number of keys must not change while a shard is unfinished, the shard index is the partition of the frontier.
+    :param api_keys: see BungieAPI.read_api_keys
+    :param folder: folder of main.db and sources.db
+    :param gamemodes: see CrawlPipeline
+    :param from_date: see CrawlPipeline
+    :param to_date: see CrawlPipeline
+    :param frontier_order: see CrawlFrontier.ORDERS
+    :param round_duration: seconds of crawl before the shards are merged, None to crawl the whole frontier
+    :param max_rounds: None to crawl until a round does not find anything new
+    :param endpoint: BungieAPI.ENDPOINT override, to crawl a fake server
+    :return: number of rows merged
+    """
+    # Migrated once before the workers read them
+    for helper in (MainDBHelper("main.db", folder), SourceDBHelper("sources.db", folder)):
+        helper.close()
+
+    n_shards = len(api_keys)
+    n_rows = 0
+    n_rounds = 0
+    while max_rounds is None or n_rounds < max_rounds:
+        start_time = time.monotonic()
+        processes = [PROCESS_CONTEXT.Process(target=crawl_shard,
+                                            name=f"shard-{i}",
+                                            args=(i, n_shards, api_key, folder, gamemodes, from_date, to_date,
+                                                  frontier_order, round_duration, endpoint))
+                     for i, api_key in enumerate(api_keys)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            if process.exitcode != 0:
+                logging.error(f"Worker {process.name} exited with code {process.exitcode}.")
+
+        # A failed worker leaves a consistent shard, it is merged too
+        round_rows = sum(merge_shard(folder, get_shard_folder(folder, i)) for i in range(n_shards)
+                         if os.path.exists(get_shard_folder(folder, i)))
+        n_rows += round_rows
+        n_rounds += 1
+        logging.info(f"Round {n_rounds} of {n_shards} shards done in {time.monotonic() - start_time:.1f}s, "
+                     f"{round_rows} rows merged.")
+        if round_rows == 0:
+            break
+
+    return n_rows
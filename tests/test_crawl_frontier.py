@@ -0,0 +1,98 @@
+"""
+CrawlFrontier against the guardians inserted during the crawl.
+
+    python -m pytest tests
+"""
+import itertools
+import shutil
+import tempfile
+import unittest
+
+from db import MainDBHelper, SourceDBHelper, CrawlFrontier
+from models.guardian import Guardian
+
+
+class CrawlFrontierTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.db_helper = MainDBHelper("main.db", self.folder, create=True)
+        self.source_db_helper = SourceDBHelper("sources.db", self.folder, create=True)
+        self.ids = itertools.count(1)
+        # activities_entered from 10 to 1, then a guardian without stats
+        for activities_entered in range(10, 0, -1):
+            self.insert_guardian(activities_entered)
+        self.insert_guardian(None)
+
+    def tearDown(self):
+        self.db_helper.close()
+        self.source_db_helper.close()
+        shutil.rmtree(self.folder)
+
+    def insert_guardian(self, activities_entered) -> int:
+        membership_id = next(self.ids)
+        guardian = Guardian(membership_id=membership_id, membership_type=3, character_id=membership_id)
+        guardian.activities_entered = activities_entered
+        self.db_helper.insert_guardians([guardian])
+        self.db_helper.commit()
+        return membership_id
+
+    def use_sources(self, membership_ids):
+        # Like the crawler once the sources are crawled
+        self.source_db_helper.insert_sources(membership_ids)
+        self.source_db_helper.commit()
+
+    def test_guardian_inserted_above_the_cursor(self):
+        frontier = CrawlFrontier(folder=self.folder, order="activities_entered", batch_size=2)
+        served = []
+        high_priority = None
+        for guardian in frontier:
+            served.append(guardian.membership_id)
+            self.use_sources([guardian.membership_id])
+            if len(served) == 3:
+                high_priority = self.insert_guardian(5000)
+        frontier.close()
+
+        self.assertIn(high_priority, served)
+        self.assertEqual(len(served), len(set(served)))
+        self.assertEqual(set(served), set(range(1, high_priority + 1)))  # the guardian without stats too
+        self.assertEqual(served[:3], [1, 2, 3])
+
+    def test_resume_after_a_guardian_inserted_above_the_cursor(self):
+        frontier = CrawlFrontier(folder=self.folder, order="activities_entered", batch_size=2)
+        served = []
+        for guardian in frontier:
+            served.append(guardian.membership_id)
+            self.use_sources([guardian.membership_id])
+            if len(served) == 4:
+                break
+        frontier.close()
+
+        # Found by the crawl before the restart, above the saved cursor
+        high_priority = self.insert_guardian(5000)
+        frontier = CrawlFrontier(folder=self.folder, order="activities_entered", batch_size=2)
+        for guardian in frontier:
+            served.append(guardian.membership_id)
+            self.use_sources([guardian.membership_id])
+        frontier.close()
+
+        self.assertEqual(set(served), set(range(1, high_priority + 1)))
+
+    def test_restart_after_exhaustion(self):
+        for order in CrawlFrontier.ORDERS:
+            with self.subTest(order=order):
+                # The cursor of the order ends on it
+                self.insert_guardian(0)
+                frontier = CrawlFrontier(folder=self.folder, order=order, batch_size=3)
+                for guardian in frontier:
+                    self.use_sources([guardian.membership_id])
+                frontier.close()
+
+                membership_id = self.insert_guardian(5000)
+                frontier = CrawlFrontier(folder=self.folder, order=order, batch_size=3)
+                self.assertEqual([guardian.membership_id for guardian in frontier], [membership_id])
+                frontier.close()
+                self.use_sources([membership_id])
+
+
+if __name__ == "__main__":
+    unittest.main()